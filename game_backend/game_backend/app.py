@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import json
+from typing import Callable
 
-from flask import Flask, request
+from flask import Flask, Response, abort, request
 
-from game_backend.game import Game
+from game_backend.config import ACTION_TIMEOUT, AUDIT_ENDPOINT
+from game_backend.ecs.entity import EntityCatalog
+from game_backend.ecs.entity_index import external_id
+from game_backend.game import Game, PlayerChanges
 from game_backend.init_game import (
     initialise_gamestate,
     init_state_complex,
@@ -13,6 +18,20 @@ from game_backend.resources import Resources
 from game_backend.game_structs import PlanetLocation
 
 app = Flask(__name__)
+# Set by start_game
+game_thread: Game = None
+
+
+def start_game(game: Game) -> Game:
+    """
+    Starts the game thread and makes the app serve it
+    """
+    global game_thread
+    game_thread = game
+    # The game stops with the server
+    game_thread.daemon = True
+    game_thread.start()
+    return game_thread
 
 
 @app.route("/")
@@ -27,51 +46,117 @@ def ping():
 
 @app.route("/get_state")
 def get_state():
-    return json.dumps(game_state.serialise())
+    return published_response(None, "state")
+
+
+def apply_action(action: Callable, *args):
+    """
+    Actions are applied by the game thread, between two updates. Actions which are
+    not applied in time are cancelled, so that a client retrying them does not get
+    them applied twice.
+    """
+    future = game_thread.submit(action, *args)
+    try:
+        return future.result(timeout=ACTION_TIMEOUT)
+    except FutureTimeoutError:
+        if future.cancel():
+            abort(503, "The game did not apply the action in time, it was cancelled")
+        # The game thread started applying it meanwhile
+        return future.result()
+
+
+@app.route("/audit")
+def audit():
+    """
+    Numbers of entities leaked by the game, by entity class. Only served when
+    AUDIT_ENDPOINT is enabled
+    """
+    if not AUDIT_ENDPOINT:
+        abort(404)
+    return apply_action(lambda: json.dumps(EntityCatalog.audit().counts()))
 
 
 @app.route("/new_player/<name>", methods=["POST"])
 def new_player(name: str):
-    return str(game_thread.create_new_player(name, name))
+    return str(apply_action(game_thread.create_new_player, name, name))
+
+
+def published_response(player_id: str, view: str) -> Response:
+    """
+    View published by the game thread, or 304 if the client already has it. The
+    views published as chunks are streamed.
+    """
+    try:
+        published = game_thread.views.get(player_id, view, timeout=ACTION_TIMEOUT)
+    except TimeoutError:
+        abort(503, "The game did not publish the view in time")
+    if published is None:
+        abort(404, f"Unknown player {player_id}")
+    response = Response(published.body)
+    response.set_etag(published.etag)
+    return response.make_conditional(request)
 
 
 @app.route("/player/<player_id>/get/planets")
 def get_player_planets(player_id: str):
-    return json.dumps(
-        {
-            planet_id: planet.serialise()
-            for planet_id, planet in game_thread.get_player_planets(player_id).items()
-        }
-    )
+    return published_response(player_id, "planets")
 
 
 @app.route("/player/<player_id>/get/fleets")
 def get_player_fleets(player_id: str):
-    return json.dumps(
-        [fleet.serialise() for fleet in game_thread.get_player_fleets(player_id)]
-    )
+    return published_response(player_id, "fleets")
 
 
 @app.route("/player/<player_id>/get/research")
 def get_player_research(player_id: str):
+    return published_response(player_id, "research")
+
+
+def serialise_changes(changes: PlayerChanges) -> str:
     return json.dumps(
         {
-            research_name: research.serialise()
-            for research_name, research in game_thread.get_player_research(
-                player_id
-            ).items()
+            "version": changes.version,
+            "time": changes.time,
+            "planets": {
+                planet_id: planet.serialise()
+                for planet_id, planet in changes.planets.items()
+            },
+            "fleets": [fleet.serialise() for fleet in changes.fleets],
+            "research": {
+                research_name: research.serialise()
+                for research_name, research in changes.research.items()
+            },
+            "fleet_ids": [external_id(fleet_id) for fleet_id in changes.fleet_ids],
         }
     )
 
 
+@app.route("/player/<player_id>/get/changes/<int:since>")
+def get_player_changes(player_id: str, since: int):
+    """
+    Planets, fleets and research of the player that changed since the version
+    returned by a previous call, 0 to get everything. The changes depend on the
+    version of the client, so they are serialised by the game thread on demand.
+    The production does not change the planets: their resources are given at the
+    game time _last_settled, the client adds _production_per_second times the time
+    elapsed since, up to the current game time and to _resources_storage.
+    """
+    return apply_action(
+        lambda: serialise_changes(game_thread.get_player_changes(player_id, since))
+    )
+
+
 @app.route(
     "/player/<player_id>/actions/upgrade_building/<planet_id>/<building_id>",
     methods=["POST"],
 )
 def upgrade_building(player_id: str, planet_id: str, building_id: str):
     return str(
-        game_thread.action_upgrade_building(
-            player_id, PlanetLocation.from_str(planet_id), building_id
+        apply_action(
+            game_thread.action_upgrade_building,
+            player_id,
+            PlanetLocation.from_str(planet_id),
+            building_id,
         )
     )
 
@@ -82,8 +167,11 @@ def upgrade_building(player_id: str, planet_id: str, building_id: str):
 )
 def upgrade_research(player_id: str, planet_id: str, research_id: str):
     return str(
-        game_thread.action_upgrade_research(
-            player_id, PlanetLocation.from_str(planet_id), research_id
+        apply_action(
+            game_thread.action_upgrade_research,
+            player_id,
+            PlanetLocation.from_str(planet_id),
+            research_id,
         )
     )
 
@@ -93,8 +181,11 @@ def upgrade_research(player_id: str, planet_id: str, research_id: str):
 )
 def build_ship(player_id: str, planet_id: str, ship_id: str):
     return str(
-        game_thread.action_build_ship(
-            player_id, PlanetLocation.from_str(planet_id), ship_id
+        apply_action(
+            game_thread.action_build_ship,
+            player_id,
+            PlanetLocation.from_str(planet_id),
+            ship_id,
         )
     )
 
@@ -112,7 +203,8 @@ def send_mission(player_id: str, planet_id: str, mission: str):
         cargo = {Resources(res): quantity for res, quantity in content["cargo"].items()}
     else:
         cargo = None
-    action_outcome = game_thread.action_send_mission(
+    action_outcome = apply_action(
+        game_thread.action_send_mission,
         player_id,
         PlanetLocation.from_str(planet_id),
         mission,
@@ -123,9 +215,6 @@ def send_mission(player_id: str, planet_id: str, mission: str):
 
 
 if __name__ == "__main__":
-    game_state = init_fast_empty()
-    game_thread = Game(game_state)
-
-    game_thread.start()
+    start_game(Game(init_fast_empty()))
 
     app.run()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+HTTP/1.1 server for the game API, built on asyncio streams.
+
+Connections are handled by the event loop, so that thousands of idle keep-alive
+connections cost little, and requests are dispatched to the Flask app on a pool of
+worker threads. The game keeps running on its own thread: request handlers only
+queue actions and read the views it publishes.
+
+Run it with: python -m game_backend.async_server
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import io
+import sys
+import traceback
+from typing import Callable, List, Tuple
+from urllib.parse import unquote
+
+from game_backend.config import (
+    KEEP_ALIVE_TIMEOUT,
+    REQUEST_TIMEOUT,
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS,
+)
+
+# Maximum size of the body of a request
+MAX_BODY_SIZE = 1 << 20
+# Maximum number of header lines of a request
+MAX_HEADERS = 100
+
+
+class BadRequest(Exception):
+    def __init__(self, status: HTTPStatus):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+class WSGIServer:
+    def __init__(
+        self,
+        wsgi_app: Callable,
+        host: str = SERVER_HOST,
+        port: int = SERVER_PORT,
+        workers: int = SERVER_WORKERS,
+        keep_alive_timeout: float = KEEP_ALIVE_TIMEOUT,
+        request_timeout: float = REQUEST_TIMEOUT,
+    ):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.keep_alive_timeout = keep_alive_timeout
+        self.request_timeout = request_timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="requests"
+        )
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port
+        )
+        # The port is picked by the system when 0 is given
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        peer = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(), self.keep_alive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                try:
+                    environ = await asyncio.wait_for(
+                        self.read_request(request_line, reader, peer),
+                        self.request_timeout,
+                    )
+                except BadRequest as error:
+                    writer.write(error_response(error.status))
+                    await writer.drain()
+                    break
+                except asyncio.TimeoutError:
+                    # Slow clients would hold their connection forever otherwise
+                    writer.write(error_response(HTTPStatus.REQUEST_TIMEOUT))
+                    await writer.drain()
+                    break
+
+                try:
+                    status, headers, body = await loop.run_in_executor(
+                        self.executor, self.call_app, environ
+                    )
+                except Exception:
+                    # Errors of the app must not drop the connection without a
+                    # response, nor be lost
+                    traceback.print_exc(file=sys.stderr)
+                    writer.write(error_response(HTTPStatus.INTERNAL_SERVER_ERROR))
+                    await writer.drain()
+                    break
+                keep_alive = wants_keep_alive(environ)
+                writer.write(
+                    encode_response(status, headers, body, environ, keep_alive)
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # ValueError is raised by readline for lines over the limit of the reader
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(
+        self, request_line: bytes, reader: asyncio.StreamReader, peer
+    ) -> dict:
+        try:
+            method, target, protocol = request_line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        path, _, query = target.partition("?")
+
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, encoding="latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": peer[0] if peer else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for n_headers in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if n_headers == MAX_HEADERS:
+                raise BadRequest(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, separator, value = line.decode("latin-1").partition(":")
+            if not separator:
+                raise BadRequest(HTTPStatus.BAD_REQUEST)
+            key = name.strip().upper().replace("-", "_")
+            value = value.strip()
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = f"HTTP_{key}"
+            if key in environ:
+                value = f"{environ[key]},{value}"
+            environ[key] = value
+
+        if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            raise BadRequest(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            content_length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        if content_length > MAX_BODY_SIZE:
+            raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(content_length) if content_length else b""
+        environ["wsgi.input"] = io.BytesIO(body)
+        return environ
+
+    def call_app(self, environ: dict) -> Tuple[str, List[Tuple[str, str]], bytes]:
+        """
+        Runs in a worker thread, responses are read whole to be sent with their
+        length
+        """
+        response_start = []
+
+        def start_response(status, headers, exc_info=None):
+            response_start[:] = [status, headers]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        status, headers = response_start
+        return status, headers, body
+
+
+def wants_keep_alive(environ: dict) -> bool:
+    connection = environ.get("HTTP_CONNECTION", "").lower()
+    if environ["SERVER_PROTOCOL"] == "HTTP/1.1":
+        return "close" not in connection
+    return "keep-alive" in connection
+
+
+def encode_response(
+    status: str,
+    headers: List[Tuple[str, str]],
+    body: bytes,
+    environ: dict,
+    keep_alive: bool,
+) -> bytes:
+    lines = [f"HTTP/1.1 {status}"]
+    lines += [
+        f"{name}: {value}"
+        for name, value in headers
+        if name.lower() not in ("content-length", "connection")
+    ]
+    if status[:3] in ("204", "304"):
+        body = b""
+    else:
+        lines.append(f"Content-Length: {len(body)}")
+        if environ["REQUEST_METHOD"] == "HEAD":
+            body = b""
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+def error_response(status: HTTPStatus) -> bytes:
+    body = status.phrase.encode()
+    return (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode("latin-1") + body
+
+
+if __name__ == "__main__":
+    from game_backend.app import app, start_game
+    from game_backend.game import Game
+    from game_backend.init_game import init_fast_empty
+
+    start_game(Game(init_fast_empty()))
+    server = WSGIServer(app)
+    print(f"Serving on http://{server.host}:{server.port}")
+    asyncio.run(server.serve_forever())
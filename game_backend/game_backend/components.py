@@ -1,62 +1,201 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass, field, astuple
-from typing import Dict, List
+from typing import Any, Callable, Dict, List
 
 from dataclasses_jsonschema import JsonSchemaMixin
 
-from game_backend.ecs.component import Component
+from game_backend.ecs.component import (
+    Component,
+    Definition,
+    SharedComponent,
+    cached_attribute,
+    definition_field,
+    derived_stat,
+)
+from game_backend.ecs.entity import EntityCatalog
+from game_backend.config import LEVEL_TABLE_SIZE
 from game_backend.resources import Resources, empty_resources, add_resources
 from game_backend.game_structs import PlanetLocation
 
 
-@dataclass
-class BuildingComponent(Component, JsonSchemaMixin):
+class LevelTable:
+    """
+    Values of a function of the level, computed once for each level. The levels
+    below LEVEL_TABLE_SIZE are computed with the table, the higher ones when they
+    are first read.
+    """
+
+    def __init__(self, compute: Callable[[int], Any], size: int = LEVEL_TABLE_SIZE):
+        self.compute = compute
+        self.values = [compute(level) for level in range(size)]
+
+    def __getitem__(self, level: int):
+        values = self.values
+        if level >= len(values):
+            values.extend(map(self.compute, range(len(values), level + 1)))
+        return values[level]
+
+
+@dataclass(frozen=True)
+class BuildingDefinition(Definition):
     name: str
     base_cost: Dict[Resources, float]
     upgrade_cost_factor: float
     upgrade_prod_factor: float = 1
-    level: int = 0
 
-    @property
-    def upgrade_cost(self) -> Dict[str, float]:
+    def __post_init__(self):
+        super().__post_init__()
+        # The tables are built with the definitions, or on first use when they are
+        # restored from a snapshot
+        self.costs, self.serialised_costs, self.prod_factors
+
+    @cached_attribute
+    def costs(self) -> LevelTable:
+        """
+        Costs of the upgrades from each level
+        """
+        return LevelTable(self.level_cost)
+
+    @cached_attribute
+    def serialised_costs(self) -> LevelTable:
+        return LevelTable(self.serialised_level_cost)
+
+    @cached_attribute
+    def prod_factors(self) -> LevelTable:
+        """
+        Factors of the production and energy of each level
+        """
+        return LevelTable(self.level_prod_factor)
+
+    def level_cost(self, level: int) -> Dict[Resources, float]:
         return {
-            resource.value: resource_base_cost * self.upgrade_cost_factor ** self.level
+            resource: resource_base_cost * self.upgrade_cost_factor ** level
             for resource, resource_base_cost in self.base_cost.items()
         }
 
+    def serialised_level_cost(self, level: int) -> Dict[str, float]:
+        return {resource.value: cost for resource, cost in self.costs[level].items()}
+
+    def level_prod_factor(self, level: int) -> float:
+        return self.upgrade_prod_factor ** level
+
 
 @dataclass
-class ShipComponent(Component, JsonSchemaMixin):
+class BuildingComponent(Component, JsonSchemaMixin):
+    definition: BuildingDefinition
+    level: int = 0
+
+    name = definition_field("name")
+    base_cost = definition_field("base_cost")
+    upgrade_cost_factor = definition_field("upgrade_cost_factor")
+    upgrade_prod_factor = definition_field("upgrade_prod_factor")
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == "level" and hasattr(self, "_entity_id"):
+            building = self.entity
+            planet = building.parent
+            if planet is None:
+                return
+            if ProducerComponent in building.components:
+                # The energy of the planet depends on the building level
+                planet.components[PlanetComponent].invalidate_stats()
+            if (
+                ProducerComponent in building.components
+                or StorageComponent in building.components
+            ):
+                # HACK
+                from game_backend.systems.production_system import ProductionSystem
+
+                # The production rates of the planet depend on the building level
+                ProductionSystem.mark_dirty(planet)
+
+    @property
+    def upgrade_cost(self) -> Dict[str, float]:
+        return self.definition.serialised_costs[self.level]
+
+    def next_level_cost(self) -> Dict[Resources, float]:
+        return self.definition.costs[self.level]
+
+    def prod_factor(self) -> float:
+        return self.definition.prod_factors[self.level]
+
+
+@dataclass(frozen=True)
+class ShipDefinition(Definition):
     name: str
-    number: int
     cost: Dict[Resources, float]
     speed: float
     cargo: float
 
 
 @dataclass
-class ResearchComponent(Component, JsonSchemaMixin):
+class ShipComponent(Component, JsonSchemaMixin):
+    definition: ShipDefinition
+    number: int = 0
+
+    name = definition_field("name")
+    cost = definition_field("cost")
+    speed = definition_field("speed")
+    cargo = definition_field("cargo")
+
+
+@dataclass(frozen=True)
+class ResearchDefinition(Definition):
     name: str
-    level: int
     cost: Dict[Resources, float]
     upgrade_cost_factor: float
 
-    @property
-    def upgrade_cost(self) -> Dict[str, float]:
+    def __post_init__(self):
+        super().__post_init__()
+        self.costs, self.serialised_costs
+
+    @cached_attribute
+    def costs(self) -> LevelTable:
+        """
+        Costs of the upgrades from each level
+        """
+        return LevelTable(self.level_cost)
+
+    @cached_attribute
+    def serialised_costs(self) -> LevelTable:
+        return LevelTable(self.serialised_level_cost)
+
+    def level_cost(self, level: int) -> Dict[Resources, float]:
         return {
-            resource.value: resource_base_cost * self.upgrade_cost_factor ** self.level
-            for resource, resource_base_cost in self.cost.items()
+            resource: resource_cost * self.upgrade_cost_factor ** level
+            for resource, resource_cost in self.cost.items()
         }
 
+    def serialised_level_cost(self, level: int) -> Dict[str, float]:
+        return {resource.value: cost for resource, cost in self.costs[level].items()}
+
 
 @dataclass
-class RequirementsComponent(Component, JsonSchemaMixin):
+class ResearchComponent(Component, JsonSchemaMixin):
+    definition: ResearchDefinition
+    level: int = 0
+
+    name = definition_field("name")
+    cost = definition_field("cost")
+    upgrade_cost_factor = definition_field("upgrade_cost_factor")
+
+    @property
+    def upgrade_cost(self) -> Dict[str, float]:
+        return self.definition.serialised_costs[self.level]
+
+    def next_level_cost(self) -> Dict[Resources, float]:
+        return self.definition.costs[self.level]
+
+
+@dataclass
+class RequirementsComponent(SharedComponent, JsonSchemaMixin):
     building: Dict[str, int]
     research: Dict[str, int]
 
 
 @dataclass
-class CombatComponent(Component, JsonSchemaMixin):
+class CombatComponent(SharedComponent, JsonSchemaMixin):
     hp: float
     shield: float
     damage: float
@@ -70,10 +209,17 @@ class FleetComponent(Component, JsonSchemaMixin):
     travelling_from: PlanetLocation
     cargo: Dict[Resources, float] = field(default_factory=empty_resources)
     travel_time_total: float = None
-    travel_time_left: float = None
+    # Game time at which the fleet reaches its destination
+    arrival_time: float = None
     mission: str = None
 
     @property
+    def travel_time_left(self) -> float:
+        if self.arrival_time is None:
+            return None
+        return self.arrival_time - EntityCatalog.get_special("game_state").world.time
+
+    @derived_stat("cargo")
     def available_cargo(self) -> float:
         fleet = self.entity
         total_available = sum(
@@ -84,17 +230,30 @@ class FleetComponent(Component, JsonSchemaMixin):
 
 
 @dataclass
-class ProducerComponent(Component, JsonSchemaMixin):
+class ProducerComponent(SharedComponent, JsonSchemaMixin):
     production_rate: Dict[Resources, float]
     energy_consumption: int
     energy_production: int = 0
 
 
 @dataclass
-class StorageComponent(Component, JsonSchemaMixin):
+class StorageComponent(SharedComponent, JsonSchemaMixin):
     resources_storage: Dict[Resources, float]
     upgrade_storage_factor: float = 1.833
 
+    @cached_attribute
+    def capacities(self) -> LevelTable:
+        """
+        Storage capacities of each level
+        """
+        return LevelTable(self.level_capacity)
+
+    def level_capacity(self, level: int) -> Dict[Resources, float]:
+        return {
+            resource: storage * self.upgrade_storage_factor ** level
+            for resource, storage in self.resources_storage.items()
+        }
+
 
 @dataclass
 class PlanetComponent(Component, JsonSchemaMixin):
@@ -109,8 +268,14 @@ class PlanetComponent(Component, JsonSchemaMixin):
         default_factory=empty_resources
     )
     _resources_storage: Dict[Resources, float] = field(default_factory=empty_resources)
+    # Game time up to which the resources were accumulated. Accumulating does not
+    # change the version of the planet: clients compute the resources from this
+    # time, the production rates and the storage capacities
+    _last_settled: float = 0.0
 
-    @property
+    # The energy stats depend on the buildings of the planet, they are invalidated
+    # when the levels of the producers change
+    @derived_stat()
     def energy_production(self) -> float:
         energy_production = 0
         planet = self.entity
@@ -121,11 +286,11 @@ class PlanetComponent(Component, JsonSchemaMixin):
                 energy_production += (
                     prod_comp.energy_production
                     * building_comp.level
-                    * building_comp.upgrade_prod_factor ** building_comp.level
+                    * building_comp.prod_factor()
                 )
         return energy_production
 
-    @property
+    @derived_stat()
     def energy_consumption(self) -> float:
         energy_consumption = 0
         planet = self.entity
@@ -136,11 +301,11 @@ class PlanetComponent(Component, JsonSchemaMixin):
                 energy_consumption += (
                     prod_comp.energy_consumption
                     * building_comp.level
-                    * building_comp.upgrade_prod_factor ** building_comp.level
+                    * building_comp.prod_factor()
                 )
         return energy_consumption
 
-    @property
+    @derived_stat()
     def energy_ratio(self) -> float:
         energy_consumption = self.energy_consumption
         if energy_consumption == 0:
@@ -1,3 +1,49 @@
 #!/usr/bin/env python3
 
 TARGET_UPDATE_TIME = 1
+
+# Production of all the planets is computed at once with numpy arrays
+VECTORIZED_PRODUCTION = True
+
+# Resources are only computed when they are read or spent instead of every update
+LAZY_ACCRUAL = False
+
+# Size of the universe
+UNIVERSE_GALAXIES = 5
+UNIVERSE_SYSTEMS = 500
+UNIVERSE_POSITIONS = 9
+
+# Number of levels in the cost, production and storage tables of the buildings and
+# research when they are built, higher levels are added when they are reached
+LEVEL_TABLE_SIZE = 32
+
+# Seed of the random generator used to resolve battles
+COMBAT_RANDOM_SEED = 42
+
+# Maximum time in seconds between two writes of the journal to the disk
+JOURNAL_FSYNC_INTERVAL = 1
+
+# Number of ticks between two snapshots, when the game has a snapshot directory
+SNAPSHOT_INTERVAL = 600
+
+# Maximum time in seconds a request waits for the game thread to apply its action,
+# or to publish the view it reads
+ACTION_TIMEOUT = 10
+
+# Seconds a view of a player keeps being published after it was last read
+PUBLISHED_VIEWS_TTL = 30
+
+# Serve /audit, which walks all the entities on the game thread and delays the next
+# update while it runs. It is not authenticated: only enable it for debugging
+AUDIT_ENDPOINT = False
+
+# Asynchronous server
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 5000
+# Threads running the request handlers
+SERVER_WORKERS = 128
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 75
+# Seconds a client has to send the headers and the body of a request once it sent
+# its request line
+REQUEST_TIMEOUT = 30
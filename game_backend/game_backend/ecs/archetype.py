@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+from typing import Dict, FrozenSet, Iterator, List, Tuple
+
+from game_backend.ecs.component import Component
+
+
+class Archetype:
+    """
+    Groups all the entities that have exactly the same set of component types.
+    Components of each type are stored contiguously in their own column: row i of
+    every column belongs to entities[i].
+    """
+
+    def __init__(self, component_types: FrozenSet[type]):
+        self.component_types = component_types
+        self.entities: List = []
+        self.columns: Dict[type, List[Component]] = {
+            component_type: [] for component_type in component_types
+        }
+
+    def __len__(self):
+        return len(self.entities)
+
+    def append(self, entity) -> int:
+        self.entities.append(entity)
+        for component_type, column in self.columns.items():
+            column.append(entity.components[component_type])
+        return len(self.entities) - 1
+
+    def swap_remove(self, row: int):
+        """
+        Removes a row by moving the last row into it.
+        Returns the entity that was moved, or None if the removed row was the last one
+        """
+        last_row = len(self.entities) - 1
+        moved_entity = None
+        if row != last_row:
+            moved_entity = self.entities[last_row]
+            self.entities[row] = moved_entity
+            for column in self.columns.values():
+                column[row] = column[last_row]
+        self.entities.pop()
+        for column in self.columns.values():
+            column.pop()
+        return moved_entity
+
+
+class ComponentStore:
+    """
+    Column store of all the registered components, indexed by archetype.
+    The entity components dict stays the source of truth for a single entity, the
+    store is used by systems to iterate over every entity having a given set of
+    components without walking the entity tree.
+    """
+
+    def __init__(self):
+        self.archetypes: Dict[FrozenSet[type], Archetype] = {}
+        self.entity_rows: Dict[int, Tuple[Archetype, int]] = {}
+        self._query_cache: Dict[FrozenSet[type], List[Archetype]] = {}
+
+    def add(self, entity):
+        component_types = frozenset(entity.components)
+        archetype = self.archetypes.get(component_types)
+        if archetype is None:
+            archetype = Archetype(component_types)
+            self.archetypes[component_types] = archetype
+            # A new archetype can match any of the queries already made
+            self._query_cache = {}
+        row = archetype.append(entity)
+        self.entity_rows[entity.id] = (archetype, row)
+
+    def remove(self, entity):
+        archetype, row = self.entity_rows.pop(entity.id)
+        moved_entity = archetype.swap_remove(row)
+        if moved_entity is not None:
+            self.entity_rows[moved_entity.id] = (archetype, row)
+
+    def move(self, entity):
+        """
+        To be called when the components of an already stored entity changed
+        """
+        self.remove(entity)
+        self.add(entity)
+
+    def matching_archetypes(self, *component_types: type) -> List[Archetype]:
+        key = frozenset(component_types)
+        archetypes = self._query_cache.get(key)
+        if archetypes is None:
+            archetypes = [
+                archetype
+                for archetype_types, archetype in self.archetypes.items()
+                if key <= archetype_types
+            ]
+            self._query_cache[key] = archetypes
+        return archetypes
+
+    def query(self, *component_types: type) -> Iterator[Tuple]:
+        """
+        Yields (entity, component_1, component_2, ...) for every entity having at
+        least all the requested component types, components being in the requested
+        order. Entities must not be added or removed while iterating.
+        """
+        for archetype in self.matching_archetypes(*component_types):
+            yield from zip(
+                archetype.entities,
+                *(
+                    archetype.columns[component_type]
+                    for component_type in component_types
+                ),
+            )
+
+    def count(self, *component_types: type) -> int:
+        return sum(
+            len(archetype) for archetype in self.matching_archetypes(*component_types)
+        )
@@ -1,29 +1,317 @@
 #!/usr/bin/env python3
 
-from dataclasses import dataclass
+from dataclasses import FrozenInstanceError, dataclass, fields
 from abc import ABC
+from enum import Enum
+from types import MappingProxyType
+from typing import Any, Callable, ClassVar, Dict, List, Tuple
 
 
 from dataclasses_jsonschema import JsonSchemaMixin
 
 
+class DerivedStat(property):
+    """
+    Property of a component computed once and cached in the component, until one
+    of the fields it depends on is set or invalidate_stats is called. Fields are
+    tracked when they are set, containers must be replaced, not changed in place.
+    The cached value is shared by the callers, it must not be changed.
+    """
+
+    def __init__(self, compute: Callable, dependencies: Tuple[str, ...]):
+        self.cache_key = f"_stat_{compute.__name__}"
+        self.dependencies = dependencies
+        cache_key = self.cache_key
+
+        def get(component):
+            attributes = component.__dict__
+            try:
+                return attributes[cache_key]
+            except KeyError:
+                value = attributes[cache_key] = compute(component)
+                return value
+
+        super().__init__(get, doc=compute.__doc__)
+
+
+def derived_stat(*dependencies: str) -> Callable[[Callable], DerivedStat]:
+    """
+    Decorator of the derived stats of a component, given the names of the fields
+    of the component they depend on
+    """
+
+    def decorator(compute: Callable) -> DerivedStat:
+        return DerivedStat(compute, dependencies)
+
+    return decorator
+
+
+class cached_attribute:
+    """
+    Attribute computed on its first read and stored in the instance, as
+    functools.cached_property does from Python 3.8
+    """
+
+    def __init__(self, compute: Callable):
+        self.compute = compute
+        self.name = compute.__name__
+        self.__doc__ = compute.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        # Set in __dict__ directly, so that it works on frozen dataclasses too
+        value = instance.__dict__[self.name] = self.compute(instance)
+        return value
+
+
+def type_origin(field_type) -> Any:
+    """
+    Unsubscripted type of a generic type, like typing.get_origin from Python 3.8:
+    dict for Dict[str, int], None for the types which are not generic
+    """
+    return getattr(field_type, "__origin__", None)
+
+
+def type_args(field_type) -> Tuple:
+    """
+    Types a generic type is subscripted with, like typing.get_args from Python 3.8
+    """
+    if getattr(field_type, "_special", False):
+        return ()
+    return getattr(field_type, "__args__", ())
+
+
 @dataclass
 class Component(ABC, JsonSchemaMixin):
+    # Index of the entity catalog, set when it is created
+    entities_index: ClassVar = None
+    # Cache keys of the derived stats depending on each field, see derived_stat
+    dependent_stats: ClassVar[Dict[str, Tuple[str, ...]]] = {}
+    derived_stats: ClassVar[Tuple[str, ...]] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        stats = {
+            name: attr
+            for base in reversed(cls.__mro__)
+            for name, attr in vars(base).items()
+            if isinstance(attr, DerivedStat)
+        }
+        cls.derived_stats = tuple(stat.cache_key for stat in stats.values())
+        dependent_stats = {}
+        for stat in stats.values():
+            for field_name in stat.dependencies:
+                dependent_stats.setdefault(field_name, []).append(stat.cache_key)
+        cls.dependent_stats = {
+            field_name: tuple(cache_keys)
+            for field_name, cache_keys in dependent_stats.items()
+        }
+        if cls.__setattr__ in (Component.__setattr__, object.__setattr__):
+            # Fields of components without derived stats are set directly
+            cls.__setattr__ = (
+                Component.__setattr__ if cls.dependent_stats else object.__setattr__
+            )
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        for cache_key in self.dependent_stats.get(name, ()):
+            self.__dict__.pop(cache_key, None)
+
     @property
     def entity(self):
-        # HACK
-        from game_backend.ecs.entity import EntityCatalog
+        return self.entities_index[self._entity_id]
 
-        return EntityCatalog.entities_index[self._entity_id]
+    def invalidate_stats(self):
+        """
+        To be called when something a derived stat depends on changed outside of
+        the fields of the component
+        """
+        attributes = self.__dict__
+        for cache_key in self.derived_stats:
+            attributes.pop(cache_key, None)
 
     def serialise(self):
-        initial_dict = self.to_dict()
+        return component_serialiser(type(self)).serialise(self)
+
+
+@dataclass
+class SharedComponent(Component):
+    """
+    Component of static data: a single instance is shared by all the entities of a
+    kind, so it is not attached to any of them, and cannot be changed: it behaves
+    as a frozen dataclass, which it cannot be as components are not frozen.
+    """
+
+    def __post_init__(self):
+        freeze_containers(self)
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__ or name not in self.__dataclass_fields__:
+            raise FrozenInstanceError(f"cannot assign to field {name!r}")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field {name!r}")
+
+    @property
+    def entity(self):
+        raise AttributeError(f"{type(self).__name__} is shared between entities")
+
+
+class Definition(JsonSchemaMixin):
+    """
+    Static fields of a component, shared by all the entities of a kind. Components
+    hold their definition in a field and read its fields with definition_field.
+    Definitions are serialised inline, as if their fields were fields of the
+    component.
+    Definitions are frozen dataclasses, their subclasses defining __post_init__
+    must call this one.
+    """
+
+    def __post_init__(self):
+        freeze_containers(self)
+
+
+def freeze_containers(instance):
+    """
+    Replaces the dict fields of shared static data by read-only copies, and its
+    list fields by tuples
+    """
+    attributes = instance.__dict__
+    for instance_field in fields(instance):
+        value = attributes.get(instance_field.name)
+        if type(value) is dict:
+            attributes[instance_field.name] = MappingProxyType(dict(value))
+        elif type(value) is list:
+            attributes[instance_field.name] = tuple(value)
+
+
+class DefinitionField(property):
+    pass
+
+
+def definition_field(name: str) -> DefinitionField:
+    """
+    Read-only property of a component, giving a field of its definition
+    """
+
+    def get(component):
+        return getattr(component.definition, name)
+
+    return DefinitionField(get)
+
+
+class ComponentSerialiser:
+    """
+    Serialiser of a component class, giving the same output as to_dict() followed by
+    the properties of the class, with the fields of definitions inlined. The fields,
+    their encoders and the properties are resolved once, when the serialiser is
+    created.
+    """
+
+    def __init__(self, component_class: type):
+        # The encoder of a definition gives the serialised fields to inline
+        self.fields: List[Tuple[str, str, Callable, bool]] = []
+        for json_field in component_class._get_fields():
+            field_type = json_field.field.type
+            if isinstance(field_type, type) and issubclass(field_type, Definition):
+                encoder = component_serialiser(field_type).serialise
+                inline = True
+            else:
+                encoder = compile_field_encoder(component_class, field_type)
+                inline = False
+            self.fields.append(
+                (json_field.field.name, json_field.mapped_name, encoder, inline)
+            )
+        self.properties: List[str] = [
+            attr_name
+            for attr_name, attr in component_class.__dict__.items()
+            if attr_name != "entity"
+            and isinstance(attr, property)
+            and not isinstance(attr, DefinitionField)
+        ]
+        # Discriminated classes are left to to_dict()
+        self.use_to_dict = (
+            getattr(component_class, "_JsonSchemaMixin__discriminator_name", None)
+            is not None
+        )
+
+    def serialise(self, component: Component) -> Dict:
+        if self.use_to_dict:
+            serialised = component.to_dict()
+        else:
+            serialised = {}
+            attributes = component.__dict__
+            for field_name, mapped_name, encoder, inline in self.fields:
+                value = attributes[field_name]
+                if value is None:
+                    continue
+                if inline:
+                    serialised.update(encoder(value))
+                    continue
+                if encoder is not None:
+                    value = encoder(value)
+                serialised[mapped_name] = value
+
+        for property_name in self.properties:
+            serialised[property_name] = getattr(component, property_name)
+        return serialised
+
+
+_component_serialisers: Dict[type, ComponentSerialiser] = {}
+
+
+def component_serialiser(component_class: type) -> ComponentSerialiser:
+    serialiser = _component_serialisers.get(component_class)
+    if serialiser is None:
+        serialiser = ComponentSerialiser(component_class)
+        _component_serialisers[component_class] = serialiser
+    return serialiser
+
+
+def compile_field_encoder(component_class: type, field_type: Any) -> Callable:
+    """
+    Returns the function encoding the values of a field like to_dict() does, or None
+    if values are left as they are.
+    Only the enums, primitive types and dicts of those are compiled, the other types
+    are encoded by JsonSchemaMixin.
+    """
+    if field_type not in component_class._field_encoders:
+        if isinstance(field_type, type) and issubclass(field_type, Enum):
+            return enum_values(field_type).__getitem__
+
+        if isinstance(field_type, type) and (
+            field_type in (int, float, bool) or issubclass(field_type, str)
+        ):
+            return None
+
+        if type_origin(field_type) is dict:
+            key_type, value_type = type_args(field_type)
+            key_encoder = compile_field_encoder(component_class, key_type)
+            value_encoder = compile_field_encoder(component_class, value_type)
+            if key_encoder is None and value_encoder is None:
+                return dict
+            if (
+                value_encoder is None
+                and isinstance(key_type, type)
+                and issubclass(key_type, Enum)
+            ):
+                values = enum_values(key_type)
+
+                def encode_enum_keys(value: Dict) -> Dict:
+                    return {values[key]: element for key, element in value.items()}
+
+                return encode_enum_keys
+
+    def encode(value):
+        return component_class._encode_field(field_type, value, True)
+
+    return encode
 
-        additional_properties = {}
-        for attr_name, attr in self.__class__.__dict__.items():
-            if attr_name == "entity":
-                continue
-            if isinstance(attr, property):
-                additional_properties[attr_name] = getattr(self, attr_name)
 
-        return {**initial_dict, **additional_properties}
+def enum_values(enum_class: type) -> Dict[Enum, Any]:
+    """
+    Accessing .value is slow, values of the members are looked up in a dict instead
+    """
+    return {member: member.value for member in enum_class}
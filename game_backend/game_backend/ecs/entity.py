@@ -1,36 +1,51 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from abc import ABC
-from uuid import uuid4
-from typing import Dict
+from typing import Dict, Iterable, Iterator, List, Tuple
+import json
+import typing
 
-from game_backend.ecs.component import Component
+from game_backend.ecs.component import (
+    Component,
+    SharedComponent,
+    type_args,
+    type_origin,
+)
+from game_backend.ecs.archetype import ComponentStore
+from game_backend.ecs.entity_index import EntityIndex, external_id
 
 
-# TODO: garbage collection
 @dataclass
 class Entity(ABC):
     components: Dict[type, Component] = field(default_factory=dict)
-    id: str = None
-    _parent_id: str = None
+    id: int = None
+    _parent_id: int = None
 
     def __post_init__(self):
         if self.id is None:
-            self.id = str(uuid4())
+            self.id = EntityCatalog.entities_index.new_id()
         for component_type, component in self.components.items():
-            component._entity_id = self.id
+            if not isinstance(component, SharedComponent):
+                component._entity_id = self.id
         # We set the parent id of all children
+        for child in self.children():
+            child._parent_id = self.id
+        EntityCatalog.register(self)
+
+    def children(self) -> Iterator["Entity"]:
+        """
+        Child entities, held by an attribute or by a list, set or dict attribute
+        """
         for attr in self.__dict__.values():
             if isinstance(attr, Entity):
-                attr._parent_id = self.id
+                yield attr
             elif isinstance(attr, list) or isinstance(attr, set):
                 for element in attr:
                     if isinstance(element, Entity):
-                        element._parent_id = self.id
+                        yield element
             elif isinstance(attr, dict):
                 for element in attr.values():
                     if isinstance(element, Entity):
-                        element._parent_id = self.id
-        EntityCatalog.register(self)
+                        yield element
 
     @property
     def parent(self):
@@ -44,72 +59,367 @@ class Entity(ABC):
 
     def add_component(self, component: Component) -> "Entity":
         component_type = type(component)
-        component._entity_id = self.id
+        if not isinstance(component, SharedComponent):
+            component._entity_id = self.id
         assert (
             component_type not in self.components
         ), f"Entity already has a component of type {component_type}"
         self.components[component_type] = component
+        if self.id in EntityCatalog.entities_index:
+            EntityCatalog.component_store.move(self)
         return self
 
     def serialise(self) -> Dict:
+        return entity_serialiser(type(self)).serialise(self)
+
+    def iter_json(self, depth: int = 0) -> Iterator[str]:
+        """
+        Yields the JSON of the entity in chunks, see EntitySerialiser.iter_json
+        """
+        return entity_serialiser(type(self)).iter_json(self, depth)
+
+    def deserialise(self, entity_dict: Dict):
+        pass
+
+    def destruct(self):
+        """
+        Deregisters the entity and all its descendants. The entity must be removed
+        from its parent, and from the systems holding it, by the caller.
+        """
+        for child in self.children():
+            child.destruct()
+        EntityCatalog.deregister(self)
+
+
+# Kinds of entity attributes
+CHILD = "child"
+CHILD_LIST = "child_list"
+CHILD_DICT = "child_dict"
+ATTRIBUTE = "attribute"
+ENTITY_ID = "entity_id"
+OTHER = "other"
+
+ENTITY_ID_FIELDS = ("id", "_parent_id")
+
+
+class EntitySerialiser:
+    """
+    Serialiser of an entity class. The kind of each field (child entity, list or
+    dict of children, or plain attribute) is resolved once from the dataclass field
+    types, only the kind of the container being checked when serialising.
+    The output is: components, then children, then the other attributes, ids being
+    given as external ids.
+    """
+
+    def __init__(self, entity_class: type):
+        type_hints = typing.get_type_hints(entity_class)
+        self.fields: List[Tuple[str, str]] = [
+            (
+                entity_field.name,
+                ENTITY_ID
+                if entity_field.name in ENTITY_ID_FIELDS
+                else field_kind(type_hints[entity_field.name]),
+            )
+            for entity_field in fields(entity_class)
+            if entity_field.name != "components"
+        ]
+
+    def serialise(self, entity: Entity, serialise_child=None) -> Dict:
+        """
+        serialise_child is applied to the child entities, they are serialised by
+        default
+        """
+        if serialise_child is None:
+            serialise_child = Entity.serialise
         components_dict = {}
-        for component_type, component in self.components.items():
+        for component_type, component in entity.components.items():
             components_dict[component_type.__name__] = component.serialise()
         entity_children = {}
         other_attributes = {}
-        for attr_name, attr in self.__dict__.items():
-            if isinstance(attr, Entity):
-                entity_children[attr_name] = attr.serialise()
-            elif isinstance(attr, list):
-                entity_list = []
-                for element in attr:
-                    if isinstance(element, Entity):
-                        entity_list.append(element.serialise())
-                entity_children[attr_name] = entity_list
-            elif isinstance(attr, set):
-                entity_set = set()
-                for element in attr:
-                    if isinstance(element, Entity):
-                        entity_set.add(element.serialise())
-                entity_children[attr_name] = entity_set
-            elif isinstance(attr, dict):
-                if attr_name == "components":
-                    continue
-                entity_dict = {}
-                for k, element in attr.items():
-                    if isinstance(element, Entity):
-                        entity_dict[k] = element.serialise()
-                entity_children[attr_name] = entity_dict
-            else:
+        attributes = entity.__dict__
+        for attr_name, kind in self.fields:
+            attr = attributes[attr_name]
+            if kind == CHILD and isinstance(attr, Entity):
+                entity_children[attr_name] = serialise_child(attr)
+            elif kind == CHILD_LIST and type(attr) is list:
+                entity_children[attr_name] = [
+                    serialise_child(element) for element in attr
+                ]
+            elif kind == CHILD_DICT and type(attr) is dict:
+                entity_children[attr_name] = {
+                    k: serialise_child(element) for k, element in attr.items()
+                }
+            elif kind == ATTRIBUTE and not isinstance(attr, (Entity, list, set, dict)):
                 other_attributes[attr_name] = attr
+            elif kind == ENTITY_ID:
+                other_attributes[attr_name] = external_id(attr)
+            else:
+                serialise_attribute(
+                    attr_name, attr, entity_children, other_attributes, serialise_child
+                )
         return dict(components=components_dict, **entity_children, **other_attributes)
 
-    def deserialise(self, entity_dict: Dict):
-        pass
+    def iter_json(self, entity: Entity, depth: int = 0) -> Iterator[str]:
+        """
+        Yields the same JSON as json.dumps(entity.serialise()), in chunks, so that
+        the whole entity tree never has to be held in memory at once.
+        The children of the entity are encoded one by one, and so are the children
+        of the children, down to the given depth.
+        """
+        serialised = self.serialise(entity, serialise_child=_keep_child)
+        separator = "{"
+        for key, value in serialised.items():
+            yield separator + json_key(key) + ": "
+            separator = ", "
+            if isinstance(value, Entity):
+                yield from iter_child_json(value, depth)
+            elif isinstance(value, list):
+                yield "["
+                for i, element in enumerate(value):
+                    if i:
+                        yield ", "
+                    yield from iter_child_json(element, depth)
+                yield "]"
+            elif isinstance(value, dict) and key != "components":
+                yield "{"
+                for i, (element_key, element) in enumerate(value.items()):
+                    yield (", " if i else "") + json_key(element_key) + ": "
+                    yield from iter_child_json(element, depth)
+                yield "}"
+            else:
+                yield json.dumps(value)
+        yield "}" if separator == ", " else "{}"
+
+
+_entity_serialisers: Dict[type, EntitySerialiser] = {}
+
+
+def entity_serialiser(entity_class: type) -> EntitySerialiser:
+    serialiser = _entity_serialisers.get(entity_class)
+    if serialiser is None:
+        serialiser = EntitySerialiser(entity_class)
+        _entity_serialisers[entity_class] = serialiser
+    return serialiser
+
+
+def _keep_child(entity: Entity) -> Entity:
+    return entity
 
-    def destruct(self):
-        EntityCatalog.deregister(self)
-        for component in self.components.values():
-            del component
+
+def iter_child_json(entity: Entity, depth: int) -> Iterator[str]:
+    if depth > 0:
+        yield from entity.iter_json(depth - 1)
+    else:
+        yield json.dumps(entity.serialise())
+
+
+def json_key(key) -> str:
+    """
+    Encodes a dict key like json.dumps does
+    """
+    if not isinstance(key, str):
+        key = json.dumps(key)
+    return json.dumps(key)
+
+
+def field_kind(field_type) -> str:
+    if isinstance(field_type, type) and issubclass(field_type, Entity):
+        return CHILD
+    element_types = type_args(field_type)
+    element_type = element_types[-1] if element_types else None
+    if isinstance(element_type, type) and issubclass(element_type, Entity):
+        if type_origin(field_type) is list:
+            return CHILD_LIST
+        if type_origin(field_type) is dict:
+            return CHILD_DICT
+    if type_origin(field_type) is None and not (
+        isinstance(field_type, type)
+        and issubclass(field_type, (Entity, list, set, dict))
+    ):
+        return ATTRIBUTE
+    return OTHER
+
+
+def serialise_attribute(
+    attr_name: str,
+    attr,
+    entity_children: Dict,
+    other_attributes: Dict,
+    serialise_child=Entity.serialise,
+):
+    """
+    Serialises an entity attribute whatever its kind, only entities being kept in
+    containers
+    """
+    if isinstance(attr, Entity):
+        entity_children[attr_name] = serialise_child(attr)
+    elif isinstance(attr, list):
+        entity_list = []
+        for element in attr:
+            if isinstance(element, Entity):
+                entity_list.append(serialise_child(element))
+        entity_children[attr_name] = entity_list
+    elif isinstance(attr, set):
+        entity_set = set()
+        for element in attr:
+            if isinstance(element, Entity):
+                entity_set.add(element.serialise())
+        entity_children[attr_name] = entity_set
+    elif isinstance(attr, dict):
+        entity_dict = {}
+        for k, element in attr.items():
+            if isinstance(element, Entity):
+                entity_dict[k] = serialise_child(element)
+        entity_children[attr_name] = entity_dict
+    else:
+        other_attributes[attr_name] = attr
+
+
+@dataclass
+class CatalogAudit:
+    """
+    Entities found by EntityCatalog.audit, as lists of ids by entity class name
+    """
+
+    # Registered, but not held by the entity trees anymore
+    leaked: Dict[str, List[int]] = field(default_factory=dict)
+    # Leaked entities whose parent was destructed
+    orphaned: Dict[str, List[int]] = field(default_factory=dict)
+    # Held by the entity trees, but not registered anymore
+    dangling: Dict[str, List[int]] = field(default_factory=dict)
+
+    @property
+    def clean(self) -> bool:
+        return not (self.leaked or self.dangling)
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "leaked": {name: len(ids) for name, ids in self.leaked.items()},
+            "orphaned": {name: len(ids) for name, ids in self.orphaned.items()},
+            "dangling": {name: len(ids) for name, ids in self.dangling.items()},
+        }
+
+
+def ids_by_class(entities: Iterable[Entity]) -> Dict[str, List[int]]:
+    ids = {}
+    for entity in entities:
+        ids.setdefault(type(entity).__name__, []).append(entity.id)
+    return ids
 
 
 class EntityCatalog:
     def __init__(self):
-        self.entities_index = {}
+        self.entities_index = EntityIndex()
+        Component.entities_index = self.entities_index
         self.special_index = {}
+        self.component_store = ComponentStore()
+        # Version of each entity: the value of the global version counter when the
+        # entity or one of its descendants last changed
+        self.version = 0
+        self.versions: Dict[int, int] = {}
+        # Version at which each entity was last touched itself, the changes it stands
+        # for may be in its descendants as well
+        self.touched: Dict[int, int] = {}
+
+    def reset(self):
+        """
+        Forgets all the entities, before a whole game state is restored
+        """
+        self.__init__()
 
     def get_special(self, key: str):
         return self.special_index.get(key)
 
-    def register(self, entity: Entity):
+    def query(self, *component_types: type):
+        """
+        Iterates over (entity, component_1, ...) for all the registered entities
+        having all the given component types
+        """
+        return self.component_store.query(*component_types)
+
+    def touch(self, *entities: Entity):
+        """
+        To be called by the systems when they change entities: bumps the version of
+        the entities and of their ancestors
+        """
+        self.version += 1
+        version = self.version
+        versions = self.versions
+        for entity in entities:
+            entity_id = entity.id
+            self.touched[entity_id] = version
+            # Ancestors shared with a previous entity are already up to date
+            while entity_id is not None and versions.get(entity_id) != version:
+                versions[entity_id] = version
+                entity = self.entities_index.get(entity_id)
+                entity_id = None if entity is None else entity._parent_id
+
+    def changed_since(self, entity: Entity, version: int) -> bool:
+        return self.versions.get(entity.id, 0) > version
+
+    def register(self, entity: Entity, version: int = None):
+        """
+        New entities get a new version, unless one is given.
+        Entities restored with the id of a registered entity replace it, and so do
+        the ones restored with the slot of a registered entity.
+        """
+        previous = self.entities_index.slot_entity(entity.id)
+        if previous is not None:
+            self.deregister(previous)
         self.entities_index[entity.id] = entity
+        if version is None:
+            self.version += 1
+            version = self.version
+        self.versions[entity.id] = version
+        self.component_store.add(entity)
         if entity.catalog_key is not None:
             self.special_index[entity.catalog_key] = entity
 
     def deregister(self, entity: Entity):
         del self.entities_index[entity.id]
-        if entity.catalog_key is not None:
+        self.versions.pop(entity.id, None)
+        self.touched.pop(entity.id, None)
+        self.component_store.remove(entity)
+        if self.special_index.get(entity.catalog_key) is entity:
             del self.special_index[entity.catalog_key]
 
+    def audit(self, roots: Iterable[Entity] = None) -> CatalogAudit:
+        """
+        Walks the entity trees from the roots, the entities of the special index by
+        default, and reports the registered entities they do not hold anymore, and
+        the entities they hold which are not registered.
+        This walks all the entities, it is meant for debugging and monitoring.
+        """
+        if roots is None:
+            roots = self.special_index.values()
+        reached = set()
+        dangling = []
+        stack = list(roots)
+        while stack:
+            entity = stack.pop()
+            if entity.id in reached:
+                continue
+            reached.add(entity.id)
+            if self.entities_index.get(entity.id) is not entity:
+                dangling.append(entity)
+            stack.extend(entity.children())
+
+        leaked = [
+            entity
+            for entity_id, entity in self.entities_index.items()
+            if entity_id not in reached
+        ]
+        orphaned = [
+            entity
+            for entity in leaked
+            if entity._parent_id is not None
+            and entity._parent_id not in self.entities_index
+        ]
+        return CatalogAudit(
+            leaked=ids_by_class(leaked),
+            orphaned=ids_by_class(orphaned),
+            dangling=ids_by_class(dangling),
+        )
+
 
 EntityCatalog = EntityCatalog()
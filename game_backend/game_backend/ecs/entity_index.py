@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+from typing import Iterator, List, Tuple
+
+# Entity ids are made of a slot in their low bits, and of a generation above
+SLOT_BITS = 32
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+
+class EntityIndex:
+    """
+    Entities by id, found in O(1) by the slot of their id in a list.
+    Slots are reused by new entities once their entities are deregistered, with the
+    next generation, so that the id of a deregistered entity is never given again
+    and is not found anymore.
+    Behaves as a dict of the registered entities by id.
+    """
+
+    def __init__(self):
+        self.entities: List = []
+        # Generation of the next id of each slot
+        self.generations: List[int] = []
+        # May hold slots taken since they were freed, they are skipped
+        self.free_slots: List[int] = []
+        self.n_entities = 0
+
+    def new_id(self) -> int:
+        entities = self.entities
+        while self.free_slots:
+            slot = self.free_slots.pop()
+            if entities[slot] is None:
+                return self.generations[slot] << SLOT_BITS | slot
+        slot = len(entities)
+        entities.append(None)
+        self.generations.append(0)
+        return slot
+
+    def get(self, entity_id: int, default=None):
+        slot = entity_id & SLOT_MASK
+        if slot < len(self.entities):
+            entity = self.entities[slot]
+            if entity is not None and entity.id == entity_id:
+                return entity
+        return default
+
+    def slot_entity(self, entity_id: int):
+        """
+        Returns the entity in the slot of the id, whatever its generation
+        """
+        slot = entity_id & SLOT_MASK
+        if slot < len(self.entities):
+            return self.entities[slot]
+
+    def __getitem__(self, entity_id: int):
+        try:
+            entity = self.entities[entity_id & SLOT_MASK]
+        except IndexError:
+            raise KeyError(entity_id)
+        if entity is None or entity.id != entity_id:
+            raise KeyError(entity_id)
+        return entity
+
+    def __contains__(self, entity_id: int) -> bool:
+        return self.get(entity_id) is not None
+
+    def __setitem__(self, entity_id: int, entity):
+        """
+        The slot must be free, or hold the entity being replaced
+        """
+        slot = entity_id & SLOT_MASK
+        if slot >= len(self.entities):
+            # Id given by another index, restored from a snapshot
+            self.grow(slot + 1)
+        previous = self.entities[slot]
+        assert (
+            previous is None or previous.id == entity_id
+        ), f"Slot of entity {entity_id} is taken by entity {previous.id}"
+        if previous is None:
+            self.n_entities += 1
+        self.entities[slot] = entity
+        self.generations[slot] = max(self.generations[slot], entity_id >> SLOT_BITS)
+
+    def __delitem__(self, entity_id: int):
+        if self.get(entity_id) is None:
+            raise KeyError(entity_id)
+        slot = entity_id & SLOT_MASK
+        self.entities[slot] = None
+        self.generations[slot] = max(self.generations[slot], entity_id >> SLOT_BITS) + 1
+        self.free_slots.append(slot)
+        self.n_entities -= 1
+
+    def restore_generations(self, generations: List[int]):
+        """
+        Raises the generations of the slots to the given ones, so that the ids given
+        before they were saved are not given again
+        """
+        self.grow(len(generations))
+        self.generations[: len(generations)] = map(
+            max, self.generations[: len(generations)], generations
+        )
+
+    def grow(self, n_slots: int):
+        """
+        Adds free slots up to n_slots, taken after the slots freed before
+        """
+        previous_n_slots = len(self.entities)
+        if n_slots <= previous_n_slots:
+            return
+        self.free_slots[:0] = range(n_slots - 1, previous_n_slots - 1, -1)
+        self.entities.extend([None] * (n_slots - previous_n_slots))
+        self.generations.extend([0] * (n_slots - previous_n_slots))
+
+    def __len__(self) -> int:
+        return self.n_entities
+
+    def __iter__(self) -> Iterator[int]:
+        return (entity.id for entity in self.values())
+
+    def values(self) -> Iterator:
+        return (entity for entity in self.entities if entity is not None)
+
+    def items(self) -> Iterator[Tuple[int, object]]:
+        return ((entity.id, entity) for entity in self.values())
+
+
+def external_id(entity_id: int) -> str:
+    """
+    Id of an entity in the JSON of the API: ids are opaque strings for the clients
+    """
+    if entity_id is None:
+        return None
+    return str(entity_id)
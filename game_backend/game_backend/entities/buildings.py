@@ -5,6 +5,7 @@ from typing import Dict
 from game_backend.ecs.entity import Entity
 from game_backend.components import (
     BuildingComponent,
+    BuildingDefinition,
     ProducerComponent,
     StorageComponent,
     CombatComponent,
@@ -29,18 +30,114 @@ class Building(Entity):
         )
 
 
+# Static data of the buildings, shared by all the planets
+METAL_MINE = BuildingDefinition(
+    name="Metal Mine",
+    base_cost={Resources.Metal: 60, Resources.Cristal: 15},
+    upgrade_cost_factor=1.5,
+    upgrade_prod_factor=1.1,
+)
+METAL_MINE_PRODUCER = ProducerComponent(
+    production_rate={Resources.Metal: 30 / 3600}, energy_consumption=10
+)
+
+CRISTAL_MINE = BuildingDefinition(
+    name="Cristal Mine",
+    base_cost={Resources.Metal: 48, Resources.Cristal: 24},
+    upgrade_cost_factor=1.6,
+    upgrade_prod_factor=1.1,
+)
+CRISTAL_MINE_PRODUCER = ProducerComponent(
+    production_rate={Resources.Cristal: 20 / 3600}, energy_consumption=10
+)
+
+DEUTERIUM_SYNTHESIZER = BuildingDefinition(
+    name="Deuterium Synthesizer",
+    base_cost={Resources.Metal: 225, Resources.Cristal: 75},
+    upgrade_cost_factor=1.5,
+    upgrade_prod_factor=1.1,
+)
+DEUTERIUM_SYNTHESIZER_PRODUCER = ProducerComponent(
+    production_rate={Resources.Deuterium: 10 / 3600}, energy_consumption=20
+)
+
+SOLAR_PLANT = BuildingDefinition(
+    name="Solar Plant",
+    base_cost={Resources.Metal: 75, Resources.Cristal: 30},
+    upgrade_cost_factor=1.5,
+    upgrade_prod_factor=1.1,
+)
+SOLAR_PLANT_PRODUCER = ProducerComponent(
+    production_rate={}, energy_consumption=0, energy_production=20
+)
+
+METAL_HANGAR = BuildingDefinition(
+    name="Metal Hangar", base_cost={Resources.Metal: 1000}, upgrade_cost_factor=2.0,
+)
+METAL_HANGAR_STORAGE = StorageComponent(resources_storage={Resources.Metal: 10000})
+
+CRISTAL_HANGAR = BuildingDefinition(
+    name="Cristal Hangar",
+    base_cost={Resources.Metal: 500, Resources.Cristal: 250},
+    upgrade_cost_factor=2.0,
+)
+CRISTAL_HANGAR_STORAGE = StorageComponent(resources_storage={Resources.Cristal: 10000})
+
+DEUTERIUM_TANK = BuildingDefinition(
+    name="Deuterium Tank",
+    base_cost={Resources.Metal: 1000, Resources.Cristal: 1000},
+    upgrade_cost_factor=2,
+)
+DEUTERIUM_TANK_STORAGE = StorageComponent(
+    resources_storage={Resources.Deuterium: 10000}
+)
+
+SHIPYARD = BuildingDefinition(
+    name="Shipyard",
+    base_cost={Resources.Metal: 400, Resources.Cristal: 200, Resources.Deuterium: 100},
+    upgrade_cost_factor=2.0,
+)
+
+RESEARCH_LAB = BuildingDefinition(
+    name="Research Lab",
+    base_cost={Resources.Metal: 200, Resources.Cristal: 400, Resources.Deuterium: 200},
+    upgrade_cost_factor=2.0,
+)
+
+MISSILE_TURRET = BuildingDefinition(
+    name="Missile Turret", base_cost={Resources.Metal: 2000}, upgrade_cost_factor=1.0,
+)
+MISSILE_TURRET_COMBAT = CombatComponent(hp=3800, shield=34, damage=152)
+MISSILE_TURRET_REQUIREMENTS = RequirementsComponent(
+    building={"shipyard": 1}, research={}
+)
+
+LASER_TURRET = BuildingDefinition(
+    name="Laser Turret",
+    base_cost={Resources.Metal: 1500, Resources.Cristal: 500},
+    upgrade_cost_factor=1.0,
+)
+LASER_TURRET_COMBAT = CombatComponent(hp=3800, shield=42, damage=190)
+LASER_TURRET_REQUIREMENTS = RequirementsComponent(
+    building={"shipyard": 2}, research={"laser": 3}
+)
+
+HEAVY_LASER = BuildingDefinition(
+    name="Heavy Laser",
+    base_cost={Resources.Metal: 6000, Resources.Cristal: 2000},
+    upgrade_cost_factor=1.0,
+)
+HEAVY_LASER_COMBAT = CombatComponent(hp=15200, shield=170, damage=475)
+HEAVY_LASER_REQUIREMENTS = RequirementsComponent(
+    building={"shipyard": 4}, research={"energy": 3, "laser": 6}
+)
+
+
 def MetalMine() -> Building:
     return Building(
         components={
-            ProducerComponent: ProducerComponent(
-                production_rate={Resources.Metal: 30 / 3600}, energy_consumption=10
-            ),
-            BuildingComponent: BuildingComponent(
-                name="Metal Mine",
-                base_cost={Resources.Metal: 60, Resources.Cristal: 15},
-                upgrade_cost_factor=1.5,
-                upgrade_prod_factor=1.1,
-            ),
+            ProducerComponent: METAL_MINE_PRODUCER,
+            BuildingComponent: BuildingComponent(METAL_MINE),
         }
     )
 
@@ -48,15 +145,8 @@ def MetalMine() -> Building:
 def CristalMine() -> Building:
     return Building(
         components={
-            ProducerComponent: ProducerComponent(
-                production_rate={Resources.Cristal: 20 / 3600}, energy_consumption=10
-            ),
-            BuildingComponent: BuildingComponent(
-                name="Cristal Mine",
-                base_cost={Resources.Metal: 48, Resources.Cristal: 24},
-                upgrade_cost_factor=1.6,
-                upgrade_prod_factor=1.1,
-            ),
+            ProducerComponent: CRISTAL_MINE_PRODUCER,
+            BuildingComponent: BuildingComponent(CRISTAL_MINE),
         }
     )
 
@@ -64,15 +154,8 @@ def CristalMine() -> Building:
 def DeuteriumSynthesizer() -> Building:
     return Building(
         components={
-            ProducerComponent: ProducerComponent(
-                production_rate={Resources.Deuterium: 10 / 3600}, energy_consumption=20
-            ),
-            BuildingComponent: BuildingComponent(
-                name="Deuterium Synthesizer",
-                base_cost={Resources.Metal: 225, Resources.Cristal: 75},
-                upgrade_cost_factor=1.5,
-                upgrade_prod_factor=1.1,
-            ),
+            ProducerComponent: DEUTERIUM_SYNTHESIZER_PRODUCER,
+            BuildingComponent: BuildingComponent(DEUTERIUM_SYNTHESIZER),
         }
     )
 
@@ -80,15 +163,8 @@ def DeuteriumSynthesizer() -> Building:
 def SolarPlant() -> Building:
     return Building(
         components={
-            ProducerComponent: ProducerComponent(
-                production_rate={}, energy_consumption=0, energy_production=20
-            ),
-            BuildingComponent: BuildingComponent(
-                name="Solar Plant",
-                base_cost={Resources.Metal: 75, Resources.Cristal: 30},
-                upgrade_cost_factor=1.5,
-                upgrade_prod_factor=1.1,
-            ),
+            ProducerComponent: SOLAR_PLANT_PRODUCER,
+            BuildingComponent: BuildingComponent(SOLAR_PLANT),
         }
     )
 
@@ -96,14 +172,8 @@ def SolarPlant() -> Building:
 def MetalHangar() -> Building:
     return Building(
         components={
-            BuildingComponent: BuildingComponent(
-                name="Metal Hangar",
-                base_cost={Resources.Metal: 1000},
-                upgrade_cost_factor=2.0,
-            ),
-            StorageComponent: StorageComponent(
-                resources_storage={Resources.Metal: 10000}
-            ),
+            BuildingComponent: BuildingComponent(METAL_HANGAR),
+            StorageComponent: METAL_HANGAR_STORAGE,
         }
     )
 
@@ -111,14 +181,8 @@ def MetalHangar() -> Building:
 def CristalHangar() -> Building:
     return Building(
         components={
-            BuildingComponent: BuildingComponent(
-                name="Cristal Hangar",
-                base_cost={Resources.Metal: 500, Resources.Cristal: 250},
-                upgrade_cost_factor=2.0,
-            ),
-            StorageComponent: StorageComponent(
-                resources_storage={Resources.Cristal: 10000}
-            ),
+            BuildingComponent: BuildingComponent(CRISTAL_HANGAR),
+            StorageComponent: CRISTAL_HANGAR_STORAGE,
         }
     )
 
@@ -126,62 +190,26 @@ def CristalHangar() -> Building:
 def DeuteriumTank() -> Building:
     return Building(
         components={
-            BuildingComponent: BuildingComponent(
-                name="Deuterium Tank",
-                base_cost={Resources.Metal: 1000, Resources.Cristal: 1000},
-                upgrade_cost_factor=2,
-            ),
-            StorageComponent: StorageComponent(
-                resources_storage={Resources.Deuterium: 10000}
-            ),
+            BuildingComponent: BuildingComponent(DEUTERIUM_TANK),
+            StorageComponent: DEUTERIUM_TANK_STORAGE,
         }
     )
 
 
 def Shipyard() -> Building:
-    return Building(
-        components={
-            BuildingComponent: BuildingComponent(
-                name="Shipyard",
-                base_cost={
-                    Resources.Metal: 400,
-                    Resources.Cristal: 200,
-                    Resources.Deuterium: 100,
-                },
-                upgrade_cost_factor=2.0,
-            ),
-        }
-    )
+    return Building(components={BuildingComponent: BuildingComponent(SHIPYARD)})
 
 
 def ResearchLab() -> Building:
-    return Building(
-        components={
-            BuildingComponent: BuildingComponent(
-                name="Research Lab",
-                base_cost={
-                    Resources.Metal: 200,
-                    Resources.Cristal: 400,
-                    Resources.Deuterium: 200,
-                },
-                upgrade_cost_factor=2.0,
-            )
-        }
-    )
+    return Building(components={BuildingComponent: BuildingComponent(RESEARCH_LAB)})
 
 
 def MissileTurret() -> Building:
     return Building(
         components={
-            BuildingComponent: BuildingComponent(
-                name="Missile Turret",
-                base_cost={Resources.Metal: 2000},
-                upgrade_cost_factor=1.0,
-            ),
-            CombatComponent: CombatComponent(hp=3800, shield=34, damage=152,),
-            RequirementsComponent: RequirementsComponent(
-                building={"shipyard": 1}, research={}
-            ),
+            BuildingComponent: BuildingComponent(MISSILE_TURRET),
+            CombatComponent: MISSILE_TURRET_COMBAT,
+            RequirementsComponent: MISSILE_TURRET_REQUIREMENTS,
         }
     )
 
@@ -189,15 +217,9 @@ def MissileTurret() -> Building:
 def LaserTurret() -> Building:
     return Building(
         components={
-            BuildingComponent: BuildingComponent(
-                name="Laser Turret",
-                base_cost={Resources.Metal: 1500, Resources.Cristal: 500},
-                upgrade_cost_factor=1.0,
-            ),
-            CombatComponent: CombatComponent(hp=3800, shield=42, damage=190),
-            RequirementsComponent: RequirementsComponent(
-                building={"shipyard": 2}, research={"laser": 3}
-            ),
+            BuildingComponent: BuildingComponent(LASER_TURRET),
+            CombatComponent: LASER_TURRET_COMBAT,
+            RequirementsComponent: LASER_TURRET_REQUIREMENTS,
         }
     )
 
@@ -205,15 +227,9 @@ def LaserTurret() -> Building:
 def HeavyLaser() -> Building:
     return Building(
         components={
-            BuildingComponent: BuildingComponent(
-                name="Heavy Laser",
-                base_cost={Resources.Metal: 6000, Resources.Cristal: 2000},
-                upgrade_cost_factor=1.0,
-            ),
-            CombatComponent: CombatComponent(hp=15200, shield=170, damage=475),
-            RequirementsComponent: RequirementsComponent(
-                building={"shipyard": 4}, research={"energy": 3, "laser": 6}
-            ),
+            BuildingComponent: BuildingComponent(HEAVY_LASER),
+            CombatComponent: HEAVY_LASER_COMBAT,
+            RequirementsComponent: HEAVY_LASER_REQUIREMENTS,
         }
     )
 
@@ -1,7 +1,8 @@
 from dataclasses import dataclass, field
 from typing import List, Dict
 
-from game_backend.ecs.entity import Entity
+from game_backend.config import LAZY_ACCRUAL
+from game_backend.ecs.entity import Entity, EntityCatalog
 from game_backend.components import (
     PlanetComponent,
     PlayerComponent,
@@ -28,6 +29,7 @@ class Planet(Entity):
     ):
         # HACK
         from game_backend.systems.position_system import PositionSystem
+        from game_backend.systems.production_system import ProductionSystem
 
         planet = cls(
             components={
@@ -37,6 +39,7 @@ class Planet(Entity):
             },
         )
         PositionSystem.register_planet(planet_id, planet)
+        ProductionSystem.mark_dirty(planet)
         return planet
 
 
@@ -44,6 +47,17 @@ class Planet(Entity):
 class World(Entity):
     speed: int = 100
     planets: Dict[str, Planet] = field(default_factory=dict)
+    # Game time in seconds
+    time: float = 0.0
+    # When set, resources are not accumulated on every update but settled whenever
+    # they are read or spent, see ProductionSystem.settle
+    lazy_accrual: bool = LAZY_ACCRUAL
+
+    def add_planet(self, planet_id: PlanetLocation, planet: Planet):
+        planet._parent_id = self.id
+        planet.components[PlanetComponent]._last_settled = self.time
+        self.planets[planet_id] = planet
+        EntityCatalog.touch(planet)
 
 
 @dataclass
@@ -55,6 +69,23 @@ class Player(Entity):
     def new(cls, id: str, name: str):
         return cls(components={PlayerComponent: PlayerComponent(id=id, name=name)})
 
+    def add_fleet(self, fleet: Fleet):
+        fleet._parent_id = self.id
+        self.fleets.append(fleet)
+        EntityCatalog.touch(self)
+
+    def remove_fleet(self, fleet: Fleet):
+        """
+        Deletes the fleet and its ships
+        """
+        # HACK
+        from game_backend.systems.position_system import PositionSystem
+
+        self.fleets = [kept for kept in self.fleets if kept is not fleet]
+        PositionSystem.unstation_fleet(fleet)
+        fleet.destruct()
+        EntityCatalog.touch(self)
+
 
 @dataclass
 class GameState(Entity):
@@ -64,3 +95,8 @@ class GameState(Entity):
     @property
     def catalog_key(self):
         return "game_state"
+
+    def add_player(self, player: Player):
+        player._parent_id = self.id
+        self.players[player.components[PlayerComponent].id] = player
+        EntityCatalog.touch(player)
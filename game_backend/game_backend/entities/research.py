@@ -2,26 +2,62 @@ from dataclasses import dataclass, field
 from typing import Dict
 
 from game_backend.ecs.entity import Entity
-from game_backend.components import ResearchComponent, RequirementsComponent
+from game_backend.components import (
+    ResearchComponent,
+    ResearchDefinition,
+    RequirementsComponent,
+)
 from game_backend.resources import Resources
 
 
+# Static data of the research, shared by all the players
+ENERGY = ResearchDefinition(
+    name="Energy",
+    cost={Resources.Metal: 100, Resources.Cristal: 200, Resources.Deuterium: 50},
+    upgrade_cost_factor=2,
+)
+ENERGY_REQUIREMENTS = RequirementsComponent(building={"research_lab": 1}, research={})
+
+LASER = ResearchDefinition(
+    name="Laser",
+    cost={Resources.Metal: 20, Resources.Cristal: 40,},
+    upgrade_cost_factor=1.7,
+)
+LASER_REQUIREMENTS = RequirementsComponent(
+    building={"research_lab": 2}, research={"energy": 2}
+)
+
+COMBUSTION_DRIVE = ResearchDefinition(
+    name="Combustion Drive",
+    cost={Resources.Metal: 400, Resources.Deuterium: 600},
+    upgrade_cost_factor=2.0,
+)
+COMBUSTION_DRIVE_REQUIREMENTS = RequirementsComponent(
+    building={"research_lab": 1}, research={"energy": 1}
+)
+
+IMPULSE_DRIVE = ResearchDefinition(
+    name="Impulse Drive",
+    cost={Resources.Metal: 2000, Resources.Cristal: 4000, Resources.Deuterium: 600},
+    upgrade_cost_factor=2.0,
+)
+IMPULSE_DRIVE_REQUIREMENTS = RequirementsComponent(
+    building={"research_lab": 2}, research={"energy": 1}
+)
+
+ARMOUR_TECH = ResearchDefinition(
+    name="Armour Technology", cost={Resources.Metal: 1000}, upgrade_cost_factor=2.0,
+)
+ARMOUR_TECH_REQUIREMENTS = RequirementsComponent(
+    building={"research_lab": 2}, research={}
+)
+
+
 def EnergyResearch() -> Entity:
     return Entity(
         components={
-            ResearchComponent: ResearchComponent(
-                name="Energy",
-                level=0,
-                cost={
-                    Resources.Metal: 100,
-                    Resources.Cristal: 200,
-                    Resources.Deuterium: 50,
-                },
-                upgrade_cost_factor=2,
-            ),
-            RequirementsComponent: RequirementsComponent(
-                building={"research_lab": 1}, research={}
-            ),
+            ResearchComponent: ResearchComponent(ENERGY),
+            RequirementsComponent: ENERGY_REQUIREMENTS,
         }
     )
 
@@ -29,15 +65,8 @@ def EnergyResearch() -> Entity:
 def LaserResearch() -> Entity:
     return Entity(
         components={
-            ResearchComponent: ResearchComponent(
-                name="Laser",
-                level=0,
-                cost={Resources.Metal: 20, Resources.Cristal: 40,},
-                upgrade_cost_factor=1.7,
-            ),
-            RequirementsComponent: RequirementsComponent(
-                building={"research_lab": 2}, research={"energy": 2}
-            ),
+            ResearchComponent: ResearchComponent(LASER),
+            RequirementsComponent: LASER_REQUIREMENTS,
         }
     )
 
@@ -45,15 +74,8 @@ def LaserResearch() -> Entity:
 def CombustionDrive() -> Entity:
     return Entity(
         components={
-            ResearchComponent: ResearchComponent(
-                name="Combustion Drive",
-                level=0,
-                cost={Resources.Metal: 400, Resources.Deuterium: 600},
-                upgrade_cost_factor=2.0,
-            ),
-            RequirementsComponent: RequirementsComponent(
-                building={"research_lab": 1}, research={"energy": 1}
-            ),
+            ResearchComponent: ResearchComponent(COMBUSTION_DRIVE),
+            RequirementsComponent: COMBUSTION_DRIVE_REQUIREMENTS,
         }
     )
 
@@ -61,19 +83,8 @@ def CombustionDrive() -> Entity:
 def ImpulseDrive() -> Entity:
     return Entity(
         components={
-            ResearchComponent: ResearchComponent(
-                name="Impulse Drive",
-                level=0,
-                cost={
-                    Resources.Metal: 2000,
-                    Resources.Cristal: 4000,
-                    Resources.Deuterium: 600,
-                },
-                upgrade_cost_factor=2.0,
-            ),
-            RequirementsComponent: RequirementsComponent(
-                building={"research_lab": 2}, research={"energy": 1}
-            ),
+            ResearchComponent: ResearchComponent(IMPULSE_DRIVE),
+            RequirementsComponent: IMPULSE_DRIVE_REQUIREMENTS,
         }
     )
 
@@ -81,15 +92,8 @@ def ImpulseDrive() -> Entity:
 def ArmourTech() -> Entity:
     return Entity(
         components={
-            ResearchComponent: ResearchComponent(
-                name="Armour Technology",
-                level=0,
-                cost={Resources.Metal: 1000},
-                upgrade_cost_factor=2.0,
-            ),
-            RequirementsComponent: RequirementsComponent(
-                building={"research_lab": 2}, research={}
-            ),
+            ResearchComponent: ResearchComponent(ARMOUR_TECH),
+            RequirementsComponent: ARMOUR_TECH_REQUIREMENTS,
         }
     )
 
@@ -5,6 +5,7 @@ from typing import Dict, List
 from game_backend.ecs.entity import Entity
 from game_backend.components import (
     ShipComponent,
+    ShipDefinition,
     CombatComponent,
     FleetComponent,
     RequirementsComponent,
@@ -18,20 +19,47 @@ class Ship(Entity):
     pass
 
 
+# Static data of the ships, shared by all the fleets
+LIGHT_FIGHTER = ShipDefinition(
+    name="LightFighter",
+    cost={Resources.Metal: 3000, Resources.Cristal: 1000,},
+    speed=12500,
+    cargo=50,
+)
+LIGHT_FIGHTER_COMBAT = CombatComponent(hp=4000, shield=10, damage=50)
+LIGHT_FIGHTER_REQUIREMENTS = RequirementsComponent(
+    building={"shipyard": 1}, research={"combustion_drive": 1}
+)
+
+HEAVY_FIGHTER = ShipDefinition(
+    name="HeavyFighter",
+    cost={Resources.Metal: 6000, Resources.Cristal: 4000},
+    speed=10000,
+    cargo=100,
+)
+HEAVY_FIGHTER_COMBAT = CombatComponent(hp=10000, shield=25, damage=150,)
+HEAVY_FIGHTER_REQUIREMENTS = RequirementsComponent(
+    building={"shipyard": 3}, research={"armour_tech": 2, "impulse_drive": 2},
+)
+
+COLONY_SHIP = ShipDefinition(
+    name="ColonyShip",
+    cost={Resources.Metal: 10, Resources.Cristal: 0},
+    speed=20,
+    cargo=500,
+)
+COLONY_SHIP_COMBAT = CombatComponent(hp=500, shield=50, damage=10)
+COLONY_SHIP_REQUIREMENTS = RequirementsComponent(
+    building={"shipyard": 4}, research={"impulse_drive": 4}
+)
+
+
 def LightFighter() -> Ship:
     return Ship(
         components={
-            ShipComponent: ShipComponent(
-                name="LightFighter",
-                number=0,
-                cost={Resources.Metal: 3000, Resources.Cristal: 1000,},
-                speed=12500,
-                cargo=50,
-            ),
-            CombatComponent: CombatComponent(hp=4000, shield=10, damage=50),
-            RequirementsComponent: RequirementsComponent(
-                building={"shipyard": 1}, research={"combustion_drive": 1}
-            ),
+            ShipComponent: ShipComponent(LIGHT_FIGHTER),
+            CombatComponent: LIGHT_FIGHTER_COMBAT,
+            RequirementsComponent: LIGHT_FIGHTER_REQUIREMENTS,
         }
     )
 
@@ -39,18 +67,9 @@ def LightFighter() -> Ship:
 def HeavyFighter() -> Ship:
     return Ship(
         components={
-            ShipComponent: ShipComponent(
-                name="HeavyFighter",
-                number=0,
-                cost={Resources.Metal: 6000, Resources.Cristal: 4000},
-                speed=10000,
-                cargo=100,
-            ),
-            CombatComponent: CombatComponent(hp=10000, shield=25, damage=150,),
-            RequirementsComponent: RequirementsComponent(
-                building={"shipyard": 3},
-                research={"armour_tech": 2, "impulse_drive": 2},
-            ),
+            ShipComponent: ShipComponent(HEAVY_FIGHTER),
+            CombatComponent: HEAVY_FIGHTER_COMBAT,
+            RequirementsComponent: HEAVY_FIGHTER_REQUIREMENTS,
         }
     )
 
@@ -58,17 +77,9 @@ def HeavyFighter() -> Ship:
 def ColonyShip() -> Ship:
     return Ship(
         components={
-            ShipComponent: ShipComponent(
-                name="ColonyShip",
-                number=0,
-                cost={Resources.Metal: 10, Resources.Cristal: 0},
-                speed=20,
-                cargo=500,
-            ),
-            CombatComponent: CombatComponent(hp=500, shield=50, damage=10),
-            RequirementsComponent: RequirementsComponent(
-                building={"shipyard": 4}, research={"impulse_drive": 4}
-            ),
+            ShipComponent: ShipComponent(COLONY_SHIP),
+            CombatComponent: COLONY_SHIP_COMBAT,
+            RequirementsComponent: COLONY_SHIP_REQUIREMENTS,
         }
     )
 
@@ -82,7 +93,10 @@ class Fleet(Entity):
 
     @classmethod
     def new(cls, owner_id: str, planet_location: PlanetLocation):
-        return cls(
+        # HACK
+        from game_backend.systems.position_system import PositionSystem
+
+        fleet = cls(
             owner_id=owner_id,
             components={
                 FleetComponent: FleetComponent(
@@ -93,7 +107,13 @@ class Fleet(Entity):
                 )
             },
         )
+        PositionSystem.station_fleet(fleet)
+        return fleet
 
     @property
     def ships(self) -> List[Ship]:
         return [self.light_fighter, self.heavy_fighter, self.colony_ship]
+
+    @property
+    def is_empty(self) -> bool:
+        return all(ship.components[ShipComponent].number == 0 for ship in self.ships)
@@ -1,12 +1,15 @@
+from concurrent.futures import Future
 from dataclasses import dataclass
+import os
+from queue import Empty, SimpleQueue
 from threading import Thread
 import time
 import random
-from typing import List, Dict
+from typing import Callable, List, Dict
 
 from dataclasses_jsonschema import JsonSchemaMixin
 
-from game_backend.config import TARGET_UPDATE_TIME
+from game_backend.config import TARGET_UPDATE_TIME, LAZY_ACCRUAL, SNAPSHOT_INTERVAL
 from game_backend.components import PlanetComponent, ProducerComponent, PlayerComponent
 from game_backend.systems.production_system import ProductionSystem
 from game_backend.systems.ship_building_system import ShipBuildingSystem
@@ -17,7 +20,10 @@ from game_backend.systems.mission_system import (
     VALID_MISSIONS,
 )
 from game_backend.systems.upgrade_system import UpgradeSystem
-from game_backend.ecs.entity import Entity
+from game_backend.ecs.entity import Entity, EntityCatalog
+from game_backend.journal import Journal, journaled
+from game_backend.published_views import PublishedViews
+from game_backend.snapshot import BackgroundSnapshots, SnapshotReport, save_snapshot
 from game_backend.entities.entities import GameState, Player, Planet
 from game_backend.entities.ships import Fleet
 from game_backend.resources import Resources
@@ -30,21 +36,141 @@ class ActionOutcome(JsonSchemaMixin):
     reason: str = None
 
 
+@dataclass
+class PlayerChanges:
+    """
+    Planets, fleets and research of a player that changed since a given version
+    """
+
+    version: int
+    # Current game time, the resources of the planets are given at the time they
+    # were last settled
+    time: float
+    planets: Dict[PlanetLocation, Planet]
+    fleets: List[Fleet]
+    research: Dict[str, Entity]
+    # All the fleets of the player, for clients to drop the deleted ones
+    fleet_ids: List[int]
+
+
 class Game(Thread):
-    def __init__(self, game_state=None):
+    def __init__(
+        self,
+        game_state=None,
+        lazy_accrual=LAZY_ACCRUAL,
+        journal: Journal = None,
+        snapshot_dir: str = None,
+    ):
         if game_state is None:
             game_state = GameState()
         super().__init__()
         self.game_state = game_state
+        # The production mode belongs to the state of this game only
+        game_state.world.lazy_accrual = lazy_accrual
+        self.journal = journal
+        self.tick = 0
+        self.last_dt = 0
+        # Snapshots are saved there every SNAPSHOT_INTERVAL ticks by run()
+        self.snapshot_dir = snapshot_dir
+        self.snapshots = BackgroundSnapshots()
+        # Actions submitted by the other threads, applied at the start of each update
+        self.actions = SimpleQueue()
+        self.views = PublishedViews()
 
     def get_state(self):
+        ProductionSystem.settle_all()
         return self.game_state
 
+    def submit(self, action: Callable, *args, **kwargs) -> Future:
+        """
+        Queues a call to an action of the game, to be done by the game thread at
+        the start of the next update. The future gives the result of the action, or
+        the exception it raised.
+        """
+        future = Future()
+        self.actions.put((future, action, args, kwargs))
+        return future
+
+    def apply_actions(self):
+        """
+        Applies the queued actions, in the order they were submitted
+        """
+        while True:
+            try:
+                future, action, args, kwargs = self.actions.get_nowait()
+            except Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = action(*args, **kwargs)
+            except Exception as exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
     def update(self, dt):
+        self.apply_actions()
+
+        self.tick += 1
+        self.last_dt = dt
+        if self.journal is not None:
+            self.journal.record_tick(self.tick, dt)
+
+        self.game_state.world.time += dt
         # Production round
         ProductionSystem.update(dt)
         MissionSystem.update(dt)
 
+        self.views.publish(self)
+        if self.journal is not None:
+            self.journal.sync_if_due()
+
+    def save_snapshot(self, path: str) -> int:
+        """
+        Saves the state, and records in the journal that it can be restored from
+        this snapshot
+        """
+        size = save_snapshot(self.game_state, path)
+        if self.journal is not None:
+            self.journal.record_snapshot(
+                self.tick, path, self.game_state.world.lazy_accrual
+            )
+        return size
+
+    def save_snapshot_in_background(self, path: str) -> "Future[SnapshotReport]":
+        """
+        The game only waits for the state to be captured, the snapshot is written by
+        a worker thread. Each snapshot should get a new path.
+        The journal records the capture, and the snapshot once it is written, by the
+        game thread at the start of the next update.
+        """
+        future = self.snapshots.save(self.game_state, path)
+        if self.journal is not None:
+            tick = self.tick
+            lazy_accrual = self.game_state.world.lazy_accrual
+            self.journal.record_capture(tick, path)
+
+            def record_snapshot(future: "Future[SnapshotReport]"):
+                if future.exception() is None:
+                    self.submit(self.journal.record_snapshot, tick, path, lazy_accrual)
+
+            future.add_done_callback(record_snapshot)
+        future.add_done_callback(report_snapshot)
+        return future
+
+    def snapshot_if_due(self):
+        if (
+            self.snapshot_dir is None
+            or self.tick % SNAPSHOT_INTERVAL != 0
+            # The previous snapshot is still being written
+            or self.snapshots.busy
+        ):
+            return
+        self.save_snapshot_in_background(
+            os.path.join(self.snapshot_dir, f"snapshot-{self.tick}")
+        )
+
     def check_player_id(self, player_id: str):
         assert player_id in self.game_state.players, f"Unknown player id {player_id}"
 
@@ -66,10 +192,13 @@ class Game(Thread):
     def get_player_planets(self, player_id: str) -> Dict[str, Planet]:
         self.check_player_id(player_id)
         planet_ids = PositionSystem.get_player_planets(player_id)
-        return {
+        planets = {
             planet_id: self.game_state.world.planets[planet_id]
             for planet_id in planet_ids
         }
+        for planet in planets.values():
+            ProductionSystem.settle(planet)
+        return planets
 
     def get_player_fleets(self, player_id: str) -> List[Fleet]:
         self.check_player_id(player_id)
@@ -81,18 +210,44 @@ class Game(Thread):
         research = self.game_state.players[player_id].research
         return research
 
+    def get_player_changes(self, player_id: str, since: int) -> PlayerChanges:
+        planets = self.get_player_planets(player_id)
+        fleets = self.get_player_fleets(player_id)
+        research = self.get_player_research(player_id)
+        return PlayerChanges(
+            version=EntityCatalog.version,
+            time=self.game_state.world.time,
+            planets={
+                planet_id: planet
+                for planet_id, planet in planets.items()
+                if EntityCatalog.changed_since(planet, since)
+            },
+            fleets=[
+                fleet for fleet in fleets if EntityCatalog.changed_since(fleet, since)
+            ],
+            research={
+                research_name: research_entity
+                for research_name, research_entity in research.items()
+                if EntityCatalog.changed_since(research_entity, since)
+            },
+            fleet_ids=[fleet.id for fleet in fleets],
+        )
+
+    @journaled
     def action_upgrade_building(
         self, player_id: str, planet_id: PlanetLocation, building_id: str
     ) -> bool:
         self.check_player_planet(player_id, planet_id)
         return UpgradeSystem.upgrade_building(player_id, planet_id, building_id)
 
+    @journaled
     def action_upgrade_research(
         self, player_id: str, planet_id: PlanetLocation, research_id: str
     ) -> bool:
         self.check_player_planet(player_id, planet_id)
         return UpgradeSystem.upgrade_research(player_id, planet_id, research_id)
 
+    @journaled
     def action_build_ship(
         self, player_id: str, planet_id: PlanetLocation, ship_id: str
     ) -> ActionOutcome:
@@ -100,6 +255,7 @@ class Game(Thread):
         result = ShipBuildingSystem.build_ship(player_id, planet_id, ship_id)
         return ActionOutcome(success=result)
 
+    @journaled
     def action_send_mission(
         self,
         player_id: str,
@@ -130,22 +286,31 @@ class Game(Thread):
             print("name taken")
             return False
         free_location = PositionSystem.get_random_free_location()
-        planet_name = f"planet-{free_location.galaxy}-{free_location.system}-{free_location.position}"
+        self.add_player(player_id, player_name, free_location, random.randint(170, 210))
+        return True
+
+    @journaled
+    def add_player(
+        self,
+        player_id: str,
+        player_name: str,
+        location: PlanetLocation,
+        planet_size: int,
+    ):
+        """
+        Adds the player with its first planet, once the random parts are decided
+        """
+        planet_name = f"planet-{location.galaxy}-{location.system}-{location.position}"
         new_planet = Planet.new(
-            free_location,
-            planet_name,
-            random.randint(170, 210),
-            location=free_location,
-            owner_id=player_id,
+            location, planet_name, planet_size, location=location, owner_id=player_id,
         )
         new_planet.components[PlanetComponent].resources = {
             Resources.Metal: 500,
             Resources.Cristal: 500,
             Resources.Deuterium: 0,
         }
-        self.game_state.world.planets[free_location] = new_planet
-        self.game_state.players[player_id] = Player.new(id=player_id, name=player_name)
-        return True
+        self.game_state.world.add_planet(location, new_planet)
+        self.game_state.add_player(Player.new(id=player_id, name=player_name))
 
     def run(self):
         last_update = time.time()
@@ -158,6 +323,7 @@ class Game(Thread):
             last_update = step_start
 
             self.update(dt)
+            self.snapshot_if_due()
 
             # Now we sleep so that each step is the same lenght
             post_update_time = time.time()
@@ -165,3 +331,15 @@ class Game(Thread):
             remaining_time = TARGET_UPDATE_TIME - dt_2
             if remaining_time > 0:
                 time.sleep(remaining_time)
+
+
+def report_snapshot(future: "Future[SnapshotReport]"):
+    if future.exception() is not None:
+        print(f"Snapshot failed: {future.exception()!r}")
+        return
+    report = future.result()
+    print(
+        f"Snapshot {report.path}: {report.size} bytes, "
+        f"captured in {report.capture_duration:.3f}s, "
+        f"written in {report.write_duration:.3f}s"
+    )
@@ -1,23 +1,61 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass
+from typing import Dict, Sequence
+
+import numpy as np
 from dataclasses_jsonschema import JsonSchemaMixin
 
+# Bit layout of the integer key of a location: galaxy | system | position
+POSITION_BITS = 8
+SYSTEM_BITS = 16
+
 
 class PlanetLocation(str):
+    """
+    Location of a planet, "galaxy_system_position" in its string form.
+    Locations are interned: there is a single instance per location, which also
+    holds the location packed in an integer key.
+    """
+
+    __slots__ = ("galaxy", "system", "position", "key")
+
+    _instances: Dict[int, "PlanetLocation"] = {}
+    _instances_by_string: Dict[str, "PlanetLocation"] = {}
+
     def __new__(cls, galaxy: int, system: int, position: int):
+        key = pack_location(galaxy, system, position)
+        instance = cls._instances.get(key)
+        if instance is not None:
+            return instance
         instance = super(PlanetLocation, cls).__new__(
             cls, f"{galaxy}_{system}_{position}"
         )
         instance.galaxy = galaxy
         instance.system = system
         instance.position = position
+        instance.key = key
+        cls._instances[key] = instance
+        cls._instances_by_string[str(instance)] = instance
         return instance
 
+    def __reduce__(self):
+        return PlanetLocation, (self.galaxy, self.system, self.position)
+
     @staticmethod
     def from_str(location_string: str):
+        instance = PlanetLocation._instances_by_string.get(location_string)
+        if instance is not None:
+            return instance
         galaxy, system, position = location_string.split("_")
         return PlanetLocation(int(galaxy), int(system), int(position))
 
+    @staticmethod
+    def from_key(key: int):
+        instance = PlanetLocation._instances.get(key)
+        if instance is not None:
+            return instance
+        return PlanetLocation(*unpack_location(key))
+
     def distance_from(self, other: "PlanetLocation"):
         if self.galaxy != other.galaxy:
             return 20000 * abs(self.galaxy - other.galaxy)
@@ -25,3 +63,39 @@ class PlanetLocation(str):
             return 2700 + 95 * abs(self.system - other.system)
         else:
             return 1000 + 5 * abs(self.position - other.position)
+
+    def distances_to(self, others: Sequence["PlanetLocation"]) -> np.ndarray:
+        """
+        Same as distance_from, for many locations at once
+        """
+        keys = np.fromiter((other.key for other in others), dtype=np.int64)
+        galaxies, systems, positions = unpack_location(keys)
+        return np.where(
+            galaxies != self.galaxy,
+            20000 * np.abs(galaxies - self.galaxy),
+            np.where(
+                systems != self.system,
+                2700 + 95 * np.abs(systems - self.system),
+                1000 + 5 * np.abs(positions - self.position),
+            ),
+        )
+
+
+def pack_location(galaxy: int, system: int, position: int) -> int:
+    assert 0 <= position < 1 << POSITION_BITS, f"Invalid position {position}"
+    assert 0 <= system < 1 << SYSTEM_BITS, f"Invalid system {system}"
+    assert 0 <= galaxy, f"Invalid galaxy {galaxy}"
+    return (
+        (galaxy << (SYSTEM_BITS + POSITION_BITS)) | (system << POSITION_BITS) | position
+    )
+
+
+def unpack_location(key):
+    """
+    Works with integers and numpy arrays of integers
+    """
+    return (
+        key >> (SYSTEM_BITS + POSITION_BITS),
+        (key >> POSITION_BITS) & ((1 << SYSTEM_BITS) - 1),
+        key & ((1 << POSITION_BITS) - 1),
+    )
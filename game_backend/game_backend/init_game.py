@@ -76,11 +76,12 @@ def init_state_complex() -> GameState:
     earth_fleet.light_fighter.components[ShipComponent].number = 10
     mars_fleet = Fleet.new("max", PlanetLocation(1, 1, 4))
     mars_fleet.heavy_fighter.components[ShipComponent].number = 5
-    game_state.players["max"].fleets = [earth_fleet, mars_fleet]
+    game_state.players["max"].add_fleet(earth_fleet)
+    game_state.players["max"].add_fleet(mars_fleet)
 
     jupiter_fleet = Fleet.new("bob", PlanetLocation(1, 1, 5))
     jupiter_fleet.heavy_fighter.components[ShipComponent].number = 5
 
-    game_state.players["bob"].fleets = [jupiter_fleet]
+    game_state.players["bob"].add_fleet(jupiter_fleet)
 
     return game_state
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Write-ahead journal of the game.
+
+Every tick and every action changing the state is appended to the journal, one
+JSON entry per line, before being applied:
+    - ticks: {"tick": 12, "dt": 1.002}
+    - actions: {"tick": 12, "dt": 1.002, "action": "action_build_ship",
+      "args": {...}}, tick and dt being those of the last tick
+    - snapshots: {"tick": 12, "snapshot": "path/of/the/snapshot",
+      "lazy_accrual": false}, with the production mode of the game, which is
+      restored with it
+    - captures of the snapshots written in the background: {"tick": 12, "capture":
+      "path/of/the/snapshot"}. The snapshot is recorded once it is written, and the
+      entries recorded since its capture are replayed after it
+
+Entries are written and fsynced in batches, at most every fsync_interval seconds,
+so that a crash loses at most that much of the game. The state is recovered by
+loading the last snapshot and replaying the entries written after it.
+"""
+
+import argparse
+from functools import wraps
+import inspect
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from game_backend.config import JOURNAL_FSYNC_INTERVAL, LAZY_ACCRUAL
+from game_backend.game_structs import PlanetLocation
+from game_backend.resources import Resources
+
+
+class Journal:
+    def __init__(self, path: str, fsync_interval: float = JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.file = open(path, "a", encoding="utf-8")
+        self.pending: List[str] = []
+        self.last_sync = time.monotonic()
+        # Actions are recorded from the request threads
+        self.lock = threading.Lock()
+
+    def append(self, entry: Dict):
+        line = json.dumps(entry)
+        with self.lock:
+            self.pending.append(line)
+
+    def record_tick(self, tick: int, dt: float):
+        self.append({"tick": tick, "dt": dt})
+
+    def record_action(self, tick: int, dt: float, action: str, args: Dict):
+        self.append(
+            {"tick": tick, "dt": dt, "action": action, "args": encode_args(args)}
+        )
+
+    def record_snapshot(self, tick: int, snapshot_path: str, lazy_accrual: bool):
+        self.append(
+            {"tick": tick, "snapshot": snapshot_path, "lazy_accrual": lazy_accrual}
+        )
+        self.sync()
+
+    def record_capture(self, tick: int, snapshot_path: str):
+        self.append({"tick": tick, "capture": snapshot_path})
+
+    def sync_if_due(self):
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        Writes the pending entries, and waits for them to be on disk
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            if pending:
+                self.file.write("\n".join(pending) + "\n")
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def journaled(action: Callable) -> Callable:
+    """
+    Decorator of the Game methods changing the state, recording their calls in the
+    journal of the game, if it has one
+    """
+    signature = inspect.signature(action)
+
+    @wraps(action)
+    def record_and_apply(game, *args, **kwargs):
+        if game.journal is not None:
+            arguments = signature.bind(game, *args, **kwargs).arguments
+            del arguments["self"]
+            game.journal.record_action(
+                game.tick, game.last_dt, action.__name__, arguments
+            )
+        return action(game, *args, **kwargs)
+
+    return record_and_apply
+
+
+def encode_args(args: Dict) -> Dict:
+    """
+    Locations are strings already, only the cargo needs converting
+    """
+    encoded = dict(args)
+    if encoded.get("cargo") is not None:
+        encoded["cargo"] = {
+            resource.value: quantity for resource, quantity in encoded["cargo"].items()
+        }
+    return encoded
+
+
+def decode_args(args: Dict) -> Dict:
+    decoded = dict(args)
+    for name in ("planet_id", "destination_id", "location"):
+        if decoded.get(name) is not None:
+            decoded[name] = PlanetLocation.from_str(decoded[name])
+    if decoded.get("cargo") is not None:
+        decoded["cargo"] = {
+            Resources(resource): quantity
+            for resource, quantity in decoded["cargo"].items()
+        }
+    return decoded
+
+
+def read_journal(path: str) -> Iterator[Dict]:
+    """
+    The last entry is skipped if it was only partly written
+    """
+    with open(path, encoding="utf-8") as journal_file:
+        for line in journal_file:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+def entries_after_snapshot(
+    entries: Iterator[Dict], snapshot_path: str
+) -> Tuple[Dict, List[Dict]]:
+    """
+    Returns the last record of the snapshot, and the entries recorded after it, or
+    after its capture if it was written in the background
+    """
+    snapshot_entry = None
+    entries_after = []
+    # Entries recorded since the capture of the snapshot
+    captured_entries = None
+    for entry in entries:
+        if entry.get("capture") == snapshot_path:
+            captured_entries = []
+        elif entry.get("snapshot") == snapshot_path:
+            snapshot_entry = entry
+            entries_after = [] if captured_entries is None else captured_entries
+            captured_entries = None
+        else:
+            entries_after.append(entry)
+            if captured_entries is not None:
+                captured_entries.append(entry)
+    assert (
+        snapshot_entry is not None
+    ), f"Snapshot {snapshot_path} is not recorded in the journal"
+    return snapshot_entry, entries_after
+
+
+def replay(game, entries: List[Dict]):
+    """
+    Applies the ticks and actions of the entries to the game, in order
+    """
+    for entry in entries:
+        if "action" in entry:
+            try:
+                getattr(game, entry["action"])(**decode_args(entry["args"]))
+            except AssertionError:
+                # The action was rejected when it was recorded as well
+                pass
+        elif "dt" in entry:
+            assert (
+                entry["tick"] == game.tick + 1
+            ), f"Tick {game.tick + 1} is missing from the journal"
+            game.update(entry["dt"])
+
+
+def recover(snapshot_path: str, journal_path: str):
+    """
+    Returns the game as it was at the end of the journal
+    """
+    # HACK
+    from game_backend.game import Game
+    from game_backend.snapshot import load_snapshot
+
+    snapshot_entry, entries = entries_after_snapshot(
+        read_journal(journal_path), snapshot_path
+    )
+    # The replayed ticks produce as they did in the production mode of the game
+    game = Game(
+        load_snapshot(snapshot_path),
+        lazy_accrual=snapshot_entry.get("lazy_accrual", LAZY_ACCRUAL),
+    )
+    game.tick = snapshot_entry["tick"]
+    replay(game, entries)
+    return game
+
+
+if __name__ == "__main__":
+    # HACK
+    from game_backend.snapshot import save_snapshot
+
+    parser = argparse.ArgumentParser(
+        description="Rebuilds the game from a snapshot and the journal written after"
+    )
+    parser.add_argument("snapshot", help="path of the snapshot, as in the journal")
+    parser.add_argument("journal")
+    parser.add_argument("output", help="path of the snapshot of the recovered game")
+    arguments = parser.parse_args()
+
+    recovered = recover(arguments.snapshot, arguments.journal)
+    size = save_snapshot(recovered.game_state, arguments.output)
+    print(f"Recovered tick {recovered.tick}, saved {size} bytes to {arguments.output}")
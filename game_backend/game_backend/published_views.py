@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import json
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+from game_backend.config import PUBLISHED_VIEWS_TTL
+from game_backend.ecs.entity import EntityCatalog
+from game_backend.response_cache import CachedResponse, ResponseCache
+
+PLAYER_VIEWS = ("planets", "fleets", "research")
+# View of the whole game state, which is not attached to a player
+STATE_VIEW = (None, "state")
+# Minimum size in characters of the chunks of the state view
+STATE_CHUNK_SIZE = 1 << 16
+
+
+class PublishedViews:
+    """
+    Serialised views of the game, published by the game thread at the end of each
+    update so that request threads never read the live entities.
+    A view is published from the update following its first read, and as long as
+    it is read again within PUBLISHED_VIEWS_TTL seconds. The whole state is costly
+    to serialise, it is only published for the reads waiting for it, as chunks
+    which are streamed.
+    Unchanged player views are reused from the response cache. The planets produce
+    resources without changing, their view is serialised again at each game time.
+    """
+
+    def __init__(self):
+        self.response_cache = ResponseCache()
+        # Replaced as a whole by each publication, None for unknown players
+        self.views: Dict[Tuple[str, str], CachedResponse] = {}
+        self.read_times: Dict[Tuple[str, str], float] = {}
+        self.lock = threading.Lock()
+        self.published = threading.Condition()
+
+    def get(self, player_id: str, view: str, timeout: float) -> CachedResponse:
+        """
+        Called by the request threads. Waits for the next publication if the view is
+        not published yet. The views of unknown players are None.
+        """
+        key = (player_id, view)
+        assert view in PLAYER_VIEWS or key == STATE_VIEW, f"Unknown view {view}"
+        with self.lock:
+            self.read_times[key] = time.monotonic()
+        with self.published:
+            if not self.published.wait_for(lambda: key in self.views, timeout):
+                raise TimeoutError(f"View {view} of {player_id} was not published")
+            return self.views[key]
+
+    def publish(self, game):
+        """
+        Called by the game thread, between two updates
+        """
+        now = time.monotonic()
+        with self.lock:
+            read_times = dict(self.read_times)
+            for key, read_time in read_times.items():
+                if key == STATE_VIEW or now - read_time > PUBLISHED_VIEWS_TTL:
+                    del self.read_times[key]
+
+        views = {}
+        for key, read_time in read_times.items():
+            if now - read_time > PUBLISHED_VIEWS_TTL:
+                self.response_cache.responses.pop(key, None)
+                continue
+            views[key] = self.serialise_view(game, *key)
+
+        with self.published:
+            self.views = views
+            self.published.notify_all()
+
+    def serialise_view(self, game, player_id: str, view: str) -> CachedResponse:
+        if (player_id, view) == STATE_VIEW:
+            return CachedResponse(
+                version=EntityCatalog.version,
+                entity_ids=(),
+                etag=f"{self.response_cache.etag_prefix}-{EntityCatalog.version}",
+                body=encode_chunks(game.get_state().iter_json(depth=1)),
+            )
+        if player_id not in game.game_state.players:
+            return None
+
+        if view == "planets":
+            planets = game.get_player_planets(player_id)
+            return self.response_cache.get(
+                player_id,
+                view,
+                list(planets.values()),
+                lambda: json.dumps(
+                    {
+                        planet_id: planet.serialise()
+                        for planet_id, planet in planets.items()
+                    }
+                ),
+                time=game.game_state.world.time,
+            )
+
+        if view == "fleets":
+            fleets = list(game.get_player_fleets(player_id))
+            return self.response_cache.get(
+                player_id,
+                view,
+                fleets,
+                lambda: json.dumps([fleet.serialise() for fleet in fleets]),
+            )
+
+        research = game.get_player_research(player_id)
+        return self.response_cache.get(
+            player_id,
+            view,
+            list(research.values()),
+            lambda: json.dumps(
+                {
+                    research_name: research_entity.serialise()
+                    for research_name, research_entity in research.items()
+                }
+            ),
+        )
+
+
+def encode_chunks(chunks: Iterable[str]) -> Tuple[bytes, ...]:
+    """
+    Encodes the chunks of a JSON, merged up to STATE_CHUNK_SIZE characters, so that
+    the whole JSON is never built as one string
+    """
+    encoded = []
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= STATE_CHUNK_SIZE:
+            encoded.append("".join(pending).encode())
+            pending = []
+            pending_size = 0
+    if pending:
+        encoded.append("".join(pending).encode())
+    return tuple(encoded)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple, Union
+from uuid import uuid4
+
+from game_backend.ecs.entity import Entity, EntityCatalog
+
+
+@dataclass
+class CachedResponse:
+    # Highest version of the entities of the response when it was serialised
+    version: int
+    entity_ids: Tuple[int, ...]
+    etag: str
+    # Chunks of the body for the views that are streamed
+    body: Union[bytes, Tuple[bytes, ...]]
+    # Game time of the response, for the views which change with time
+    time: float = None
+
+
+class ResponseCache:
+    """
+    Serialised responses of the player views (planets, fleets, research), kept until
+    one of the entities they contain changes or the set of entities changes, or the
+    game time changes for the views which depend on it.
+    Each response gets a new ETag, the global version counter making it unique
+    within the process and a random prefix across restarts.
+    """
+
+    def __init__(self):
+        self.responses: Dict[Tuple[str, str], CachedResponse] = {}
+        self.etag_prefix = uuid4().hex[:8]
+
+    def get(
+        self,
+        player_id: str,
+        view: str,
+        entities: List[Entity],
+        serialise: Callable[[], str],
+        time: float = None,
+    ) -> CachedResponse:
+        """
+        Returns the cached response of the view, serialise being called only if
+        the entities or the given game time changed since it was cached
+        """
+        versions = EntityCatalog.versions
+        version = max((versions.get(entity.id, 0) for entity in entities), default=0)
+        entity_ids = tuple(entity.id for entity in entities)
+
+        cached = self.responses.get((player_id, view))
+        if (
+            cached is None
+            or cached.version != version
+            or cached.entity_ids != entity_ids
+            or cached.time != time
+        ):
+            etag = f"{self.etag_prefix}-{EntityCatalog.version}"
+            if time is not None:
+                etag = f"{etag}-{time!r}"
+            cached = CachedResponse(
+                version=version,
+                entity_ids=entity_ids,
+                etag=etag,
+                body=serialise().encode(),
+                time=time,
+            )
+            self.responses[(player_id, view)] = cached
+        return cached
+
+    def clear(self):
+        self.responses = {}
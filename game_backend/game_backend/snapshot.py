@@ -0,0 +1,956 @@
+#!/usr/bin/env python3
+"""
+Binary snapshots of the game state.
+
+Saving is done in two phases:
+    - capture: copies the field values of the entity tree. It has to be done
+      between two updates for the snapshot to be consistent. The parts of the
+      tree which did not change since the previous capture, according to the
+      versions of the catalog, are reused from it
+    - encode: flattens the capture into tables of rows, one table per entity or
+      component class, and turns them into bytes. It can be done on another
+      thread
+
+Tables are written column by column, each column being packed at once with the
+layout matching the types of its values (doubles, integers, strings joined,
+locations keys, enum indexes, or dicts split in key and value columns). Values
+which do not fit any of these layouts are written one by one with a small tagged
+encoding.
+Class names and field names are written with the snapshot, so that snapshots
+survive new fields. Shared components and definitions are written as the name of
+the module constant holding them, and restored as this constant, so that they are
+still shared after a load and follow the changes of the game data.
+
+File layout: MAGIC, format version (u16), flags (u16), then the payload, zlib
+compressed if the COMPRESSED flag is set.
+"""
+
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import MISSING, dataclass, fields
+from enum import Enum
+from functools import lru_cache
+import gc
+import importlib
+from itertools import islice
+from operator import itemgetter
+import os
+import struct
+import time
+from types import MappingProxyType
+import typing
+from typing import Any, Dict, List, NamedTuple, Tuple
+import zlib
+
+import numpy as np
+
+from game_backend.ecs.component import (
+    Definition,
+    SharedComponent,
+    freeze_containers,
+    type_origin,
+)
+from game_backend.ecs.entity import (
+    CHILD,
+    CHILD_DICT,
+    CHILD_LIST,
+    Entity,
+    EntityCatalog,
+    field_kind,
+)
+from game_backend.entities.entities import GameState, Planet, World
+from game_backend.components import FleetComponent
+from game_backend.game_structs import PlanetLocation
+from game_backend.systems.combat_system import CombatSystem
+from game_backend.systems.mission_system import MissionSystem
+from game_backend.systems.position_system import PositionSystem
+from game_backend.systems.production_system import ProductionSystem
+
+MAGIC = b"OGSNAP"
+FORMAT_VERSION = 6
+COMPRESSED = 1
+
+HEADER = struct.Struct("<6sHH")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+I64 = struct.Struct("<q")
+U64 = struct.Struct("<Q")
+F64 = struct.Struct("<d")
+
+# Modules holding the shared components and definitions in constants
+SHARED_MODULES = (
+    "game_backend.entities.buildings",
+    "game_backend.entities.research",
+    "game_backend.entities.ships",
+)
+
+# Entity fields which are saved in the entities table
+ENTITY_BASE_FIELDS = ("components", "id", "_parent_id")
+
+# Entities changing without their version: the game time, and the resources of the
+# planets accumulated by the production. They are captured again by every capture
+VOLATILE_ENTITY_CLASSES = (World, Planet)
+
+# Kinds of the values of a number column
+NONE, FLOAT, INT, BOOL = range(4)
+NUMBER_KINDS = {type(None): NONE, float: FLOAT, int: INT, bool: BOOL}
+
+
+class EntityCapture(NamedTuple):
+    """
+    Copy of an entity and of its descendants, shared by the captures while they do
+    not change
+    """
+
+    # (class, id, parent id, component classes, version, shared components)
+    entity: Tuple
+    # (class, field values) of the components, then of the entity
+    rows: Tuple[Tuple[type, Tuple], ...]
+    # (field of the entity holding the child, key in this field, capture)
+    children: Tuple[Tuple[str, Any, "EntityCapture"], ...]
+    # Whether the entity or one of its descendants changes without its version
+    volatile: bool
+
+
+class CapturedSnapshot(NamedTuple):
+    catalog_version: int
+    # Versions of the catalog the state was captured from, the next captures only
+    # reuse this one if the catalog was not reset since
+    catalog_versions: Dict[int, int]
+    rng_state: Dict
+    # Generations of the slots of the entity ids
+    id_generations: List[int]
+    # Sequence numbers of the fleet arrivals by fleet id, ordering the arrivals at
+    # the same time
+    arrival_sequences: Dict[int, int]
+    root: EntityCapture
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class ClassLayout:
+    """
+    Saved fields of an entity or component class
+    """
+
+    def __init__(self, cls: type):
+        type_hints = typing.get_type_hints(cls)
+        self.names: List[str] = []
+        self.kinds: List[str] = []
+        # Positions in the field values of the child fields, and of the dicts and
+        # lists which have to be copied when captured
+        self.children: List[Tuple[int, str, str]] = []
+        self.containers: List[int] = []
+        for class_field in fields(cls):
+            if issubclass(cls, Entity) and class_field.name in ENTITY_BASE_FIELDS:
+                continue
+            kind = field_kind(type_hints[class_field.name])
+            position = len(self.names)
+            if kind in (CHILD, CHILD_LIST, CHILD_DICT):
+                self.children.append((position, class_field.name, kind))
+            elif type_origin(type_hints[class_field.name]) in (dict, list):
+                self.containers.append(position)
+            self.names.append(class_field.name)
+            self.kinds.append(kind)
+        if not self.names:
+            self.getter = lambda attributes: ()
+        elif len(self.names) == 1:
+            (name,) = self.names
+            self.getter = lambda attributes: (attributes[name],)
+        else:
+            self.getter = itemgetter(*self.names)
+
+
+_layouts: Dict[type, ClassLayout] = {}
+
+
+def class_layout(cls: type) -> ClassLayout:
+    layout = _layouts.get(cls)
+    if layout is None:
+        layout = ClassLayout(cls)
+        _layouts[cls] = layout
+    return layout
+
+
+def capture_snapshot(
+    game_state: GameState, previous: CapturedSnapshot = None
+) -> CapturedSnapshot:
+    """
+    The parts of the previous capture of the game which did not change are reused
+    """
+    if previous is not None and previous.catalog_versions is not EntityCatalog.versions:
+        previous = None
+    ProductionSystem.write_resources()
+    # The capture only allocates tuples, which the garbage collector would scan
+    # again and again as they pile up
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        root = capture_entity(
+            game_state,
+            None if previous is None else previous.root,
+            None if previous is None else previous.catalog_version,
+        )
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return CapturedSnapshot(
+        catalog_version=EntityCatalog.version,
+        catalog_versions=EntityCatalog.versions,
+        rng_state=CombatSystem.rng.bit_generator.state,
+        id_generations=list(EntityCatalog.entities_index.generations),
+        arrival_sequences=MissionSystem.arrival_sequences(game_state),
+        root=root,
+    )
+
+
+def capture_entity(
+    entity: Entity, previous: EntityCapture, previous_version: int
+) -> EntityCapture:
+    """
+    Reuses the previous capture of the entity, taken at the catalog version
+    previous_version, if neither the entity nor its descendants changed since.
+    Otherwise the entity is captured again, and so are its children, reusing their
+    previous captures the same way. Touching an entity may stand for changes of its
+    descendants as well, their previous captures are not reused then.
+    """
+    versions = EntityCatalog.versions
+    previous_children = {}
+    if previous is not None:
+        if not previous.volatile and versions.get(entity.id, 0) <= previous_version:
+            return previous
+        if EntityCatalog.touched.get(entity.id, 0) <= previous_version:
+            previous_children = {
+                child.entity[1]: child for _, _, child in previous.children
+            }
+
+    shared_components = []
+    rows = []
+    for component_type, component in entity.components.items():
+        if is_shared_type(component_type):
+            shared_components.append(component)
+            continue
+        layout = class_layout(component_type)
+        row = layout.getter(component.__dict__)
+        if layout.containers:
+            row = copy_containers(row, layout.containers)
+        rows.append((component_type, row))
+
+    layout = class_layout(type(entity))
+    row = layout.getter(entity.__dict__)
+    if layout.containers:
+        row = copy_containers(row, layout.containers)
+    children = []
+    volatile = type(entity) in VOLATILE_ENTITY_CLASSES
+    if layout.children:
+        # Children are captured as entities, the row only tells which containers
+        # exist
+        row = list(row)
+        for position, name, kind in layout.children:
+            value = row[position]
+            if kind == CHILD and isinstance(value, Entity):
+                elements = [(None, value)]
+            elif kind == CHILD_LIST and type(value) is list:
+                elements = [(None, element) for element in value]
+            elif kind == CHILD_DICT and type(value) is dict:
+                elements = value.items()
+            else:
+                continue
+            for key, element in elements:
+                child = capture_entity(
+                    element, previous_children.get(element.id), previous_version
+                )
+                children.append((name, key, child))
+                volatile = volatile or child.volatile
+            row[position] = True
+        row = tuple(row)
+    rows.append((type(entity), row))
+
+    return EntityCapture(
+        entity=(
+            type(entity),
+            entity.id,
+            entity._parent_id,
+            tuple(entity.components),
+            versions.get(entity.id, 0),
+            shared_components,
+        ),
+        rows=tuple(rows),
+        children=tuple(children),
+        volatile=volatile,
+    )
+
+
+def flatten_capture(root: EntityCapture) -> Tuple[List[Tuple], Dict[type, List]]:
+    """
+    Returns the entities in depth first order: (class, id, parent id, component
+    classes, version, parent index, field of the parent holding the entity, key in
+    this field, shared components), and the rows of field values by entity or
+    component class, starting with the index of their entity
+    """
+    entities = []
+    rows = {}
+    stack = [(root, -1, None, None)]
+    while stack:
+        capture, parent_index, parent_field, parent_key = stack.pop()
+        index = len(entities)
+        (
+            entity_class,
+            entity_id,
+            parent_id,
+            component_types,
+            version,
+            shared_components,
+        ) = capture.entity
+        entities.append(
+            (
+                entity_class,
+                entity_id,
+                parent_id,
+                component_types,
+                version,
+                parent_index,
+                parent_field,
+                parent_key,
+                shared_components,
+            )
+        )
+        for cls, row in capture.rows:
+            rows.setdefault(cls, []).append((index, *row))
+        stack.extend(
+            (child, index, name, key) for name, key, child in reversed(capture.children)
+        )
+    return entities, rows
+
+
+def copy_containers(row: Tuple, positions: List[int]) -> Tuple:
+    """
+    Values of the other fields are immutable, or replaced rather than changed
+    """
+    row = list(row)
+    for position in positions:
+        value = row[position]
+        if type(value) is dict:
+            row[position] = dict(value)
+        elif type(value) is list:
+            row[position] = list(value)
+    return tuple(row)
+
+
+class SnapshotWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.class_indexes: Dict[type, int] = {}
+
+    def class_index(self, cls: type) -> int:
+        index = self.class_indexes.get(cls)
+        if index is None:
+            index = len(self.class_indexes)
+            self.class_indexes[cls] = index
+        return index
+
+    def class_table(self) -> List[List]:
+        table = []
+        for cls in self.class_indexes:
+            names = [] if issubclass(cls, Enum) else class_layout(cls).names
+            table.append([f"{cls.__module__}:{cls.__qualname__}", names])
+        return table
+
+    def write_bytes(self, data: bytes):
+        self.buffer += U32.pack(len(data))
+        self.buffer += data
+
+    def write(self, value):
+        """
+        Tagged encoding of a single value
+        """
+        buffer = self.buffer
+        if value is None:
+            buffer += b"N"
+        elif value is True:
+            buffer += b"T"
+        elif value is False:
+            buffer += b"F"
+        elif isinstance(value, (float, np.floating)):
+            buffer += b"d"
+            buffer += F64.pack(value)
+        elif isinstance(value, PlanetLocation):
+            buffer += b"L"
+            buffer += U64.pack(value.key)
+        elif isinstance(value, Enum):
+            buffer += b"E"
+            buffer += U16.pack(self.class_index(type(value)))
+            self.write(value.value)
+        elif isinstance(value, str):
+            buffer += b"s"
+            self.write_bytes(value.encode())
+        elif isinstance(value, (int, np.integer)):
+            value = int(value)
+            if -(1 << 63) <= value < 1 << 63:
+                buffer += b"i"
+                buffer += I64.pack(value)
+            else:
+                buffer += b"I"
+                self.write_bytes(
+                    value.to_bytes((value.bit_length() + 8) // 8, "little", signed=True)
+                )
+        elif isinstance(value, (dict, MappingProxyType)):
+            buffer += b"m"
+            buffer += U32.pack(len(value))
+            for key, element in value.items():
+                self.write(key)
+                self.write(element)
+        elif isinstance(value, (list, tuple)):
+            buffer += b"l"
+            buffer += U32.pack(len(value))
+            for element in value:
+                self.write(element)
+        else:
+            raise SnapshotError(f"Cannot write {value!r} in a snapshot")
+
+    def write_column(self, values: List):
+        """
+        Packs a column of values at once, with the layout fitting their types
+        """
+        buffer = self.buffer
+        buffer += U32.pack(len(values))
+        types = set(map(type, values))
+        has_none = type(None) in types
+        types.discard(type(None))
+
+        if types <= {float, int, bool}:
+            try:
+                ints = array(
+                    "q",
+                    [
+                        value
+                        for value in values
+                        if type(value) is not float and value is not None
+                    ],
+                )
+            except OverflowError:
+                ints = None
+            if ints is not None:
+                buffer += b"n"
+                self.write_bytes(bytes([NUMBER_KINDS[type(value)] for value in values]))
+                floats = [value for value in values if type(value) is float]
+                self.write_bytes(array("d", floats).tobytes())
+                self.write_bytes(ints.tobytes())
+                return
+
+        elif types == {str}:
+            strings = [value for value in values if value is not None]
+            joined = "\0".join(strings)
+            if joined.count("\0") == max(len(strings) - 1, 0):
+                buffer += b"s"
+                self.write_none_mask(values, has_none)
+                self.write_bytes(joined.encode())
+                return
+
+        elif types == {PlanetLocation}:
+            buffer += b"L"
+            self.write_none_mask(values, has_none)
+            keys = [value.key for value in values if value is not None]
+            self.write_bytes(array("Q", keys).tobytes())
+            return
+
+        elif len(types) == 1 and issubclass(next(iter(types)), Enum):
+            (enum_class,) = types
+            member_indexes = {member: i for i, member in enumerate(enum_class)}
+            buffer += b"E"
+            buffer += U16.pack(self.class_index(enum_class))
+            self.write_none_mask(values, has_none)
+            self.write_bytes(
+                array(
+                    "H",
+                    [member_indexes[value] for value in values if value is not None],
+                ).tobytes()
+            )
+            return
+
+        elif types == {dict} and not has_none:
+            buffer += b"m"
+            self.write_bytes(array("I", [len(value) for value in values]).tobytes())
+            self.write_column([key for value in values for key in value])
+            self.write_column(
+                [element for value in values for element in value.values()]
+            )
+            return
+
+        elif types == {list} and not has_none:
+            buffer += b"l"
+            self.write_bytes(array("I", [len(value) for value in values]).tobytes())
+            self.write_column([element for value in values for element in value])
+            return
+
+        elif types and not has_none and all(map(is_shared_type, types)):
+            # Each shared object is written once
+            shared_indexes = {}
+            for value in values:
+                shared_indexes.setdefault(id(value), (len(shared_indexes), value))
+            buffer += b"S"
+            buffer += U32.pack(len(shared_indexes))
+            for _, value in shared_indexes.values():
+                key = shared_keys().get(id(value))
+                self.write(key)
+                if key is None:
+                    # Not a constant of the game data, written by value
+                    buffer += U16.pack(self.class_index(type(value)))
+                    for name in class_layout(type(value)).names:
+                        self.write(getattr(value, name))
+            self.write_bytes(
+                array("I", [shared_indexes[id(value)][0] for value in values]).tobytes()
+            )
+            return
+
+        buffer += b"a"
+        for value in values:
+            self.write(value)
+
+    def write_none_mask(self, values: List, has_none: bool):
+        if has_none:
+            self.buffer += b"\x01"
+            self.write_bytes(bytes([value is None for value in values]))
+        else:
+            self.buffer += b"\x00"
+
+    def write_table(self, cls: type, rows: List[Tuple]):
+        self.buffer += U16.pack(self.class_index(cls))
+        self.buffer += U32.pack(len(rows))
+        for column in zip(*rows):
+            self.write_column(list(column))
+
+
+def encode_snapshot(captured: CapturedSnapshot, compress: bool = True) -> bytes:
+    writer = SnapshotWriter()
+    writer.write(captured.catalog_version)
+    writer.write(captured.rng_state)
+    writer.write_column(captured.id_generations)
+    writer.write_column(list(captured.arrival_sequences))
+    writer.write_column(list(captured.arrival_sequences.values()))
+
+    entities, rows = flatten_capture(captured.root)
+    entity_columns = list(zip(*entities))
+    entity_columns[0] = [writer.class_index(cls) for cls in entity_columns[0]]
+    entity_columns[3] = [
+        [writer.class_index(cls) for cls in component_types]
+        for component_types in entity_columns[3]
+    ]
+    writer.buffer += U32.pack(len(entities))
+    for column in entity_columns:
+        writer.write_column(list(column))
+
+    writer.buffer += U32.pack(len(rows))
+    for cls, class_rows in rows.items():
+        writer.write_table(cls, class_rows)
+
+    body = writer.buffer
+    writer.buffer = bytearray()
+    writer.write(writer.class_table())
+    payload = bytes(writer.buffer + body)
+
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= COMPRESSED
+    return HEADER.pack(MAGIC, FORMAT_VERSION, flags) + payload
+
+
+class SnapshotReader:
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.offset = 0
+        # (class, field names in the snapshot, defaults of the missing fields)
+        self.classes: List[Tuple[type, List[str], Dict[str, Any]]] = []
+
+    def unpack(self, unpacker: struct.Struct):
+        (value,) = unpacker.unpack_from(self.payload, self.offset)
+        self.offset += unpacker.size
+        return value
+
+    def read_bytes(self) -> bytes:
+        length = self.unpack(U32)
+        self.offset += length
+        return self.payload[self.offset - length : self.offset]
+
+    def read_array(self, typecode: str) -> List:
+        values = array(typecode)
+        values.frombytes(self.read_bytes())
+        return values.tolist()
+
+    def read_class_table(self):
+        for path, names in self.read():
+            module_name, qualname = path.split(":")
+            cls = importlib.import_module(module_name)
+            for attr_name in qualname.split("."):
+                cls = getattr(cls, attr_name)
+            missing_defaults = {}
+            if not issubclass(cls, Enum):
+                for name in class_layout(cls).names:
+                    if name not in names:
+                        missing_defaults[name] = field_default(cls, name)
+            self.classes.append((cls, names, missing_defaults))
+
+    def read(self):
+        tag = self.payload[self.offset : self.offset + 1]
+        self.offset += 1
+        if tag == b"N":
+            return None
+        if tag == b"T":
+            return True
+        if tag == b"F":
+            return False
+        if tag == b"i":
+            return self.unpack(I64)
+        if tag == b"d":
+            return self.unpack(F64)
+        if tag == b"s":
+            return str(self.read_bytes(), "utf-8")
+        if tag == b"L":
+            return PlanetLocation.from_key(self.unpack(U64))
+        if tag == b"E":
+            enum_class, _, _ = self.classes[self.unpack(U16)]
+            return enum_class(self.read())
+        if tag == b"I":
+            return int.from_bytes(self.read_bytes(), "little", signed=True)
+        if tag == b"m":
+            value = {}
+            for _ in range(self.unpack(U32)):
+                key = self.read()
+                value[key] = self.read()
+            return value
+        if tag == b"l":
+            return [self.read() for _ in range(self.unpack(U32))]
+        raise SnapshotError(f"Unknown tag {tag} at offset {self.offset - 1}")
+
+    def read_column(self) -> List:
+        n_values = self.unpack(U32)
+        layout = self.payload[self.offset : self.offset + 1]
+        self.offset += 1
+
+        if layout == b"n":
+            kinds = self.read_bytes()
+            floats = self.read_array("d")
+            ints = self.read_array("q")
+            if len(floats) == n_values:
+                return floats
+            if len(ints) == n_values and BOOL not in kinds:
+                return ints
+            floats_iter = iter(floats)
+            ints_iter = iter(ints)
+            return [
+                (
+                    next(floats_iter)
+                    if kind == FLOAT
+                    else (
+                        next(ints_iter)
+                        if kind == INT
+                        else bool(next(ints_iter)) if kind == BOOL else None
+                    )
+                )
+                for kind in kinds
+            ]
+
+        if layout == b"s":
+            none_mask = self.read_none_mask()
+            data = str(self.read_bytes(), "utf-8")
+            strings = data.split("\0") if n_values - none_mask.count(1) else []
+            return fill_nones(strings, none_mask)
+
+        if layout == b"L":
+            none_mask = self.read_none_mask()
+            from_key = PlanetLocation.from_key
+            locations = [from_key(key) for key in self.read_array("Q")]
+            return fill_nones(locations, none_mask)
+
+        if layout == b"E":
+            enum_class, _, _ = self.classes[self.unpack(U16)]
+            members = list(enum_class)
+            none_mask = self.read_none_mask()
+            values = [members[index] for index in self.read_array("H")]
+            return fill_nones(values, none_mask)
+
+        if layout == b"m":
+            lengths = self.read_array("I")
+            keys = iter(self.read_column())
+            elements = iter(self.read_column())
+            return [dict(zip(islice(keys, length), elements)) for length in lengths]
+
+        if layout == b"l":
+            lengths = self.read_array("I")
+            elements = iter(self.read_column())
+            return [list(islice(elements, length)) for length in lengths]
+
+        if layout == b"S":
+            shared_values = []
+            for _ in range(self.unpack(U32)):
+                key = self.read()
+                if key is not None:
+                    shared_values.append(shared_constant(key))
+                    continue
+                cls, names, missing_defaults = self.classes[self.unpack(U16)]
+                value = cls.__new__(cls)
+                value.__dict__.update((name, self.read()) for name in names)
+                value.__dict__.update(missing_defaults)
+                freeze_containers(value)
+                shared_values.append(value)
+            return [shared_values[index] for index in self.read_array("I")]
+
+        if layout == b"a":
+            return [self.read() for _ in range(n_values)]
+
+        raise SnapshotError(f"Unknown column layout {layout}")
+
+    def read_none_mask(self) -> bytes:
+        has_none = self.payload[self.offset]
+        self.offset += 1
+        return self.read_bytes() if has_none else b""
+
+
+@lru_cache(maxsize=None)
+def is_shared_type(cls: type) -> bool:
+    return issubclass(cls, (SharedComponent, Definition))
+
+
+@lru_cache(maxsize=None)
+def shared_keys() -> Dict[int, str]:
+    """
+    Keys of the shared components and definitions of SHARED_MODULES by object id:
+    the module and the name of their constant
+    """
+    keys = {}
+    for module_name in SHARED_MODULES:
+        module = importlib.import_module(module_name)
+        for name, value in vars(module).items():
+            if name.isupper() and is_shared_type(type(value)):
+                keys.setdefault(id(value), f"{module_name}:{name}")
+    return keys
+
+
+def shared_constant(key: str):
+    module_name, name = key.split(":")
+    value = getattr(importlib.import_module(module_name), name, None)
+    if value is None or not is_shared_type(type(value)):
+        raise SnapshotError(f"Unknown shared component or definition {key}")
+    return value
+
+
+def fill_nones(values: List, none_mask: bytes) -> List:
+    if not none_mask:
+        return values
+    values_iter = iter(values)
+    return [None if is_none else next(values_iter) for is_none in none_mask]
+
+
+def field_default(cls: type, name: str):
+    for class_field in fields(cls):
+        if class_field.name == name:
+            if class_field.default is not MISSING:
+                return class_field.default
+            if class_field.default_factory is not MISSING:
+                return class_field.default_factory()
+    raise SnapshotError(f"Field {cls.__name__}.{name} is missing from the snapshot")
+
+
+def decode_snapshot(data: bytes) -> GameState:
+    """
+    Restores a game state, replacing the one in the catalog. Entities are rebuilt
+    without calling __init__ or __post_init__, then registered in the emptied
+    catalog at once, and the indexes of the systems are rebuilt from the restored
+    state.
+    """
+    magic, format_version, flags = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("Not a game snapshot")
+    if format_version != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format {format_version}")
+    payload = data[HEADER.size :]
+    if flags & COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    reader = SnapshotReader(payload)
+    reader.read_class_table()
+    catalog_version = reader.read()
+    rng_state = reader.read()
+    id_generations = reader.read_column()
+    arrival_sequences = dict(zip(reader.read_column(), reader.read_column()))
+
+    n_entities = reader.unpack(U32)
+    (
+        class_indexes,
+        ids,
+        parent_ids,
+        component_class_indexes,
+        versions,
+        parent_indexes,
+        parent_fields,
+        parent_keys,
+        shared_components,
+    ) = [reader.read_column() for _ in range(9)]
+    entities = []
+    for i in range(n_entities):
+        entity_class = reader.classes[class_indexes[i]][0]
+        entity = entity_class.__new__(entity_class)
+        entity.__dict__.update(
+            components={
+                reader.classes[class_index][0]: None
+                for class_index in component_class_indexes[i]
+            },
+            id=ids[i],
+            _parent_id=parent_ids[i],
+        )
+        for component in shared_components[i]:
+            entity.components[type(component)] = component
+        entities.append(entity)
+
+    for _ in range(reader.unpack(U32)):
+        cls, names, missing_defaults = reader.classes[reader.unpack(U16)]
+        n_rows = reader.unpack(U32)
+        columns = [reader.read_column() for _ in range(len(names) + 1)]
+        rows = zip(*columns) if n_rows else []
+        if issubclass(cls, Entity):
+            layout = class_layout(cls)
+            containers = {
+                name: {CHILD_LIST: list, CHILD_DICT: dict}.get(kind)
+                for name, kind in zip(layout.names, layout.kinds)
+                if kind in (CHILD, CHILD_LIST, CHILD_DICT)
+            }
+            for entity_index, *values in rows:
+                attributes = entities[entity_index].__dict__
+                attributes.update(zip(names, values))
+                attributes.update(missing_defaults)
+                for name, container in containers.items():
+                    if attributes.get(name) is True:
+                        attributes[name] = None if container is None else container()
+        else:
+            for entity_index, *values in rows:
+                entity = entities[entity_index]
+                component = cls.__new__(cls)
+                component.__dict__.update(zip(names, values))
+                component.__dict__.update(missing_defaults)
+                component._entity_id = entity.id
+                entity.components[cls] = component
+
+    for entity, parent_index, parent_field, parent_key in zip(
+        entities, parent_indexes, parent_fields, parent_keys
+    ):
+        if parent_index < 0:
+            continue
+        parent_attributes = entities[parent_index].__dict__
+        container = parent_attributes[parent_field]
+        if type(container) is list:
+            container.append(entity)
+        elif type(container) is dict:
+            container[parent_key] = entity
+        else:
+            parent_attributes[parent_field] = entity
+
+    # The version keeps increasing, so that the versions given before the restore
+    # are not given again
+    previous_version = EntityCatalog.version
+    EntityCatalog.reset()
+    EntityCatalog.entities_index.restore_generations(id_generations)
+    for entity, version in zip(entities, versions):
+        EntityCatalog.register(entity, version=version)
+    EntityCatalog.version = max(previous_version, catalog_version)
+
+    CombatSystem.rng = np.random.default_rng()
+    CombatSystem.rng.bit_generator.state = rng_state
+    game_state: GameState = entities[0]
+    restore_indexes(game_state, arrival_sequences)
+    return game_state
+
+
+def restore_indexes(game_state: GameState, arrival_sequences: Dict[int, int]):
+    PositionSystem.reset()
+    for planet_id, planet in game_state.world.planets.items():
+        PositionSystem.register_planet(planet_id, planet)
+    for player in game_state.players.values():
+        for fleet in player.fleets:
+            if not fleet.components[FleetComponent].in_transit:
+                PositionSystem.station_fleet(fleet)
+    MissionSystem.restore_arrivals(game_state, arrival_sequences)
+    ProductionSystem.mark_all_dirty()
+
+
+def save_snapshot(game_state: GameState, path: str, compress: bool = True) -> int:
+    """
+    Returns the size of the snapshot in bytes
+    """
+    return write_snapshot(capture_snapshot(game_state), path, compress)
+
+
+def write_snapshot(captured: CapturedSnapshot, path: str, compress: bool = True) -> int:
+    """
+    The snapshot is written next to its path then renamed, so that a file at the
+    path is always a whole snapshot
+    """
+    data = encode_snapshot(captured, compress)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+    return len(data)
+
+
+@dataclass
+class SnapshotReport:
+    path: str
+    size: int
+    # Seconds spent capturing the state in the game thread, and encoding and writing
+    # it in the worker thread
+    capture_duration: float
+    write_duration: float
+
+
+class BackgroundSnapshots:
+    """
+    Saves snapshots without pausing the game for longer than the capture: the
+    captured tables are a copy of the state, so the game can go on while they are
+    encoded and written by a worker thread.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="snapshots"
+        )
+        self.pending: Future = None
+        # Reused by the next capture
+        self.previous_capture: CapturedSnapshot = None
+
+    @property
+    def busy(self) -> bool:
+        return self.pending is not None and not self.pending.done()
+
+    def save(
+        self, game_state: GameState, path: str, compress: bool = True
+    ) -> "Future[SnapshotReport]":
+        """
+        To be called between two updates of the game
+        """
+        capture_start = time.perf_counter()
+        captured = capture_snapshot(game_state, self.previous_capture)
+        self.previous_capture = captured
+        capture_duration = time.perf_counter() - capture_start
+
+        def write() -> SnapshotReport:
+            write_start = time.perf_counter()
+            size = write_snapshot(captured, path, compress)
+            return SnapshotReport(
+                path=path,
+                size=size,
+                capture_duration=capture_duration,
+                write_duration=time.perf_counter() - write_start,
+            )
+
+        self.pending = self.executor.submit(write)
+        return self.pending
+
+
+def load_snapshot(path: str) -> GameState:
+    with open(path, "rb") as snapshot_file:
+        return decode_snapshot(snapshot_file.read())
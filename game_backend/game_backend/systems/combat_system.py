@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 from dataclasses import dataclass
-import random
+from typing import Dict, List, Tuple
 
 import numpy as np
 
+from game_backend.config import COMBAT_RANDOM_SEED
 from game_backend.ecs.entity import EntityCatalog
+from game_backend.entities.buildings import Building
 from game_backend.entities.entities import Planet
 from game_backend.entities.ships import Fleet
+from game_backend.systems.position_system import PositionSystem
 from game_backend.components import (
     FleetComponent,
     ShipComponent,
@@ -16,142 +19,258 @@ from game_backend.components import (
     BuildingComponent,
 )
 
-random.seed(42)
-
 
 @dataclass
 class CombatLog:
     attacker_victory: bool
 
 
-class CombatSystem:
-    def resolve_combat(
-        self, planet: Planet, fleet_defender: Fleet, fleet_attacker: Fleet
-    ) -> CombatLog:
-        game_state = EntityCatalog.get_special("game_state")
-        planet_comp = planet.components[PlanetComponent]
-        if fleet_defender is None:
-            # we spawn an empty fleet. It will be garbage collected by the mission system
-            fleet_defender = Fleet.new(planet_comp.owner_id, planet_comp.location,)
-            game_state.players[planet_comp.owner_id].fleets.append(fleet_defender)
-
-        attacking_fleet_combat_components = [
-            ship.components[CombatComponent] for ship in fleet_attacker.ships
-        ]
-        attacking_fleet_numbers = [
-            ship.components[ShipComponent].number for ship in fleet_attacker.ships
+@dataclass
+class Battle:
+    planet: Planet
+    fleet_defender: Fleet
+    fleet_attacker: Fleet
+
+    @property
+    def defending_buildings(self) -> List[Building]:
+        return [
+            building
+            for building in self.planet.buildings.values()
+            if CombatComponent in building.components
         ]
 
-        defending_fleet_combat_components = [
-            ship.components[CombatComponent] for ship in fleet_defender.ships
-        ]
-        defending_fleet_numbers = [
-            ship.components[ShipComponent].number for ship in fleet_defender.ships
+    def attacking_units(self) -> List[Tuple[CombatComponent, int]]:
+        return [
+            (ship.components[CombatComponent], ship.components[ShipComponent].number)
+            for ship in self.fleet_attacker.ships
         ]
 
-        defending_planet_buildings = [
-            building_id
-            for building_id, building in planet.buildings.items()
-            if CombatComponent in building.components
-        ]
-        defending_planet_combat_components = [
-            planet.buildings[building_id].components[CombatComponent]
-            for building_id in defending_planet_buildings
-        ]
-        defending_planet_numbers = [
-            planet.buildings[building_id].components[BuildingComponent].level
-            for building_id in defending_planet_buildings
+    def defending_units(self) -> List[Tuple[CombatComponent, int]]:
+        return [
+            (ship.components[CombatComponent], ship.components[ShipComponent].number)
+            for ship in self.fleet_defender.ships
+        ] + [
+            (
+                building.components[CombatComponent],
+                building.components[BuildingComponent].level,
+            )
+            for building in self.defending_buildings
         ]
 
-        # One fighting round
-        while sum(attacking_fleet_numbers) > 0 and (
-            sum(defending_fleet_numbers) > 0 or sum(defending_planet_numbers) > 0
-        ):
-
-            # simplified system
 
-            attacker_total_damage = sum(
-                combat_component.damage * number
-                for combat_component, number in zip(
-                    attacking_fleet_combat_components, attacking_fleet_numbers
-                )
-            )
+class CombatSystem:
+    def __init__(self):
+        self.seed(COMBAT_RANDOM_SEED)
 
-            # print(attacker_total_damage)
+    def seed(self, seed: int = None):
+        """
+        Battles are reproducible for a given seed
+        """
+        self.rng = np.random.default_rng(seed)
 
-            defender_total_hp = sum(
-                combat_component.hp * number
-                for combat_component, number in zip(
-                    defending_fleet_combat_components, defending_fleet_numbers
-                )
-            ) + sum(
-                combat_component.hp * number
-                for combat_component, number in zip(
-                    defending_planet_combat_components, defending_planet_numbers
+    def resolve_combat(
+        self, planet: Planet, fleet_defender: Fleet, fleet_attacker: Fleet
+    ) -> CombatLog:
+        spawned_fleet = None
+        if fleet_defender is None:
+            fleet_defender = spawned_fleet = self.spawn_defender_fleet(planet)
+        (combat_log,) = self.resolve_battles(
+            [Battle(planet, fleet_defender, fleet_attacker)]
+        )
+        if spawned_fleet is not None:
+            self.remove_defender_fleets([spawned_fleet])
+        return combat_log
+
+    def resolve_combats(self, attacks: List[Tuple[Planet, Fleet]]) -> List[CombatLog]:
+        """
+        Resolves all the (planet, attacking fleet) battles of a tick together.
+        Attacks must be given in arrival order: the attackers of a same planet fight
+        one after the other, each one against what is left of the defence. Battles
+        are resolved in waves, the k-th attackers of all the planets being resolved
+        at the same time.
+        """
+        waves: List[List[int]] = []
+        n_attacks_per_planet: Dict[str, int] = {}
+        for i, (planet, _) in enumerate(attacks):
+            k = n_attacks_per_planet.get(planet.id, 0)
+            n_attacks_per_planet[planet.id] = k + 1
+            if k == len(waves):
+                waves.append([])
+            waves[k].append(i)
+
+        combat_logs = [None] * len(attacks)
+        # Spawned fleets defend the planets in the following waves as well
+        spawned_fleets = []
+        for wave in waves:
+            battles = []
+            for i in wave:
+                planet, fleet_attacker = attacks[i]
+                planet_comp = planet.components[PlanetComponent]
+                fleet_defender = PositionSystem.get_player_fleet(
+                    planet_comp.owner_id, planet_comp.location
                 )
-            )
+                if fleet_defender is None:
+                    fleet_defender = self.spawn_defender_fleet(planet)
+                    spawned_fleets.append(fleet_defender)
+                battles.append(Battle(planet, fleet_defender, fleet_attacker))
+            for i, combat_log in zip(wave, self.resolve_battles(battles)):
+                combat_logs[i] = combat_log
+        self.remove_defender_fleets(spawned_fleets)
+        return combat_logs
+
+    def resolve_battles(self, battles: List[Battle]) -> List[CombatLog]:
+        """
+        Resolves independent battles (no planet or fleet in two of them) at once
+        """
+        attacking_numbers, defending_numbers = fight(
+            *padded_unit_arrays([battle.attacking_units() for battle in battles]),
+            *padded_unit_arrays([battle.defending_units() for battle in battles]),
+            self.rng,
+        )
+
+        combat_logs = []
+        for battle, attacking_numbers_left, defending_numbers_left in zip(
+            battles, attacking_numbers.tolist(), defending_numbers.tolist()
+        ):
+            for i, ship in enumerate(battle.fleet_attacker.ships):
+                ship.components[ShipComponent].number = attacking_numbers_left[i]
 
-            attack_damage_ratio = attacker_total_damage / defender_total_hp
+            for i, ship in enumerate(battle.fleet_defender.ships):
+                ship.components[ShipComponent].number = defending_numbers_left[i]
 
-            defender_total_damage = sum(
-                combat_component.damage * number
-                for combat_component, number in zip(
-                    defending_fleet_combat_components, defending_fleet_numbers
-                )
-            ) + sum(
-                combat_component.hp * number
-                for combat_component, number in zip(
-                    defending_planet_combat_components, defending_planet_numbers
-                )
-            )
+            n_defending_ships = len(battle.fleet_defender.ships)
+            for i, building in enumerate(battle.defending_buildings):
+                building.components[BuildingComponent].level = defending_numbers_left[
+                    n_defending_ships + i
+                ]
 
-            attacker_total_hp = sum(
-                combat_component.hp * number
-                for combat_component, number in zip(
-                    attacking_fleet_combat_components, attacking_fleet_numbers
-                )
+            EntityCatalog.touch(
+                battle.fleet_attacker, battle.fleet_defender, battle.planet
             )
-
-            defense_damage_ratio = defender_total_damage / attacker_total_hp
-
-            for i in range(len(defending_fleet_numbers)):
-                defending_fleet_numbers[i] = update_numbers(
-                    attack_damage_ratio, defending_fleet_numbers[i]
-                )
-
-            for i in range(len(defending_planet_numbers)):
-                defending_planet_numbers[i] = update_numbers(
-                    attack_damage_ratio, defending_planet_numbers[i]
-                )
-
-            for i in range(len(attacking_fleet_numbers)):
-                attacking_fleet_numbers[i] = update_numbers(
-                    defense_damage_ratio, attacking_fleet_numbers[i]
-                )
-
-        attacker_victory = True
-        if sum(attacking_fleet_numbers) <= 0:
-            attacker_victory = False
-
-        for i, ship in enumerate(fleet_attacker.ships):
-            ship.components[ShipComponent].number = attacking_fleet_numbers[i]
-
-        for i, ship in enumerate(fleet_defender.ships):
-            ship.components[ShipComponent].number = defending_fleet_numbers[i]
-
-        for i, building_id in enumerate(defending_planet_buildings):
-            planet.buildings[building_id].components[
-                BuildingComponent
-            ].level = defending_planet_numbers[i]
-
-        return CombatLog(attacker_victory)
+            combat_logs.append(CombatLog(sum(attacking_numbers_left) > 0))
+        return combat_logs
+
+    def spawn_defender_fleet(self, planet: Planet) -> Fleet:
+        """
+        Spawns an empty fleet, for the buildings of a planet without ships to fight.
+        It is removed by remove_defender_fleets once the battles are over.
+        """
+        game_state = EntityCatalog.get_special("game_state")
+        planet_comp = planet.components[PlanetComponent]
+        fleet_defender = Fleet.new(planet_comp.owner_id, planet_comp.location,)
+        game_state.players[planet_comp.owner_id].add_fleet(fleet_defender)
+        return fleet_defender
+
+    def remove_defender_fleets(self, spawned_fleets: List[Fleet]):
+        """
+        Spawned fleets have no ships to lose, they are still empty after the battles
+        """
+        game_state = EntityCatalog.get_special("game_state")
+        for fleet in spawned_fleets:
+            game_state.players[fleet.owner_id].remove_fleet(fleet)
 
 
 CombatSystem = CombatSystem()
 
 
-def update_numbers(attack_ratio, n_ships):
-    n_death = int((attack_ratio + (random.random() - 0.5) / 10) * n_ships) + (
-        1 if random.random() < attack_ratio else 0
+def unit_arrays(
+    units: List[Tuple[CombatComponent, int]]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the numbers, hp and damage arrays of a list of unit stacks
+    """
+    numbers = np.array([number for _, number in units], dtype=np.int64)
+    hp = np.array([combat_comp.hp for combat_comp, _ in units], dtype=float)
+    damage = np.array([combat_comp.damage for combat_comp, _ in units], dtype=float)
+    return numbers, hp, damage
+
+
+def padded_unit_arrays(
+    units_per_battle: List[List[Tuple[CombatComponent, int]]]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the (battles x unit stacks) numbers, hp and damage arrays of several
+    battles, padded with empty stacks
+    """
+    n_stacks = max(len(units) for units in units_per_battle)
+    padded_arrays = (
+        np.zeros((len(units_per_battle), n_stacks), dtype=np.int64),
+        np.zeros((len(units_per_battle), n_stacks)),
+        np.zeros((len(units_per_battle), n_stacks)),
     )
-    return max(0, min(n_ships, n_ships - n_death))
+    for row, units in enumerate(units_per_battle):
+        for padded_array, array in zip(padded_arrays, unit_arrays(units)):
+            padded_array[row, : len(units)] = array
+    return padded_arrays
+
+
+def fight(
+    attacking_numbers: np.ndarray,
+    attacking_hp: np.ndarray,
+    attacking_damage: np.ndarray,
+    defending_numbers: np.ndarray,
+    defending_hp: np.ndarray,
+    defending_damage: np.ndarray,
+    rng: np.random.Generator,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fights rounds until one of the sides is destroyed and returns the numbers of
+    units left on both sides.
+    Arrays are either (unit stacks) for a single battle, or (battles x unit stacks)
+    to fight several battles at once, finished battles being left as they are.
+    Each round, every stack of units loses about the same share of its units: the
+    total damage of the other side over the total hp of its side.
+    """
+    # simplified system
+    while True:
+        ongoing = (attacking_numbers.sum(axis=-1) > 0) & (
+            defending_numbers.sum(axis=-1) > 0
+        )
+        if not ongoing.any():
+            break
+        ongoing = ongoing[..., np.newaxis]
+
+        attack_damage_ratio = damage_ratio(
+            attacking_damage, attacking_numbers, defending_hp, defending_numbers
+        )
+        defense_damage_ratio = damage_ratio(
+            defending_damage, defending_numbers, attacking_hp, attacking_numbers
+        )
+
+        defending_numbers = np.where(
+            ongoing,
+            update_numbers(attack_damage_ratio, defending_numbers, rng),
+            defending_numbers,
+        )
+        attacking_numbers = np.where(
+            ongoing,
+            update_numbers(defense_damage_ratio, attacking_numbers, rng),
+            attacking_numbers,
+        )
+    return attacking_numbers, defending_numbers
+
+
+def damage_ratio(
+    damage: np.ndarray, numbers: np.ndarray, hp_other: np.ndarray, numbers_other
+) -> np.ndarray:
+    """
+    Total damage of a side over the total hp of the other side, 0 if the other side
+    has no units left
+    """
+    total_damage = (damage * numbers).sum(axis=-1, keepdims=True)
+    total_hp_other = (hp_other * numbers_other).sum(axis=-1, keepdims=True)
+    return np.divide(
+        total_damage,
+        total_hp_other,
+        out=np.zeros_like(total_damage),
+        where=total_hp_other > 0,
+    )
+
+
+def update_numbers(
+    attack_ratio: np.ndarray, n_ships: np.ndarray, rng: np.random.Generator
+) -> np.ndarray:
+    n_death = np.trunc(
+        (attack_ratio + (rng.random(n_ships.shape) - 0.5) / 10) * n_ships
+    ).astype(np.int64) + (rng.random(n_ships.shape) < attack_ratio)
+    return np.clip(n_ships - n_death, 0, n_ships)
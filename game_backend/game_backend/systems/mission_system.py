@@ -1,8 +1,10 @@
-from typing import List, Dict
+from typing import List, Dict, Set, Tuple
+import heapq
+import itertools
 import math
 
 from game_backend.ecs.entity import EntityCatalog
-from game_backend.entities.entities import GameState, Planet
+from game_backend.entities.entities import GameState, Planet, Player
 from game_backend.components import (
     FleetComponent,
     ShipComponent,
@@ -11,6 +13,7 @@ from game_backend.components import (
 from game_backend.entities.ships import Fleet
 from game_backend.systems.position_system import PositionSystem
 from game_backend.systems.combat_system import CombatSystem
+from game_backend.systems.production_system import ProductionSystem
 from game_backend.resources import (
     Resources,
     add_resources,
@@ -30,69 +33,156 @@ class MissionException(Exception):
 
 
 class MissionSystem:
+    def __init__(self):
+        # Heap of (arrival_time, sequence number, fleet id) of the fleets in transit.
+        # The sequence number makes the order of simultaneous arrivals deterministic
+        self.arrivals: List[Tuple[float, int, int]] = []
+        self.arrivals_world_id: int = None
+        self.arrivals_sequence = itertools.count()
+        # Players whose fleets have to be merged or deleted at the end of the update
+        self.players_to_clean: Set[str] = set()
+
     def update(self, dt):
         # TODO Make sure there is only one fleet per planet at the end of this update
         game_state: GameState = EntityCatalog.get_special("game_state")
+        self.check_arrivals_world(game_state)
+
+        now = game_state.world.time
+        # Battles of the tick are resolved together, after the other missions
+        attacking_fleets = []
+        while self.arrivals and self.arrivals[0][0] <= now:
+            arrival_time, _, fleet_id = heapq.heappop(self.arrivals)
+            fleet = EntityCatalog.entities_index.get(fleet_id)
+            if fleet is None:
+                # The fleet was destroyed while travelling
+                continue
+            fleet_comp = fleet.components[FleetComponent]
+            if not fleet_comp.in_transit or fleet_comp.arrival_time != arrival_time:
+                # The fleet was rescheduled, this entry is outdated
+                continue
+            self.players_to_clean.add(fleet.owner_id)
+            if fleet_comp.mission == "ATTACK":
+                attacking_fleets.append(fleet)
+            else:
+                self.execute_mission(game_state, fleet)
+        if attacking_fleets:
+            self.execute_attacks(game_state, attacking_fleets)
 
-        for player in game_state.players.values():
-            for fleet in player.fleets:
-                fleet_comp = fleet.components[FleetComponent]
-                if not fleet_comp.in_transit:
-                    continue
+        players_to_clean, self.players_to_clean = self.players_to_clean, set()
+        for player_id in players_to_clean:
+            if player_id in game_state.players:
+                self.clean_player_fleets(game_state.players[player_id])
 
-                fleet_comp.travel_time_left -= dt
+    def clean_player_fleets(self, player: Player):
+        """
+        Merges the fleets stationed on the same planet and deletes the empty fleets
+        """
+        # Merge fleets on the same planet
+        planets_to_fleet = {}
+        for fleet in player.fleets:
+            fleet_comp = fleet.components[FleetComponent]
+            if fleet_comp.in_transit:
+                continue
+            planets_to_fleet.setdefault(fleet_comp.current_location, []).append(fleet)
+        for fleets in planets_to_fleet.values():
+            if len(fleets) <= 1:
+                continue
+            fleet_to_keep = fleets[0]
+            for fleet_removed in fleets[1:]:
+                for ship_kept, ship_removed in zip(
+                    fleet_to_keep.ships, fleet_removed.ships
+                ):
+                    ship_kept.components[
+                        ShipComponent
+                    ].number += ship_removed.components[ShipComponent].number
+                    ship_removed.components[ShipComponent].number = 0
+                EntityCatalog.touch(fleet_to_keep, fleet_removed)
+
+        # Delete empty fleets
+        for fleet in list(player.fleets):
+            if fleet.is_empty:
+                player.remove_fleet(fleet)
+
+    def schedule_arrival(self, fleet: Fleet, travel_time: float):
+        game_state: GameState = EntityCatalog.get_special("game_state")
+        fleet_comp = fleet.components[FleetComponent]
+        fleet_comp.arrival_time = game_state.world.time + travel_time
+        heapq.heappush(
+            self.arrivals,
+            (fleet_comp.arrival_time, next(self.arrivals_sequence), fleet.id),
+        )
 
-                if fleet_comp.travel_time_left <= 0:
-                    self.execute_mission(game_state, fleet)
+    def reset_arrivals(self):
+        """
+        The arrivals heap will be rebuilt from the fleets on the next update
+        """
+        self.arrivals = []
+        self.arrivals_world_id = None
 
-            # Merge fleets on the same planet
-            planets_to_fleet = {}
+    def arrival_sequences(self, game_state: GameState) -> Dict[int, int]:
+        """
+        Sequence numbers of the scheduled arrivals by fleet id, saved with the game
+        so that simultaneous arrivals keep their order once it is restored
+        """
+        self.check_arrivals_world(game_state)
+        sequences = {}
+        for arrival_time, sequence_number, fleet_id in self.arrivals:
+            fleet = EntityCatalog.entities_index.get(fleet_id)
+            if fleet is None:
+                continue
+            fleet_comp = fleet.components[FleetComponent]
+            if fleet_comp.in_transit and fleet_comp.arrival_time == arrival_time:
+                # The first entry of the fleet is the one which is executed
+                sequences[fleet_id] = min(
+                    sequence_number, sequences.get(fleet_id, sequence_number)
+                )
+        return sequences
+
+    def restore_arrivals(self, game_state: GameState, sequences: Dict[int, int]):
+        """
+        Rebuilds the arrivals heap of a restored game with the saved sequence numbers
+        """
+        self.reset_arrivals()
+        self.check_arrivals_world(game_state, sequences)
+
+    def check_arrivals_world(
+        self, game_state: GameState, sequences: Dict[int, int] = None
+    ):
+        """
+        Rebuilds the arrivals heap from the fleets in transit if the world changed.
+        The fleets missing from the given sequence numbers arrive after the others
+        at the same time.
+        """
+        if game_state.world.id == self.arrivals_world_id:
+            return
+        sequences = sequences or {}
+        self.arrivals = []
+        first_sequence_number = max(sequences.values(), default=-1) + 1
+        self.arrivals_sequence = itertools.count(first_sequence_number)
+        for player in game_state.players.values():
             for fleet in player.fleets:
                 fleet_comp = fleet.components[FleetComponent]
-                if fleet_comp.in_transit:
-                    continue
-                planets_to_fleet.setdefault(fleet_comp.current_location, []).append(
-                    fleet
-                )
-            for fleets in planets_to_fleet.values():
-                if len(fleets) <= 1:
-                    continue
-                fleet_to_keep = fleets[0]
-                for fleet_removed in fleets[1:]:
-                    for ship_kept, ship_removed in zip(
-                        fleet_to_keep.ships, fleet_removed.ships
-                    ):
-                        ship_kept.components[
-                            ShipComponent
-                        ].number += ship_removed.components[ShipComponent].number
-                        ship_removed.components[ShipComponent].number = 0
-
-            # Delete empty fleets
-            fleets_to_delete = []
-            for i, fleet in enumerate(player.fleets):
-                to_delete = True
-                for ship in fleet.ships:
-                    if ship.components[ShipComponent].number > 0:
-                        to_delete = False
-                if to_delete:
-                    fleets_to_delete.append(i)
-            for i in fleets_to_delete[::-1]:
-                fleet = player.fleets.pop(i)
-                fleet.destruct()
-                for ship in fleet.ships:
-                    ship.destruct()
-                    del ship
-                del fleet
+                if fleet_comp.in_transit and fleet_comp.arrival_time is not None:
+                    sequence_number = sequences.get(fleet.id)
+                    if sequence_number is None:
+                        sequence_number = next(self.arrivals_sequence)
+                    self.arrivals.append(
+                        (fleet_comp.arrival_time, sequence_number, fleet.id)
+                    )
+        heapq.heapify(self.arrivals)
+        self.arrivals_world_id = game_state.world.id
 
     def execute_mission(self, game_state: GameState, fleet: Fleet):
         fleet_comp = fleet.components[FleetComponent]
         if fleet_comp.mission == "TRANSPORT":
             destination_planet = game_state.world.planets[fleet_comp.travelling_to]
+            ProductionSystem.settle(destination_planet)
             dest_planet_comp = destination_planet.components[PlanetComponent]
             dest_planet_comp.resources = add_resources(
                 dest_planet_comp.resources, fleet_comp.cargo
             )
             fleet_comp.cargo = empty_resources()
+            EntityCatalog.touch(destination_planet)
 
             fleet_comp.mission = "RETURN"
             prev_destination = fleet_comp.travelling_to
@@ -103,23 +193,20 @@ class MissionSystem:
                 game_state, fleet, fleet_comp.travelling_from, fleet_comp.travelling_to,
             )
 
-            fleet_comp.travel_time_left = fleet_comp.travel_time_total
+            self.schedule_arrival(fleet, fleet_comp.travel_time_total)
+            EntityCatalog.touch(fleet)
 
         elif fleet_comp.mission == "RETURN":
             destination_planet = game_state.world.planets[fleet_comp.travelling_to]
+            ProductionSystem.settle(destination_planet)
             dest_planet_comp = destination_planet.components[PlanetComponent]
             dest_planet_comp.resources = add_resources(
                 dest_planet_comp.resources, fleet_comp.cargo
             )
             fleet_comp.cargo = empty_resources()
+            EntityCatalog.touch(destination_planet)
 
-            fleet_comp.current_location = fleet_comp.travelling_to
-            fleet_comp.in_transit = False
-            fleet_comp.travelling_to = (
-                fleet_comp.travelling_from
-            ) = (
-                fleet_comp.mission
-            ) = fleet_comp.travel_time_total = fleet_comp.travel_time_left = 0
+            self.stop_fleet(fleet)
 
         elif fleet_comp.mission == "COLONIZE":
             if not PositionSystem.is_location_free(fleet_comp.travelling_to):
@@ -137,7 +224,7 @@ class MissionSystem:
                     location=planet_id,
                     owner_id=fleet.owner_id,
                 )
-                game_state.world.planets[planet_id] = planet
+                game_state.world.add_planet(planet_id, planet)
 
                 # Deposit cargo
                 planet_comp = planet.components[PlanetComponent]
@@ -145,26 +232,35 @@ class MissionSystem:
                     planet_comp.resources, fleet_comp.cargo
                 )
                 fleet_comp.cargo = empty_resources()
+                EntityCatalog.touch(planet)
 
                 # Fleet stays at new planet
                 self.stop_fleet(fleet)
         elif fleet_comp.mission == "ATTACK":
-            defender_planet = game_state.world.planets[fleet_comp.travelling_to]
-            defender_id = defender_planet.components[PlanetComponent].owner_id
-            # we find the defender fleet if there is one
-            defender_fleet = None
-            for defender_fleet in game_state.players[defender_id].fleets:
-                defender_fleet_comp = defender_fleet.components[FleetComponent]
-                if (
-                    not defender_fleet_comp.in_transit
-                    and defender_fleet_comp.current_location == fleet_comp.travelling_to
-                ):
-                    break
-            combat_log = CombatSystem.resolve_combat(
-                defender_planet, defender_fleet, fleet
+            self.execute_attacks(game_state, [fleet])
+
+    def execute_attacks(self, game_state: GameState, fleets: List[Fleet]):
+        """
+        Resolves the attacks of the given fleets at once. Fleets are in arrival order,
+        which is the order in which the attackers of a same planet fight.
+        """
+        attacks = []
+        for fleet in fleets:
+            defender_planet = game_state.world.planets[
+                fleet.components[FleetComponent].travelling_to
+            ]
+            self.players_to_clean.add(
+                defender_planet.components[PlanetComponent].owner_id
             )
+            attacks.append((defender_planet, fleet))
+
+        combat_logs = CombatSystem.resolve_combats(attacks)
+
+        for (defender_planet, fleet), combat_log in zip(attacks, combat_logs):
             if combat_log.attacker_victory:
                 # the fleet takes all the resources it can carry
+                fleet_comp = fleet.components[FleetComponent]
+                ProductionSystem.settle(defender_planet)
                 defender_planet_comp = defender_planet.components[PlanetComponent]
                 loot = self._decide_loot(
                     defender_planet_comp.resources, fleet_comp.available_cargo,
@@ -174,7 +270,7 @@ class MissionSystem:
                 )
 
                 fleet_comp.cargo = add_resources(fleet_comp.cargo, loot)
-                print(id(fleet_comp.cargo))
+                EntityCatalog.touch(defender_planet)
                 self.finish_mission_and_return(fleet)
 
     def _decide_loot(
@@ -196,7 +292,8 @@ class MissionSystem:
         prev_destination = fleet_comp.travelling_to
         fleet_comp.travelling_to = fleet_comp.travelling_from
         fleet_comp.travelling_from = prev_destination
-        fleet_comp.travel_time_left = fleet_comp.travel_time_total
+        self.schedule_arrival(fleet, fleet_comp.travel_time_total)
+        EntityCatalog.touch(fleet)
 
     def stop_fleet(self, fleet: Fleet):
         """
@@ -208,7 +305,10 @@ class MissionSystem:
         fleet_comp.travelling_to = (
             fleet_comp.travelling_from
         ) = fleet_comp.mission = None
-        fleet_comp.travel_time_total = fleet_comp.travel_time_left = 0
+        fleet_comp.travel_time_total = 0
+        fleet_comp.arrival_time = None
+        PositionSystem.station_fleet(fleet)
+        EntityCatalog.touch(fleet)
 
     def compute_travelling_time(
         self,
@@ -239,14 +339,7 @@ class MissionSystem:
         game_state: GameState = EntityCatalog.get_special("game_state")
 
         assert player_id in game_state.players
-        player = game_state.players[player_id]
-
-        for fleet in player.fleets:
-            fleet_comp = fleet.components[FleetComponent]
-            if not fleet_comp.in_transit and fleet_comp.current_location == planet_id:
-                # There should only be one per planet so we can return it...
-                return fleet
-        # if nothing was found, will return None
+        return PositionSystem.get_player_fleet(player_id, planet_id)
 
     def order_mission(
         self,
@@ -282,6 +375,7 @@ class MissionSystem:
             ), "Cannot attack your own planet"
 
         planet_from = game_state.world.planets[fleet_comp.current_location]
+        ProductionSystem.settle(planet_from)
         planet_comp = planet_from.components[PlanetComponent]
         if not sufficient_funds(cargo, planet_comp.resources):
             raise MissionException("Insufficient resources on planet")
@@ -298,8 +392,10 @@ class MissionSystem:
         fleet_comp.travel_time_total = self.compute_travelling_time(
             game_state, fleet, fleet_comp.travelling_from, destination_id
         )
-        fleet_comp.travel_time_left = fleet_comp.travel_time_total
+        self.schedule_arrival(fleet, fleet_comp.travel_time_total)
+        PositionSystem.unstation_fleet(fleet)
         fleet_comp.current_location = None
+        EntityCatalog.touch(fleet, planet_from)
 
 
 MissionSystem = MissionSystem()
@@ -1,17 +1,90 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass, astuple
 import random
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
-from game_backend.components import PlanetComponent
+from game_backend.components import PlanetComponent, FleetComponent
 from game_backend.entities.entities import Planet
+from game_backend.entities.ships import Fleet
 from game_backend.game_structs import PlanetLocation
+from game_backend.config import UNIVERSE_GALAXIES, UNIVERSE_SYSTEMS, UNIVERSE_POSITIONS
+
+
+class FreeLocations:
+    """
+    Free locations of a universe. They are kept in an array, each location being
+    encoded as an integer, so that picking a random one is O(1). Taking a location
+    is O(1) too: it is replaced by the last one of the array.
+    """
+
+    def __init__(self, galaxies: int, systems: int, positions: int):
+        self.galaxies = galaxies
+        self.systems = systems
+        self.positions = positions
+        size = galaxies * systems * positions
+        self.locations: List[int] = list(range(size))
+        # Index of each location in self.locations, -1 when it is taken
+        self.indexes: List[int] = list(range(size))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def encode(self, galaxy: int, system: int, position: int) -> int:
+        """
+        Returns None for locations outside of the universe
+        """
+        if not (
+            1 <= galaxy <= self.galaxies
+            and 1 <= system <= self.systems
+            and 1 <= position <= self.positions
+        ):
+            return None
+        return ((galaxy - 1) * self.systems + system - 1) * self.positions + (
+            position - 1
+        )
+
+    def decode(self, code: int) -> Tuple[int, int, int]:
+        code, position = divmod(code, self.positions)
+        galaxy, system = divmod(code, self.systems)
+        return galaxy + 1, system + 1, position + 1
+
+    def take(self, galaxy: int, system: int, position: int):
+        code = self.encode(galaxy, system, position)
+        if code is None or self.indexes[code] == -1:
+            return
+        index = self.indexes[code]
+        last_code = self.locations.pop()
+        if last_code != code:
+            self.locations[index] = last_code
+            self.indexes[last_code] = index
+        self.indexes[code] = -1
+
+    def random_location(self) -> Tuple[int, int, int]:
+        return self.decode(self.locations[random.randrange(len(self.locations))])
 
 
 class PositionSystem:
-    def __init__(self):
+    def __init__(
+        self,
+        galaxies: int = UNIVERSE_GALAXIES,
+        systems: int = UNIVERSE_SYSTEMS,
+        positions: int = UNIVERSE_POSITIONS,
+    ):
         self.planets_index: Dict[PlanetLocation, str] = {}
         self.player_planets: Dict[str, List[PlanetLocation]] = {}
+        # Fleets which are not in transit, by location
+        self.stationed_fleets: Dict[PlanetLocation, List[Fleet]] = {}
+        # The fleet of each player at a location (the first one to arrive, the
+        # others being merged into it by the mission system)
+        self.player_fleets: Dict[Tuple[str, PlanetLocation], Fleet] = {}
+        self.free_locations = FreeLocations(galaxies, systems, positions)
+
+    def set_universe_size(self, galaxies: int, systems: int, positions: int):
+        self.free_locations = FreeLocations(galaxies, systems, positions)
+        for location in self.planets_index:
+            self.free_locations.take(
+                location.galaxy, location.system, location.position
+            )
 
     def register_planet(self, planet_id: PlanetLocation, planet: Planet):
         planet_comp = planet.components[PlanetComponent]
@@ -21,25 +94,54 @@ class PositionSystem:
             location not in self.planets_index
         ), "Trying to register a planet at an already taken location"
         self.planets_index[location] = planet_id
+        self.free_locations.take(location.galaxy, location.system, location.position)
         self.player_planets.setdefault(planet_comp.owner_id, []).append(planet_id)
 
+    def station_fleet(self, fleet: Fleet):
+        """
+        To be called when a fleet stops at its current location
+        """
+        location = fleet.components[FleetComponent].current_location
+        self.stationed_fleets.setdefault(location, []).append(fleet)
+        self.player_fleets.setdefault((fleet.owner_id, location), fleet)
+
+    def unstation_fleet(self, fleet: Fleet):
+        """
+        To be called before a stationed fleet leaves its location or is deleted
+        """
+        location = fleet.components[FleetComponent].current_location
+        fleets = self.stationed_fleets.get(location, [])
+        if not any(stationed is fleet for stationed in fleets):
+            return
+        fleets = [stationed for stationed in fleets if stationed is not fleet]
+        if fleets:
+            self.stationed_fleets[location] = fleets
+        else:
+            del self.stationed_fleets[location]
+
+        key = (fleet.owner_id, location)
+        if self.player_fleets.get(key) is fleet:
+            del self.player_fleets[key]
+            for stationed in fleets:
+                if stationed.owner_id == fleet.owner_id:
+                    self.player_fleets[key] = stationed
+                    break
+
+    def get_player_fleet(self, player_id: str, location: PlanetLocation) -> Fleet:
+        """
+        Returns None if the player has no fleet stationed at this location
+        """
+        return self.player_fleets.get((player_id, location))
+
+    def get_stationed_fleets(self, location: PlanetLocation) -> List[Fleet]:
+        return self.stationed_fleets.get(location, [])
+
     def is_location_free(self, location: PlanetLocation):
         return location not in self.planets_index
 
-    def get_random_free_location(
-        self, galaxy_range=5, system_range=500, position_range=9
-    ) -> PlanetLocation:
-        all_locations = set(
-            (g + 1, s + 1, p + 1)
-            for g in range(galaxy_range)
-            for s in range(system_range)
-            for p in range(position_range)
-        )
-        taken_locations = set(loc for loc in self.planets_index)
-        free_locations = all_locations - taken_locations
-        random_free_location = random.choice(list(free_locations))
-
-        return PlanetLocation(*random_free_location)
+    def get_random_free_location(self) -> PlanetLocation:
+        assert len(self.free_locations) > 0, "There is no free location left"
+        return PlanetLocation(*self.free_locations.random_location())
 
     def get_player_planets(self, player_id: str) -> List[str]:
         assert (
@@ -49,6 +151,13 @@ class PositionSystem:
 
     def reset(self):
         self.planets_index = {}
+        self.player_planets = {}
+        self.stationed_fleets = {}
+        self.player_fleets = {}
+        free_locations = self.free_locations
+        self.free_locations = FreeLocations(
+            free_locations.galaxies, free_locations.systems, free_locations.positions
+        )
 
 
 PositionSystem = PositionSystem()
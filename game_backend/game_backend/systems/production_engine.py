@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+from typing import Dict, Iterable, List, Set
+
+import numpy as np
+
+from game_backend.ecs.entity import EntityCatalog
+from game_backend.entities.entities import Planet, World
+from game_backend.resources import Resources
+from game_backend.components import (
+    BuildingComponent,
+    PlanetComponent,
+    ProducerComponent,
+    StorageComponent,
+)
+
+RESOURCES = list(Resources)
+
+
+class ProductionEngine:
+    """
+    Batched version of the production system. The state of all the planets is kept
+    in arrays:
+        - levels: (planets x buildings)
+        - resources: (planets x resources)
+    and the static building data (production rates, energy, storage, upgrade
+    factors) in (buildings) and (buildings x resources) arrays, so that a whole
+    production step is done with a few array operations.
+    Production rates and storage capacities are kept between updates and only
+    recomputed for the planets that were marked dirty.
+    The arrays hold the resources of the planets between updates. They are only
+    written back into a planet when it is settled, to be read or spent, and read
+    again from the planets that were written back.
+    Buildings are identified by their name, all the planets sharing the same
+    building definitions.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.world_id: int = None
+        self.universe_speed: float = None
+        self.planets: List[Planet] = []
+        self.planet_rows: Dict[int, int] = {}
+        self.building_columns: Dict[str, int] = {}
+        self.refreshed_rows: List[int] = []
+
+        self.levels = np.zeros((0, 0))
+        self.resources = np.zeros((0, len(RESOURCES)))
+        # Game time up to which the resources of each planet were accumulated
+        self.settled_times = np.zeros(0)
+        # Rows written back into their planets since the last step: the resources of
+        # these planets may have been spent since, they are read again
+        self.written_rows: Set[int] = set()
+        self.production_per_second = np.zeros((0, len(RESOURCES)))
+        self.resources_storage = np.zeros((0, len(RESOURCES)))
+
+        self.production_rate = np.zeros((0, len(RESOURCES)))
+        self.energy_production = np.zeros(0)
+        self.energy_consumption = np.zeros(0)
+        self.upgrade_prod_factor = np.ones(0)
+        self.storage = np.zeros((0, len(RESOURCES)))
+        self.upgrade_storage_factor = np.ones(0)
+
+    def sync(self, world: World, dirty_planets: Iterable[Planet]):
+        """
+        Makes sure the production rates are up to date. Only the dirty planets are
+        reloaded, unless the world or its speed changed.
+        """
+        if world.id != self.world_id or world.speed != self.universe_speed:
+            if world.id == self.world_id:
+                # The speed changed, the arrays hold the resources of the planets
+                self.write_all()
+            self.load({planet.id: planet for planet in world.planets.values()})
+            self.world_id = world.id
+            self.universe_speed = world.speed
+            self.refreshed_rows = list(range(len(self.planets)))
+        else:
+            new_planets = []
+            rows = []
+            for planet in dirty_planets:
+                if planet._parent_id != world.id:
+                    # Not part of this world (anymore)
+                    continue
+                row = self.planet_rows.get(planet.id)
+                if row is None:
+                    new_planets.append(planet)
+                else:
+                    rows.append(row)
+            rows += self._add_planets(new_planets)
+            for row in rows:
+                self._load_planet_levels(row, self.planets[row])
+            self.refreshed_rows = rows
+        if self.refreshed_rows:
+            self.compute_rates(self.refreshed_rows)
+
+    def load(self, planets: Dict[int, Planet]):
+        """
+        Loads the building levels of the given planets (indexed by entity id) in the
+        arrays
+        """
+        self.planets = list(planets.values())
+        self.planet_rows = {planet_id: row for row, planet_id in enumerate(planets)}
+
+        levels = np.zeros((len(self.planets), len(self.building_columns)))
+        for building, building_comp in EntityCatalog.query(BuildingComponent):
+            row = self.planet_rows.get(building._parent_id)
+            if row is None:
+                continue
+            column = self.building_columns.get(building_comp.name)
+            if column is None:
+                column = self._add_building(building)
+                levels = np.pad(levels, ((0, 0), (0, 1)))
+            levels[row, column] = building_comp.level
+        self.levels = levels
+        self.production_per_second = np.zeros((len(self.planets), len(RESOURCES)))
+        self.resources_storage = np.zeros((len(self.planets), len(RESOURCES)))
+        self.resources = np.zeros((len(self.planets), len(RESOURCES)))
+        self.settled_times = np.zeros(len(self.planets))
+        self.written_rows = set()
+        self._read_resources(list(range(len(self.planets))))
+
+    def _add_planets(self, planets: List[Planet]) -> List[int]:
+        if not planets:
+            return []
+        first_row = len(self.planets)
+        for row, planet in enumerate(planets, first_row):
+            self.planets.append(planet)
+            self.planet_rows[planet.id] = row
+        self.levels = np.pad(self.levels, ((0, len(planets)), (0, 0)))
+        self.production_per_second = np.pad(
+            self.production_per_second, ((0, len(planets)), (0, 0))
+        )
+        self.resources_storage = np.pad(
+            self.resources_storage, ((0, len(planets)), (0, 0))
+        )
+        self.resources = np.pad(self.resources, ((0, len(planets)), (0, 0)))
+        self.settled_times = np.pad(self.settled_times, (0, len(planets)))
+        rows = list(range(first_row, len(self.planets)))
+        self._read_resources(rows)
+        return rows
+
+    def _load_planet_levels(self, row: int, planet: Planet):
+        for building in planet.buildings.values():
+            building_comp = building.components[BuildingComponent]
+            column = self.building_columns.get(building_comp.name)
+            if column is None:
+                column = self._add_building(building)
+                self.levels = np.pad(self.levels, ((0, 0), (0, 1)))
+            self.levels[row, column] = building_comp.level
+
+    def _add_building(self, building) -> int:
+        """
+        Adds the static data of a new kind of building to the building arrays
+        """
+        column = len(self.building_columns)
+        self.building_columns[building.components[BuildingComponent].name] = column
+
+        production_rate = np.zeros((1, len(RESOURCES)))
+        energy_production = energy_consumption = 0
+        if ProducerComponent in building.components:
+            prod_comp = building.components[ProducerComponent]
+            for resource, rate in prod_comp.production_rate.items():
+                production_rate[0, RESOURCES.index(resource)] = rate
+            energy_production = prod_comp.energy_production
+            energy_consumption = prod_comp.energy_consumption
+
+        storage = np.zeros((1, len(RESOURCES)))
+        upgrade_storage_factor = 1
+        if StorageComponent in building.components:
+            stor_comp = building.components[StorageComponent]
+            for resource, resource_storage in stor_comp.resources_storage.items():
+                storage[0, RESOURCES.index(resource)] = resource_storage
+            upgrade_storage_factor = stor_comp.upgrade_storage_factor
+
+        self.production_rate = np.vstack([self.production_rate, production_rate])
+        self.energy_production = np.append(self.energy_production, energy_production)
+        self.energy_consumption = np.append(
+            self.energy_consumption, energy_consumption
+        )
+        self.upgrade_prod_factor = np.append(
+            self.upgrade_prod_factor,
+            building.components[BuildingComponent].upgrade_prod_factor,
+        )
+        self.storage = np.vstack([self.storage, storage])
+        self.upgrade_storage_factor = np.append(
+            self.upgrade_storage_factor, upgrade_storage_factor
+        )
+        return column
+
+    def compute_rates(self, rows: List[int]):
+        """
+        Computes the production per second and the storage capacity of the planets
+        at the given rows
+        """
+        levels = self.levels[rows]
+        prod_factor = self.upgrade_prod_factor ** levels
+        energy_production = (self.energy_production * levels * prod_factor).sum(
+            axis=1
+        )
+        energy_consumption = (self.energy_consumption * levels * prod_factor).sum(
+            axis=1
+        )
+        energy_ratio = np.ones(len(rows))
+        consuming = energy_consumption != 0
+        energy_ratio[consuming] = np.minimum(
+            1, energy_production[consuming] / energy_consumption[consuming]
+        )
+
+        base_rate = self.production_rate * self.universe_speed
+        self.production_per_second[rows] = (
+            base_rate
+            + base_rate
+            * levels[:, :, np.newaxis]
+            * energy_ratio[:, np.newaxis, np.newaxis]
+            * prod_factor[:, :, np.newaxis]
+        ).sum(axis=1)
+
+        self.resources_storage[rows] = (
+            self.storage * (self.upgrade_storage_factor ** levels)[:, :, np.newaxis]
+        ).sum(axis=1)
+
+    def _read_resources(self, rows: List[int]):
+        """
+        Reads the resources of the planets at the given rows, and the game time they
+        were accumulated to
+        """
+        if not rows:
+            return
+        planet_comps = [self.planets[row].components[PlanetComponent] for row in rows]
+        self.resources[rows] = [
+            [planet_comp.resources[r] for r in RESOURCES]
+            for planet_comp in planet_comps
+        ]
+        self.settled_times[rows] = [
+            planet_comp._last_settled for planet_comp in planet_comps
+        ]
+
+    def step(self, time: float):
+        """
+        Accumulates the production of every planet up to the given game time, planets
+        stop accumulating a resource once they are at or above capacity
+        """
+        if self.written_rows:
+            self._read_resources(sorted(self.written_rows))
+            self.written_rows.clear()
+        dt = (time - self.settled_times)[:, np.newaxis]
+        capacity_left = self.resources_storage - self.resources
+        self.resources += np.where(
+            capacity_left > 0,
+            np.minimum(self.production_per_second * dt, capacity_left),
+            0,
+        )
+        self.settled_times[:] = time
+
+    def write(self, planet: Planet):
+        """
+        Writes the resources of the planet back into its component, for them to be
+        read or spent until the next step. Does nothing for the planets which are not
+        in the arrays, or which were already written back.
+        """
+        row = self.planet_rows.get(planet.id)
+        if row is None or row in self.written_rows:
+            return
+        planet_comp = planet.components[PlanetComponent]
+        planet_comp.resources.update(zip(RESOURCES, self.resources[row].tolist()))
+        planet_comp._last_settled = self.settled_times[row].item()
+        self.written_rows.add(row)
+
+    def write_all(self):
+        for planet in self.planets:
+            self.write(planet)
+
+    def store(self) -> List[Planet]:
+        """
+        Writes the rates that were recomputed back into the planet components, with
+        the resources they were recomputed at. Returns the planets whose rates were
+        recomputed.
+        """
+        refreshed_planets = []
+        for row in self.refreshed_rows:
+            planet = self.planets[row]
+            self.write(planet)
+            planet_comp = planet.components[PlanetComponent]
+            planet_comp._production_per_second = dict(
+                zip(RESOURCES, self.production_per_second[row].tolist())
+            )
+            planet_comp._resources_storage = dict(
+                zip(RESOURCES, self.resources_storage[row].tolist())
+            )
+            refreshed_planets.append(planet)
+        self.refreshed_rows = []
+        return refreshed_planets
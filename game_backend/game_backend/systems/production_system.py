@@ -1,7 +1,8 @@
-from typing import Dict
+from typing import Dict, Iterable, List
 
+from game_backend.config import VECTORIZED_PRODUCTION
 from game_backend.ecs.entity import EntityCatalog
-from game_backend.entities.entities import GameState, Planet
+from game_backend.entities.entities import GameState, Planet, World
 from game_backend.resources import Resources, empty_resources
 from game_backend.components import (
     ProducerComponent,
@@ -10,47 +11,227 @@ from game_backend.components import (
     BuildingComponent,
     StorageComponent,
 )
+from game_backend.systems.production_engine import ProductionEngine
 
 
 class ProductionSystem:
     def __init__(self):
         producer_components_index = Dict[str, ProducerComponent]
+        self.vectorized = VECTORIZED_PRODUCTION
+        self.engine = ProductionEngine()
+
+        # Planets whose production rates and storage have to be recomputed
+        self.dirty_planets: Dict[int, Planet] = {}
+        self.rates_world_id: int = None
+        self.rates_speed: float = None
+
+    def mark_dirty(self, planet: Planet):
+        """
+        Production rates and storage capacities are cached, they will be recomputed
+        for this planet on the next update.
+        Building level changes mark their planet dirty automatically.
+        """
+        self.dirty_planets[planet.id] = planet
+
+    def mark_all_dirty(self):
+        self.rates_world_id = None
+        self.engine.reset()
 
     def update(self, dt: float):
         game_state: GameState = EntityCatalog.get_special("game_state")
-        for planet_id, planet in game_state.world.planets.items():
-            self.update_planet_production(game_state.world.speed, planet)
-            self.update_planet_storage(planet)
-            planet_comp = planet.components[PlanetComponent]
-            production_per_second = planet_comp._production_per_second
-            planet_storage = planet_comp._resources_storage
-
-            for resource, resource_prod_per_sec in production_per_second.items():
-                capacity_left = (
-                    planet_storage[resource] - planet_comp.resources[resource]
-                )
-                if capacity_left <= 0:
+        world = game_state.world
+        if world.lazy_accrual:
+            return
+        dirty_planets, self.dirty_planets = self.dirty_planets, {}
+        # The production does not change the versions of the planets: clients compute
+        # their resources from the time they were accumulated to and their rates, so
+        # planets only change with their rates
+        if self.vectorized:
+            self.engine.sync(world, dirty_planets.values())
+            self.engine.step(world.time)
+            refreshed_planets = self.engine.store()
+        else:
+            refreshed_planets = self.refresh_rates(world, dirty_planets.values())
+            for planet in world.planets.values():
+                planet_comp = planet.components[PlanetComponent]
+                self.accumulate(planet_comp, dt)
+                planet_comp._last_settled = world.time
+        if refreshed_planets:
+            EntityCatalog.touch(*refreshed_planets)
+
+    def accumulate(self, planet_comp: PlanetComponent, dt: float):
+        production_per_second = planet_comp._production_per_second
+        planet_storage = planet_comp._resources_storage
+
+        for resource, resource_prod_per_sec in production_per_second.items():
+            capacity_left = planet_storage[resource] - planet_comp.resources[resource]
+            if capacity_left <= 0:
+
+                # The planet is at or above capacity for this resource, it stops accumulating
+                continue
+            planet_comp.resources[resource] += min(
+                resource_prod_per_sec * dt, capacity_left
+            )
+
+    def settle(self, planet: Planet):
+        """
+        In lazy accrual mode, adds to the planet everything it produced since it was
+        last settled. Production rates only change with building levels, so the
+        resources produced are simply the rates times the elapsed time, capped at
+        the storage capacity. Otherwise, writes the resources held by the vectorized
+        production back into the planet.
+        Has to be called before reading or spending the resources of a planet, and
+        before changing its building levels.
+        """
+        game_state: GameState = EntityCatalog.get_special("game_state")
+        world = game_state.world
+        if not world.lazy_accrual:
+            # The vectorized production keeps the resources in its arrays
+            self.engine.write(planet)
+            return
+        dirty_planet = self.dirty_planets.pop(planet.id, None)
+        refreshed_planets = self.refresh_rates(
+            world, [] if dirty_planet is None else [dirty_planet]
+        )
+        if refreshed_planets:
+            EntityCatalog.touch(*refreshed_planets)
+
+        planet_comp = planet.components[PlanetComponent]
+        if world.time == planet_comp._last_settled:
+            return
+        # Settling does not change the version of the planet, see update
+        self.accumulate(planet_comp, world.time - planet_comp._last_settled)
+        planet_comp._last_settled = world.time
 
-                    # The planet is at or above capacity for this resource, it stops accumulating
+    def write_resources(self):
+        """
+        Writes the resources held by the vectorized production back into all the
+        planets, for the readers which do not settle them
+        """
+        self.engine.write_all()
+
+    def settle_all(self):
+        game_state: GameState = EntityCatalog.get_special("game_state")
+        for planet in game_state.world.planets.values():
+            self.settle(planet)
+
+    def refresh_rates(
+        self, world: World, dirty_planets: Iterable[Planet]
+    ) -> List[Planet]:
+        """
+        Recomputes the production rates and storage capacities of the dirty planets,
+        or of all the planets if the world or its speed changed. Returns the planets
+        whose rates were recomputed.
+        """
+        if world.id != self.rates_world_id or world.speed != self.rates_speed:
+            planets = {planet.id: planet for planet in world.planets.values()}
+            self.update_production(world.speed, planets)
+            self.update_storage(planets)
+            self.rates_world_id = world.id
+            self.rates_speed = world.speed
+            refreshed_planets = list(planets.values())
+        else:
+            refreshed_planets = []
+            for planet in dirty_planets:
+                if planet._parent_id != world.id:
+                    # Not part of this world (anymore)
                     continue
-                planet_comp.resources[resource] += min(
-                    resource_prod_per_sec * dt, capacity_left
+                self.update_planet_production(world.speed, planet)
+                self.update_planet_storage(planet)
+                refreshed_planets.append(planet)
+        # The engine did not see these changes
+        self.engine.write_all()
+        self.engine.reset()
+        return refreshed_planets
+
+    def update_production(self, universe_speed: float, planets: Dict[int, Planet]):
+        """
+        Same as update_planet_production but for all the given planets (indexed by
+        entity id) at once, going through the producer columns only once
+        """
+        energy_production = {planet_id: 0 for planet_id in planets}
+        energy_consumption = {planet_id: 0 for planet_id in planets}
+        producers = []
+        for _, building, prod_comp, building_comp in self._planet_buildings(
+            planets, ProducerComponent
+        ):
+            prod_factor = building_comp.prod_factor()
+            energy_production[building._parent_id] += (
+                prod_comp.energy_production * building_comp.level * prod_factor
+            )
+            energy_consumption[building._parent_id] += (
+                prod_comp.energy_consumption * building_comp.level * prod_factor
+            )
+            producers.append((building._parent_id, prod_comp, building_comp))
+
+        energy_ratios = {}
+        for planet_id in planets:
+            if energy_consumption[planet_id] == 0:
+                energy_ratios[planet_id] = 1
+            else:
+                energy_ratios[planet_id] = min(
+                    1, energy_production[planet_id] / energy_consumption[planet_id]
                 )
+        produced_resources = {planet_id: empty_resources() for planet_id in planets}
+        for planet_id, prod_comp, building_comp in producers:
+            for resource, rate in prod_comp.production_rate.items():
+                produced_resources[planet_id][resource] += rate * universe_speed + (
+                    rate
+                    * universe_speed
+                    * building_comp.level
+                    * energy_ratios[planet_id]
+                    * building_comp.prod_factor()
+                )
+        for planet_id, planet in planets.items():
+            planet.components[PlanetComponent]._production_per_second = (
+                produced_resources[planet_id]
+            )
+
+    def update_storage(self, planets: Dict[int, Planet]):
+        """
+        Same as update_planet_storage but for all the given planets (indexed by
+        entity id) at once
+        """
+        resources_storage = {planet_id: empty_resources() for planet_id in planets}
+        for _, building, stor_comp, building_comp in self._planet_buildings(
+            planets, StorageComponent
+        ):
+            planet_storage = resources_storage[building._parent_id]
+            for resource, storage in stor_comp.capacities[building_comp.level].items():
+                planet_storage[resource] += storage
+        for planet_id, planet in planets.items():
+            planet.components[PlanetComponent]._resources_storage = resources_storage[
+                planet_id
+            ]
+
+    def _planet_buildings(self, planets: Dict[int, Planet], component_type: type):
+        """
+        Yields (planet, building, component, building_component) for every building
+        of the given planets having a component of type component_type
+        """
+        for building, component, building_comp in EntityCatalog.query(
+            component_type, BuildingComponent
+        ):
+            planet = planets.get(building._parent_id)
+            if planet is not None:
+                yield planet, building, component, building_comp
 
     def update_planet_production(self, universe_speed: float, planet: Planet):
         planet_component = planet.components[PlanetComponent]
         produced_resources = empty_resources()
+        energy_ratio = planet_component.energy_ratio
         for building in planet.buildings.values():
             if ProducerComponent in building.components:
                 prod_comp = building.components[ProducerComponent]
                 building_comp = building.components[BuildingComponent]
+                prod_factor = building_comp.prod_factor()
                 for resource, rate in prod_comp.production_rate.items():
                     produced_resources[resource] += rate * universe_speed + (
                         rate
                         * universe_speed
                         * building_comp.level
-                        * planet_component.energy_ratio
-                        * building_comp.upgrade_prod_factor ** building_comp.level
+                        * energy_ratio
+                        * prod_factor
                     )
         planet_component._production_per_second = produced_resources
 
@@ -60,11 +241,9 @@ class ProductionSystem:
             if StorageComponent in building.components:
                 stor_comp = building.components[StorageComponent]
                 building_comp = building.components[BuildingComponent]
-                for resource, storage in stor_comp.resources_storage.items():
-                    resources_storage[resource] += (
-                        storage
-                        * stor_comp.upgrade_storage_factor ** building_comp.level
-                    )
+                capacities = stor_comp.capacities[building_comp.level]
+                for resource, storage in capacities.items():
+                    resources_storage[resource] += storage
         planet.components[PlanetComponent]._resources_storage = resources_storage
 
 
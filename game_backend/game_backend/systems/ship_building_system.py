@@ -2,7 +2,7 @@
 from typing import Dict
 
 from game_backend.ecs.entity import EntityCatalog
-from game_backend.entities.entities import GameState
+from game_backend.entities.entities import GameState, Planet, Player
 from game_backend.entities.ships import Fleet
 from game_backend.resources import Resources, sufficient_funds, subtract_cost
 from game_backend.components import (
@@ -12,6 +12,8 @@ from game_backend.components import (
     FleetComponent,
 )
 from game_backend.systems.upgrade_system import UpgradeSystem
+from game_backend.systems.production_system import ProductionSystem
+from game_backend.systems.position_system import PositionSystem
 from game_backend.game_structs import PlanetLocation
 
 
@@ -25,26 +27,35 @@ class ShipBuildingSystem:
         if planet.buildings["shipyard"].components[BuildingComponent].level == 0:
             return False
 
-        # Finding the appropriate fleet
-        planet_fleet = None
-        for fleet in player.fleets:
-            fleet_position_comp = fleet.components[FleetComponent]
-            if (
-                not fleet_position_comp.in_transit
-                and fleet_position_comp.current_location == planet_id
-            ):
-                planet_fleet = fleet
-                break
-        if planet_fleet is None:
+        # Finding the appropriate fleet. A new fleet is only kept if the ship is built,
+        # empty fleets are only removed after arrivals and battles
+        planet_fleet = PositionSystem.get_player_fleet(player_id, planet_id)
+        new_fleet = planet_fleet is None
+        if new_fleet:
             planet_fleet = Fleet.new(player_id, planet_id)
-            player.fleets.append(planet_fleet)
+        built = False
+        try:
+            built = ShipBuildingSystem.add_ship(player, planet, planet_fleet, ship_id)
+        finally:
+            if new_fleet and built:
+                player.add_fleet(planet_fleet)
+            elif new_fleet:
+                PositionSystem.unstation_fleet(planet_fleet)
+                planet_fleet.destruct()
+        return built
 
-        assert hasattr(planet_fleet, ship_id), f"Invalid ship id: {ship_id}"
-        ship = getattr(planet_fleet, ship_id)
+    def add_ship(player: Player, planet: Planet, fleet: Fleet, ship_id: str) -> bool:
+        """
+        Adds one ship to the fleet if its requirements are met and the planet can pay
+        for it
+        """
+        assert hasattr(fleet, ship_id), f"Invalid ship id: {ship_id}"
+        ship = getattr(fleet, ship_id)
 
         if not UpgradeSystem.check_requirements_met(player, planet, ship):
             return False
 
+        ProductionSystem.settle(planet)
         planet_component = planet.components[PlanetComponent]
         ship_cost = ship.components[ShipComponent].cost
 
@@ -57,5 +68,6 @@ class ShipBuildingSystem:
 
         # Add one ship to the fleet
         ship.components[ShipComponent].number += 1
+        EntityCatalog.touch(ship, planet)
 
         return True
@@ -11,6 +11,7 @@ from game_backend.ecs.entity import Entity, EntityCatalog
 from game_backend.entities.entities import Player, Planet
 from game_backend.entities.buildings import Building
 from game_backend.resources import Resources
+from game_backend.systems.production_system import ProductionSystem
 
 
 class UpgradeInsufficientFunds(Exception):
@@ -48,17 +49,18 @@ class UpgradeSystem:
 
         building = planet.buildings[building_name]
         building_component = building.components[BuildingComponent]
-        upgrade_cost = building_component.upgrade_cost
+        upgrade_cost = building_component.next_level_cost()
 
         if not self.check_requirements_met(player, planet, building):
             return False
         if not self.check_enough_resources(planet, upgrade_cost):
             return False
 
-        for resource_str, cost in upgrade_cost.items():
-            planet_component.resources[Resources(resource_str)] -= cost
+        for resource, cost in upgrade_cost.items():
+            planet_component.resources[resource] -= cost
 
         building_component.level += 1
+        EntityCatalog.touch(building)
 
         return True
 
@@ -77,17 +79,18 @@ class UpgradeSystem:
 
         research = player.research[research_name]
         research_component = research.components[ResearchComponent]
-        upgrade_cost = research_component.upgrade_cost
+        upgrade_cost = research_component.next_level_cost()
 
         if not self.check_requirements_met(player, planet, research):
             return False
         if not self.check_enough_resources(planet, upgrade_cost):
             return False
 
-        for resource_str, cost in upgrade_cost.items():
-            planet_component.resources[Resources(resource_str)] -= cost
+        for resource, cost in upgrade_cost.items():
+            planet_component.resources[resource] -= cost
 
         research_component.level += 1
+        EntityCatalog.touch(research, planet)
 
         return True
 
@@ -129,16 +132,18 @@ class UpgradeSystem:
         return True
 
     def check_enough_resources(
-        self, planet: Planet, upgrade_cost: Dict[str, float], raises_exception=False,
+        self,
+        planet: Planet,
+        upgrade_cost: Dict[Resources, float],
+        raises_exception=False,
     ) -> bool:
-        for resource_str, cost in upgrade_cost.items():
-            if (
-                cost
-                > planet.components[PlanetComponent].resources[Resources(resource_str)]
-            ):
+        ProductionSystem.settle(planet)
+        resources = planet.components[PlanetComponent].resources
+        for resource, cost in upgrade_cost.items():
+            if cost > resources[resource]:
                 if raises_exception:
                     raise UpgradeInsufficientFunds(
-                        f"Insufficient {resource_str}. Costs {cost}"
+                        f"Insufficient {resource.value}. Costs {cost}"
                     )
                 return False
         return True
@@ -5,6 +5,7 @@ from typing import Dict, List
 
 from game_backend.ecs.entity import Entity, EntityCatalog
 from game_backend.ecs.component import Component
+from game_backend.ecs.entity_index import SLOT_BITS, SLOT_MASK, EntityIndex
 
 
 def test_ecs():
@@ -55,3 +56,74 @@ def test_ecs():
     assert "simple_entities" in serialised
     assert serialised["simple_entities"][0]["_parent_id"] == serialised["id"]
     assert serialised["simple_entities"][0]["components"]["HealthComponent"]["hp"] == 10
+
+
+def test_component_store_query():
+    @dataclass
+    class PositionComponent(Component):
+        x: int = 0
+
+    @dataclass
+    class VelocityComponent(Component):
+        dx: int = 1
+
+    moving = Entity(
+        components={
+            PositionComponent: PositionComponent(1),
+            VelocityComponent: VelocityComponent(2),
+        }
+    )
+    static = Entity(components={PositionComponent: PositionComponent(3)})
+
+    assert [
+        (entity, position.x, velocity.dx)
+        for entity, position, velocity in EntityCatalog.query(
+            PositionComponent, VelocityComponent
+        )
+    ] == [(moving, 1, 2)]
+    assert set(entity.id for entity, _ in EntityCatalog.query(PositionComponent)) == {
+        moving.id,
+        static.id,
+    }
+
+    # Adding a component moves the entity to another archetype
+    static.add_component(VelocityComponent(5))
+    assert set(
+        velocity.dx
+        for _, _, velocity in EntityCatalog.query(PositionComponent, VelocityComponent)
+    ) == {2, 5}
+
+    moving.destruct()
+    assert [entity for entity, _ in EntityCatalog.query(PositionComponent)] == [static]
+
+
+def test_entity_ids():
+    @dataclass
+    class HealthComponent(Component):
+        hp: int = 10
+
+    ennemy = Entity(components={HealthComponent: HealthComponent()})
+    assert type(ennemy.id) is int
+    assert EntityCatalog.entities_index[ennemy.id] is ennemy
+    assert ennemy.serialise()["id"] == str(ennemy.id)
+
+    # The slot of a destructed entity is reused, with a new id
+    ennemy_id = ennemy.id
+    ennemy.destruct()
+    assert ennemy_id not in EntityCatalog.entities_index
+    assert EntityCatalog.entities_index.get(ennemy_id) is None
+    next_ennemy = Entity(components={HealthComponent: HealthComponent()})
+    assert next_ennemy.id != ennemy_id
+    assert next_ennemy.id & SLOT_MASK == ennemy_id & SLOT_MASK
+    assert next_ennemy.components[HealthComponent].entity is next_ennemy
+
+    # Restored ids keep their slot, and their generations are not given again
+    index = EntityIndex()
+    index.restore_generations([0, 3])
+    restored = Entity.__new__(Entity)
+    restored.id = 2 << SLOT_BITS | 4
+    index[restored.id] = restored
+    assert index[restored.id] is restored
+    assert len(index) == 1
+    new_ids = [index.new_id() for _ in range(5)]
+    assert new_ids == [0, 3 << SLOT_BITS | 1, 2, 3, 5]
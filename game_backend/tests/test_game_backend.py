@@ -1,4 +1,8 @@
+import asyncio
+from dataclasses import FrozenInstanceError
 import json
+import os
+import pickle
 import pytest
 
 from game_backend import __version__
@@ -10,25 +14,64 @@ from game_backend.init_game import (
 from game_backend.game import Game
 from game_backend.resources import Resources
 from game_backend.entities.entities import GameState
+from game_backend.entities.buildings import (
+    MetalMine,
+    METAL_MINE,
+    METAL_MINE_PRODUCER,
+)
 from game_backend.ecs.entity import EntityCatalog
+from game_backend.ecs.component import DefinitionField, SharedComponent
 from game_backend.components import (
+    LevelTable,
     PlayerComponent,
     ProducerComponent,
     PlanetComponent,
     BuildingComponent,
     ShipComponent,
     FleetComponent,
+    CombatComponent,
+    ResearchComponent,
+    StorageComponent,
 )
 from game_backend.systems.position_system import PositionSystem
 from game_backend.systems.mission_system import MissionSystem
+from game_backend.systems.production_system import ProductionSystem
+from game_backend.systems.combat_system import (
+    CombatSystem,
+    fight,
+    unit_arrays,
+    padded_unit_arrays,
+)
 
 from game_backend.game_structs import PlanetLocation
+from game_backend.response_cache import ResponseCache
+from game_backend.snapshot import (
+    capture_snapshot,
+    encode_snapshot,
+    save_snapshot,
+    load_snapshot,
+)
+from game_backend.journal import Journal, recover
+from game_backend import app as app_module, published_views
+from game_backend.app import app
+from game_backend.async_server import MAX_HEADERS, WSGIServer
+from game_backend.config import (
+    UNIVERSE_GALAXIES,
+    UNIVERSE_SYSTEMS,
+    UNIVERSE_POSITIONS,
+    COMBAT_RANDOM_SEED,
+)
 
 
 @pytest.fixture(autouse=True, scope="function")
 def teardown(request):
+    CombatSystem.seed(COMBAT_RANDOM_SEED)
+
     def fin():
         PositionSystem.reset()
+        PositionSystem.set_universe_size(
+            UNIVERSE_GALAXIES, UNIVERSE_SYSTEMS, UNIVERSE_POSITIONS
+        )
 
     request.addfinalizer(fin)
 
@@ -68,6 +111,56 @@ def test_serialise_gamestate():
 # assert new_game_state == game_state
 
 
+def test_serialise_gamestate_stream():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    game.update(100)
+
+    for depth in range(3):
+        chunks = list(game_state.iter_json(depth))
+        assert "".join(chunks) == json.dumps(game_state.serialise())
+    assert len(chunks) > len(game_state.world.planets) + len(game_state.players)
+
+
+def test_serialise_components():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    game.update(100)
+    game.action_send_mission(
+        "max", PlanetLocation(1, 1, 3), "ATTACK", PlanetLocation(1, 1, 5)
+    )
+
+    def reference_serialise(component):
+        serialised = component.to_dict()
+        # Definitions are inlined
+        definition = serialised.pop("definition", {})
+        properties = {
+            attr_name: getattr(component, attr_name)
+            for attr_name, attr in type(component).__dict__.items()
+            if attr_name != "entity"
+            and isinstance(attr, property)
+            and not isinstance(attr, DefinitionField)
+        }
+        return {**definition, **serialised, **properties}
+
+    def components(entity):
+        yield from entity.components.values()
+        for attr in entity.__dict__.values():
+            children = attr.values() if isinstance(attr, dict) else attr
+            if isinstance(attr, (list, dict)):
+                for child in children:
+                    if hasattr(child, "components"):
+                        yield from components(child)
+            elif hasattr(attr, "components"):
+                yield from components(attr)
+
+    n_components = 0
+    for component in components(game_state):
+        assert component.serialise() == reference_serialise(component)
+        n_components += 1
+    assert n_components > 100
+
+
 def test_ids():
     game_state = initialise_gamestate()
 
@@ -75,8 +168,89 @@ def test_ids():
         "metal_mine"
     ]
 
-    assert metal_mine.components[ProducerComponent]._entity_id == metal_mine.id
+    assert metal_mine.components[BuildingComponent]._entity_id == metal_mine.id
     assert metal_mine.id in EntityCatalog.entities_index
+    # Static components are shared by all the buildings of a kind
+    other_metal_mine = MetalMine()
+    producer_comp = metal_mine.components[ProducerComponent]
+    assert isinstance(producer_comp, SharedComponent)
+    assert other_metal_mine.components[ProducerComponent] is producer_comp
+    assert not hasattr(producer_comp, "_entity_id")
+    assert (
+        other_metal_mine.components[BuildingComponent].definition
+        is metal_mine.components[BuildingComponent].definition
+    )
+    # and cannot be changed
+    with pytest.raises(FrozenInstanceError):
+        producer_comp.energy_consumption = 0
+    with pytest.raises(TypeError):
+        producer_comp.production_rate[Resources.Metal] = 0
+    with pytest.raises(TypeError):
+        METAL_MINE.base_cost[Resources.Metal] = 0
+
+
+def test_derived_stats():
+    game_state = init_state_complex()
+    earth = game_state.world.planets[PlanetLocation(1, 1, 3)]
+    planet_comp = earth.components[PlanetComponent]
+    metal_mine_comp = earth.buildings["metal_mine"].components[BuildingComponent]
+    solar_plant_comp = earth.buildings["solar_plant"].components[BuildingComponent]
+
+    # Stats are computed once, until a field they depend on is set
+    upgrade_cost = metal_mine_comp.upgrade_cost
+    assert metal_mine_comp.upgrade_cost is upgrade_cost
+    metal_mine_comp.level += 1
+    assert metal_mine_comp.upgrade_cost is not upgrade_cost
+    factor = metal_mine_comp.upgrade_cost_factor ** metal_mine_comp.level
+    assert metal_mine_comp.upgrade_cost == {
+        resource.value: cost * factor
+        for resource, cost in metal_mine_comp.base_cost.items()
+    }
+
+    # Energy stats follow the levels of the producers of the planet
+    energy_consumption = planet_comp.energy_consumption
+    energy_production = planet_comp.energy_production
+    metal_mine_comp.level += 1
+    assert planet_comp.energy_consumption > energy_consumption
+    solar_plant_comp.level += 1
+    assert planet_comp.energy_production > energy_production
+    assert planet_comp.energy_ratio == min(
+        1, planet_comp.energy_production / planet_comp.energy_consumption
+    )
+
+    fleet_comp = game_state.players["max"].fleets[0].components[FleetComponent]
+    available_cargo = fleet_comp.available_cargo
+    fleet_comp.cargo = {**fleet_comp.cargo, Resources.Metal: 10}
+    assert fleet_comp.available_cargo == available_cargo - 10
+
+    # Components without derived stats are not slowed down
+    assert ShipComponent.__setattr__ is object.__setattr__
+    assert "_stat_upgrade_cost" not in metal_mine_comp.serialise()
+
+
+def test_level_tables():
+    table = LevelTable(lambda level: 2 ** level, size=4)
+    assert table.values == [1, 2, 4, 8]
+    # Higher levels are added when they are read
+    assert table[10] == 1024
+    assert len(table.values) == 11
+
+    game_state = init_state_complex()
+    earth = game_state.world.planets[PlanetLocation(1, 1, 3)]
+    metal_mine_comp = earth.buildings["metal_mine"].components[BuildingComponent]
+    metal_mine_comp.level = 40
+    assert metal_mine_comp.next_level_cost() == {
+        Resources.Metal: 60 * 1.5 ** 40,
+        Resources.Cristal: 15 * 1.5 ** 40,
+    }
+    assert metal_mine_comp.upgrade_cost == {
+        "metal": 60 * 1.5 ** 40,
+        "cristal": 15 * 1.5 ** 40,
+    }
+    assert metal_mine_comp.prod_factor() == 1.1 ** 40
+
+    stor_comp = earth.buildings["metal_hangar"].components[StorageComponent]
+    assert stor_comp.capacities[3] == {Resources.Metal: 10000 * 1.833 ** 3}
 
 
 def test_game_update():
@@ -207,9 +381,15 @@ def test_build_ship():
 
     assert success
 
+    n_entities = len(EntityCatalog.entities_index)
     outcome = game.action_build_ship("max", earth, "light_fighter")
 
     assert not outcome.success
+    # No empty fleet is left by the builds that fail
+    game.update(1)
+    assert game_state.players["max"].fleets == []
+    assert PositionSystem.get_player_fleet("max", earth) is None
+    assert len(EntityCatalog.entities_index) == n_entities
 
     assert game.action_upgrade_building("max", earth, "research_lab")
     assert game.action_upgrade_research("max", earth, "energy")
@@ -369,13 +549,638 @@ def test_combat():
         Resources.Deuterium: 0,
     }
     assert len(game_state.players["bob"].fleets) == 0
-    assert attacking_fleet.ships[0].components[ShipComponent].number == 7
+    assert attacking_fleet.ships[0].components[ShipComponent].number == 5
     assert attacking_fleet.components[FleetComponent].cargo[Resources.Metal] > 0
     assert attacking_fleet.components[FleetComponent].cargo[Resources.Cristal] > 0
     assert attacking_fleet.components[FleetComponent].cargo[Resources.Deuterium] > 0
     game.update(20)
 
 
+def test_destruct():
+    game_state = init_state_complex()
+    Game(game_state)
+    max_player = game_state.players["max"]
+    bob = game_state.players["bob"]
+    jupiter = game_state.world.planets[PlanetLocation(1, 1, 5)]
+
+    # Fleets are destructed with their ships
+    jupiter_fleet = bob.fleets[0]
+    bob.remove_fleet(jupiter_fleet)
+    assert bob.fleets == []
+    assert PositionSystem.get_player_fleet("bob", PlanetLocation(1, 1, 5)) is None
+    for entity in [jupiter_fleet, *jupiter_fleet.ships]:
+        assert entity.id not in EntityCatalog.entities_index
+
+    # The fleet spawned to defend the planet is removed after the battle
+    earth_fleet, mars_fleet = max_player.fleets
+    n_entities = len(EntityCatalog.entities_index)
+    CombatSystem.resolve_combats([(jupiter, earth_fleet)])
+    assert bob.fleets == []
+    assert len(EntityCatalog.entities_index) == n_entities
+
+    audit = EntityCatalog.audit([game_state])
+    assert all(
+        entity_id not in audit.leaked.get(type(entity).__name__, [])
+        for entity_id, entity in EntityCatalog.entities_index.items()
+        if entity.parent is bob or entity.parent is max_player
+    )
+    assert audit.dangling == {}
+
+    # Fleets detached without being destructed are leaked, and orphaned once their
+    # player is destructed
+    max_player.fleets.remove(mars_fleet)
+    earth_fleet.destruct()
+    audit = EntityCatalog.audit([game_state])
+    assert mars_fleet.id in audit.leaked["Fleet"]
+    assert mars_fleet.light_fighter.id in audit.leaked["Ship"]
+    assert mars_fleet.id not in audit.orphaned.get("Fleet", [])
+    assert audit.dangling["Fleet"] == [earth_fleet.id]
+    assert sorted(audit.dangling["Ship"]) == sorted(
+        ship.id for ship in earth_fleet.ships
+    )
+    assert audit.counts()["dangling"] == {"Fleet": 1, "Ship": 3}
+
+    max_player.fleets.remove(earth_fleet)
+    del game_state.players["max"]
+    max_player.destruct()
+    audit = EntityCatalog.audit([game_state])
+    assert mars_fleet.id in audit.orphaned["Fleet"]
+    assert audit.dangling == {}
+
+
+def test_combat_reproducible():
+    def battle():
+        attackers = unit_arrays(
+            [(CombatComponent(hp=400, shield=10, damage=50), 1000)] * 200
+        )
+        defenders = unit_arrays(
+            [(CombatComponent(hp=1000, shield=25, damage=150), 300)] * 100
+        )
+        return fight(*attackers, *defenders, CombatSystem.rng)
+
+    CombatSystem.seed(1)
+    attacking_numbers, defending_numbers = battle()
+    assert attacking_numbers.sum() > 0
+    assert defending_numbers.sum() == 0
+    assert (attacking_numbers <= 1000).all()
+
+    CombatSystem.seed(1)
+    same_attacking_numbers, same_defending_numbers = battle()
+    assert (same_attacking_numbers == attacking_numbers).all()
+    assert (same_defending_numbers == defending_numbers).all()
+
+
+def test_batch_combat():
+    game_state = init_state_complex()
+    Game(game_state)
+    earth_fleet, mars_fleet = game_state.players["max"].fleets
+    jupiter = game_state.world.planets[PlanetLocation(1, 1, 5)]
+    jupiter_fleet = game_state.players["bob"].fleets[0]
+    earth_fleet.light_fighter.components[ShipComponent].number = 1
+    mars_fleet.heavy_fighter.components[ShipComponent].number = 1000
+
+    # The attackers of a same planet fight one after the other
+    combat_logs = CombatSystem.resolve_combats(
+        [(jupiter, earth_fleet), (jupiter, mars_fleet)]
+    )
+    assert [combat_log.attacker_victory for combat_log in combat_logs] == [
+        False,
+        True,
+    ]
+    assert earth_fleet.light_fighter.components[ShipComponent].number == 0
+    assert jupiter_fleet.heavy_fighter.components[ShipComponent].number == 0
+    assert 0 < mars_fleet.heavy_fighter.components[ShipComponent].number <= 1000
+
+    # Battles of different sizes are padded with empty stacks
+    attackers = padded_unit_arrays(
+        [
+            [(CombatComponent(hp=400, shield=10, damage=50), 10)],
+            [(CombatComponent(hp=400, shield=10, damage=50), 10)] * 3,
+        ]
+    )
+    defenders = padded_unit_arrays(
+        [[(CombatComponent(hp=1000, shield=25, damage=150), 0)] * 2, []]
+    )
+    attacking_numbers, defending_numbers = fight(
+        *attackers, *defenders, CombatSystem.rng
+    )
+    assert attacking_numbers.tolist() == [[10, 0, 0], [10, 10, 10]]
+    assert defending_numbers.tolist() == [[0, 0], [0, 0]]
+
+
+def test_player_changes():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    earth = PlanetLocation(1, 1, 3)
+    mars = PlanetLocation(1, 1, 4)
+
+    changes = game.get_player_changes("max", 0)
+    assert set(changes.planets) == {earth, mars}
+    assert len(changes.fleets) == 2
+    assert set(changes.research) == set(game_state.players["max"].research)
+    assert changes.fleet_ids == [
+        fleet.id for fleet in game_state.players["max"].fleets
+    ]
+
+    version = changes.version
+    changes = game.get_player_changes("max", version)
+    assert changes.version == version
+    assert changes.planets == {} and changes.fleets == [] and changes.research == {}
+
+    earth_fleet = game_state.players["max"].fleets[0]
+    assert game.action_send_mission("max", earth, "TRANSPORT", mars).success
+    changes = game.get_player_changes("max", version)
+    assert changes.version > version
+    assert set(changes.planets) == {earth}
+    assert [fleet.id for fleet in changes.fleets] == [earth_fleet.id]
+    assert changes.research == {}
+    # Other players do not see these changes
+    assert game.get_player_changes("bob", version).fleets == []
+
+    version = changes.version
+    game.update(1)
+    changes = game.get_player_changes("max", version)
+    assert set(changes.planets) == {earth, mars}
+    assert changes.fleets == []
+
+
+def test_response_cache():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    response_cache = ResponseCache()
+    serialised = []
+
+    def get_research():
+        research = game.get_player_research("max")
+
+        def serialise():
+            serialised.append("research")
+            return json.dumps(
+                {name: entity.serialise() for name, entity in research.items()}
+            )
+
+        return response_cache.get("max", "research", list(research.values()), serialise)
+
+    cached = get_research()
+    assert json.loads(cached.body) == json.loads(
+        json.dumps(
+            {
+                name: entity.serialise()
+                for name, entity in game_state.players["max"].research.items()
+            }
+        )
+    )
+    game.update(10)
+    assert get_research() is cached
+    assert serialised == ["research"]
+
+    research = game_state.players["max"].research["energy"]
+    research.components[ResearchComponent].level += 1
+    EntityCatalog.touch(research)
+    new_cached = get_research()
+    assert new_cached.etag != cached.etag
+    assert serialised == ["research", "research"]
+
+
+def test_snapshot(tmp_path):
+    game_state = init_state_complex()
+    game = Game(game_state)
+    game.update(3600)
+    game.action_send_mission(
+        "max",
+        PlanetLocation(1, 1, 3),
+        "TRANSPORT",
+        PlanetLocation(1, 1, 4),
+        {Resources.Metal: 2, Resources.Cristal: 2},
+    )
+    game.update(5)
+    serialised = json.dumps(game.get_state().serialise())
+
+    path = tmp_path / "game.snapshot"
+    assert save_snapshot(game_state, path) > 0
+    random_state = CombatSystem.rng.bit_generator.state
+    # Entities created after the save are dropped by the load
+    assert game.create_new_player("alice", "Alice")
+    # Versions given before the load are not given again
+    version = EntityCatalog.version
+    CombatSystem.seed(0)
+
+    loaded_state = load_snapshot(path)
+    assert loaded_state is not game_state
+    assert json.dumps(loaded_state.serialise()) == serialised
+    assert EntityCatalog.get_special("game_state") is loaded_state
+    assert EntityCatalog.version == version
+    # The loaded state replaces the saved one in the catalog
+    assert EntityCatalog.audit().clean
+    assert EntityCatalog.entities_index[game_state.id] is loaded_state
+    assert CombatSystem.rng.bit_generator.state == random_state
+    assert PlanetLocation(1, 1, 3) in PositionSystem.get_player_planets("max")
+    assert not PositionSystem.is_location_free(PlanetLocation(1, 1, 4))
+    # Shared data is restored as the constants of the game data
+    metal_mine = loaded_state.world.planets[PlanetLocation(1, 1, 3)].buildings[
+        "metal_mine"
+    ]
+    assert metal_mine.components[BuildingComponent].definition is METAL_MINE
+    assert metal_mine.components[ProducerComponent] is METAL_MINE_PRODUCER
+
+    game = Game(loaded_state)
+    game.update(100)
+    fleet_comp = game.get_player_fleets("max")[0].components[FleetComponent]
+    assert fleet_comp.mission == "RETURN"
+    assert fleet_comp.travelling_to == PlanetLocation(1, 1, 3)
+    assert (
+        loaded_state.world.planets[PlanetLocation(1, 1, 4)]
+        .components[PlanetComponent]
+        .resources[Resources.Cristal]
+        > game_state.world.planets[PlanetLocation(1, 1, 4)]
+        .components[PlanetComponent]
+        .resources[Resources.Cristal]
+    )
+
+
+def test_incremental_capture():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    earth = PlanetLocation(1, 1, 3)
+    game.update(3600)
+    previous = capture_snapshot(game_state)
+
+    game.action_send_mission(
+        "max", earth, "TRANSPORT", PlanetLocation(1, 1, 4), {Resources.Metal: 2}
+    )
+    game.action_upgrade_building("max", earth, "metal_mine")
+    assert game.create_new_player("alice", "Alice")
+    # Touching an entity stands for the changes of its descendants too
+    fleet = game_state.players["max"].fleets[1]
+    fleet.ships[0].components[ShipComponent].number += 1
+    EntityCatalog.touch(fleet)
+    game.update(5)
+
+    captured = capture_snapshot(game_state, previous)
+    assert encode_snapshot(captured) == encode_snapshot(capture_snapshot(game_state))
+
+    def player_capture(captured, player_id):
+        (capture,) = [
+            child
+            for name, key, child in captured.root.children
+            if name == "players" and key == player_id
+        ]
+        return capture
+
+    # The unchanged players are reused from the previous capture
+    assert player_capture(captured, "bob") is player_capture(previous, "bob")
+    assert player_capture(captured, "max") is not player_capture(previous, "max")
+
+
+@pytest.mark.parametrize("lazy_accrual", [False, True])
+def test_journal_recover(tmp_path, lazy_accrual):
+    journal = Journal(str(tmp_path / "journal"), fsync_interval=0)
+    game_state = init_state_complex()
+    game = Game(game_state, lazy_accrual=lazy_accrual, journal=journal)
+    game.update(3600)
+    snapshot_path = str(tmp_path / "game.snapshot")
+    game.save_snapshot(snapshot_path)
+
+    game.update(1)
+    game.action_send_mission(
+        "max",
+        PlanetLocation(1, 1, 3),
+        "TRANSPORT",
+        PlanetLocation(1, 1, 4),
+        {Resources.Metal: 2, Resources.Cristal: 2},
+    )
+    game.action_upgrade_building("max", PlanetLocation(1, 1, 3), "metal_mine")
+    assert game.create_new_player("alice", "Alice")
+    game.update(5)
+    game.update(100)
+    journal.close()
+
+    def player_view(game, player_id):
+        planets = game.get_player_planets(player_id)
+        return (
+            json.dumps(
+                {
+                    planet_id: planet.components[PlanetComponent].serialise()
+                    for planet_id, planet in planets.items()
+                }
+            ),
+            json.dumps(
+                [
+                    fleet.components[FleetComponent].serialise()
+                    for fleet in game.get_player_fleets(player_id)
+                ]
+            ),
+        )
+
+    views = {player_id: player_view(game, player_id) for player_id in ("max", "alice")}
+    world_time = game_state.world.time
+
+    # The game is recovered in its own production mode, whatever the default one
+    recovered = recover(snapshot_path, str(tmp_path / "journal"))
+    assert recovered.game_state.world.lazy_accrual == lazy_accrual
+    assert recovered.game_state is not game_state
+    assert recovered.tick == game.tick
+    assert recovered.game_state.world.time == world_time
+    for player_id, view in views.items():
+        assert player_view(recovered, player_id) == view
+
+
+def test_background_snapshot(tmp_path):
+    journal = Journal(str(tmp_path / "journal"), fsync_interval=0)
+    game_state = init_state_complex()
+    game = Game(game_state, journal=journal)
+    game.update(3600)
+    serialised = json.dumps(game_state.serialise())
+
+    snapshot_path = str(tmp_path / "game.snapshot")
+    future = game.save_snapshot_in_background(snapshot_path)
+    # The game goes on while the snapshot is written
+    game.update(100)
+    game.action_upgrade_building("max", PlanetLocation(1, 1, 3), "metal_mine")
+    report = future.result()
+    # The snapshot is recorded in the journal by the game once it is written, and
+    # the entries since its capture are replayed after it
+    game.update(1)
+    assert report.path == snapshot_path
+    assert report.size == os.path.getsize(snapshot_path)
+    assert report.capture_duration >= 0 and report.write_duration >= 0
+    assert not game.snapshots.busy
+    # Snapshots which could not be written are not recorded
+    failed_path = str(tmp_path / "missing" / "game.snapshot")
+    with pytest.raises(FileNotFoundError):
+        game.save_snapshot_in_background(failed_path).result()
+    game.update(1)
+    journal.close()
+    with pytest.raises(AssertionError):
+        recover(failed_path, str(tmp_path / "journal"))
+    metal = (
+        game_state.world.planets[PlanetLocation(1, 1, 3)]
+        .components[PlanetComponent]
+        .resources[Resources.Metal]
+    )
+
+    assert json.dumps(load_snapshot(snapshot_path).serialise()) == serialised
+    recovered = recover(snapshot_path, str(tmp_path / "journal"))
+    assert (
+        recovered.game_state.world.planets[PlanetLocation(1, 1, 3)]
+        .components[PlanetComponent]
+        .resources[Resources.Metal]
+        == metal
+    )
+
+
+def test_submit_actions():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    game.update(3600)
+    building_comp = (
+        game_state.world.planets[PlanetLocation(1, 1, 3)]
+        .buildings["metal_mine"]
+        .components[BuildingComponent]
+    )
+    level = building_comp.level
+
+    upgrade = game.submit(
+        game.action_upgrade_building, "max", PlanetLocation(1, 1, 3), "metal_mine"
+    )
+    unknown_player = game.submit(
+        game.action_build_ship, "nobody", PlanetLocation(1, 1, 3), "light_fighter"
+    )
+    # Actions wait for the game thread
+    assert not upgrade.done()
+    assert building_comp.level == level
+
+    game.update(1)
+    assert upgrade.result(timeout=0)
+    assert building_comp.level == level + 1
+    with pytest.raises(AssertionError):
+        unknown_player.result(timeout=0)
+
+
+def test_action_timeout(monkeypatch):
+    game_state = init_state_complex()
+    game = Game(game_state)
+    game.update(3600)
+    building_comp = (
+        game_state.world.planets[PlanetLocation(1, 1, 3)]
+        .buildings["metal_mine"]
+        .components[BuildingComponent]
+    )
+    level = building_comp.level
+    # The game thread is not running, actions are never applied in time
+    monkeypatch.setattr(app_module, "game_thread", game)
+    monkeypatch.setattr(app_module, "ACTION_TIMEOUT", 0.01)
+
+    client = app.test_client()
+    response = client.post("/player/max/actions/upgrade_building/1_1_3/metal_mine")
+    assert response.status_code == 503
+
+    # The timed out action is cancelled, it is not applied by the next update
+    game.update(1)
+    assert building_comp.level == level
+
+
+def test_published_response_errors(monkeypatch):
+    game = Game(init_state_complex())
+    monkeypatch.setattr(app_module, "game_thread", game)
+    monkeypatch.setattr(app_module, "ACTION_TIMEOUT", 0.01)
+    client = app.test_client()
+
+    # The game thread is not running, the views are never published
+    assert client.get("/player/max/get/planets").status_code == 503
+    assert client.get("/player/nobody/get/fleets").status_code == 503
+    game.update(1)
+    assert client.get("/player/max/get/planets").status_code == 200
+    assert client.get("/player/nobody/get/fleets").status_code == 404
+
+
+def test_get_state_chunks(monkeypatch):
+    game_state = init_state_complex()
+    game = Game(game_state)
+    monkeypatch.setattr(app_module, "game_thread", game)
+    monkeypatch.setattr(app_module, "ACTION_TIMEOUT", 0.01)
+    monkeypatch.setattr(published_views, "STATE_CHUNK_SIZE", 1000)
+    client = app.test_client()
+
+    assert client.get("/get_state").status_code == 503
+    game.update(1)
+    # The state is published planet by planet and player by player
+    assert len(game.views.get(None, "state", timeout=0).body) > 1
+    response = client.get("/get_state")
+    assert response.status_code == 200
+    assert json.loads(response.data) == json.loads(json.dumps(game_state.serialise()))
+    response = client.get(
+        "/get_state", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+
+def test_audit_endpoint(monkeypatch):
+    game = Game(init_state_complex())
+    monkeypatch.setattr(app_module, "game_thread", game)
+    monkeypatch.setattr(app_module, "ACTION_TIMEOUT", 0.01)
+    client = app.test_client()
+
+    # Disabled by default
+    assert client.get("/audit").status_code == 404
+    # Without stalling the game
+    assert game.actions.empty()
+
+    # The game thread is not running, the audit is submitted but not run in time
+    monkeypatch.setattr(app_module, "AUDIT_ENDPOINT", True)
+    assert client.get("/audit").status_code == 503
+
+
+def test_published_views():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    game.update(3600)
+
+    # Views are published from the update following their first read
+    with pytest.raises(TimeoutError):
+        game.views.get("max", "planets", timeout=0)
+    with pytest.raises(TimeoutError):
+        game.views.get(None, "state", timeout=0)
+    with pytest.raises(TimeoutError):
+        game.views.get("nobody", "fleets", timeout=0)
+    game.update(1)
+
+    planets = game.views.get("max", "planets", timeout=0)
+    assert json.loads(planets.body) == json.loads(
+        json.dumps(
+            {
+                planet_id: planet.serialise()
+                for planet_id, planet in game.get_player_planets("max").items()
+            }
+        )
+    )
+    state = game.views.get(None, "state", timeout=0)
+    assert json.loads(b"".join(state.body)) == json.loads(
+        json.dumps(game_state.serialise())
+    )
+    assert game.views.get("nobody", "fleets", timeout=0) is None
+
+    # Published views are not changed by the game until the next update
+    game.action_upgrade_building("max", PlanetLocation(1, 1, 3), "metal_mine")
+    assert game.views.get("max", "planets", timeout=0) is planets
+    game.update(1)
+    assert game.views.get("max", "planets", timeout=0).etag != planets.etag
+    # The planets view follows the resources they produce
+    planets = game.views.get("max", "planets", timeout=0)
+    game.update(60)
+    produced = game.views.get("max", "planets", timeout=0)
+    assert produced.etag != planets.etag
+    earth_id = str(PlanetLocation(1, 1, 3))
+    metal = json.loads(planets.body)[earth_id]["components"]["PlanetComponent"][
+        "resources"
+    ]["metal"]
+    assert (
+        json.loads(produced.body)[earth_id]["components"]["PlanetComponent"][
+            "resources"
+        ]["metal"]
+        > metal
+    )
+    # The whole state is only published for the reads waiting for it
+    game.update(1)
+    with pytest.raises(TimeoutError):
+        game.views.get(None, "state", timeout=0)
+
+
+def test_async_server():
+    async def exchange():
+        server = WSGIServer(app, host="127.0.0.1", port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+
+        async def request(lines: str):
+            writer.write(lines.encode())
+            status = (await reader.readline()).decode().strip()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            return status, headers, body
+
+        # Requests are served one after the other on the same connection
+        responses = [
+            await request("GET /ping HTTP/1.1\r\nHost: test\r\n\r\n"),
+            await request("GET /unknown HTTP/1.1\r\nHost: test\r\n\r\n"),
+            await request(
+                "GET /ping HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n"
+            ),
+        ]
+        assert await reader.read() == b""
+        writer.close()
+        server.server.close()
+        await server.server.wait_closed()
+        return responses
+
+    ping, unknown, last_ping = asyncio.run(exchange())
+    assert ping[0] == "HTTP/1.1 200 OK"
+    assert ping[1]["connection"] == "keep-alive"
+    assert ping[2] == b"pong"
+    assert unknown[0] == "HTTP/1.1 404 NOT FOUND"
+    assert last_ping[1]["connection"] == "close"
+    assert last_ping[2] == b"pong"
+
+
+def test_async_server_limits():
+    async def exchange(lines: str):
+        server = WSGIServer(
+            app, host="127.0.0.1", port=0, keep_alive_timeout=0.1, request_timeout=0.1
+        )
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(lines.encode())
+        status = (await reader.readline()).decode().strip()
+        await reader.read()
+        writer.close()
+        server.server.close()
+        await server.server.wait_closed()
+        return status
+
+    # The end of the headers is never sent
+    slow = asyncio.run(exchange("GET /ping HTTP/1.1\r\nHost: test\r\n"))
+    assert slow == "HTTP/1.1 408 Request Timeout"
+    # Nor the body
+    slow = asyncio.run(
+        exchange("POST /ping HTTP/1.1\r\nContent-Length: 10\r\n\r\nping")
+    )
+    assert slow == "HTTP/1.1 408 Request Timeout"
+
+    headers = "".join(f"X-Header-{i}: {i}\r\n" for i in range(MAX_HEADERS + 1))
+    too_many = asyncio.run(exchange(f"GET /ping HTTP/1.1\r\n{headers}\r\n"))
+    assert too_many == "HTTP/1.1 431 Request Header Fields Too Large"
+    headers = "".join(f"X-Header-{i}: {i}\r\n" for i in range(MAX_HEADERS))
+    enough = asyncio.run(exchange(f"GET /ping HTTP/1.1\r\n{headers}\r\n"))
+    assert enough == "HTTP/1.1 200 OK"
+
+
+def test_async_server_app_error(capsys):
+    def failing_app(environ, start_response):
+        raise RuntimeError("failing app")
+
+    async def exchange():
+        server = WSGIServer(failing_app, host="127.0.0.1", port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"GET /ping HTTP/1.1\r\nHost: test\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        await server.server.wait_closed()
+        return response
+
+    response = asyncio.run(exchange())
+    assert response.startswith(b"HTTP/1.1 500 Internal Server Error\r\n")
+    assert b"Connection: close" in response
+    assert "RuntimeError: failing app" in capsys.readouterr().err
+
+
 def test_universe_speed():
     game_state = initialise_gamestate()
     game = Game(game_state)
@@ -385,3 +1190,352 @@ def test_universe_speed():
     game.update(1)
 
     assert earth.components[PlanetComponent].resources[Resources.Metal] == 10000
+
+
+def test_vectorized_production():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    levels = {"metal_mine": 3, "cristal_mine": 2, "solar_plant": 4, "metal_hangar": 1}
+    for i, planet in enumerate(game_state.world.planets.values()):
+        for building_id, level in levels.items():
+            planet.buildings[building_id].components[BuildingComponent].level = (
+                level + i
+            )
+
+    def run(vectorized):
+        for planet in game_state.world.planets.values():
+            planet.components[PlanetComponent].resources = {
+                resource: 100.0 for resource in Resources
+            }
+        ProductionSystem.vectorized = vectorized
+        try:
+            for dt in (1, 60, 3600):
+                game.update(dt)
+        finally:
+            ProductionSystem.vectorized = True
+        return {
+            planet_id: (
+                dict(planet.components[PlanetComponent].resources),
+                dict(planet.components[PlanetComponent]._production_per_second),
+                dict(planet.components[PlanetComponent]._resources_storage),
+            )
+            for planet_id, planet in game.get_state().world.planets.items()
+        }
+
+    expected = run(vectorized=False)
+    result = run(vectorized=True)
+    for planet_id, planet_values in expected.items():
+        for expected_values, values in zip(planet_values, result[planet_id]):
+            for resource in Resources:
+                assert values[resource] == pytest.approx(expected_values[resource])
+
+
+def test_vectorized_resources():
+    game_state = initialise_gamestate()
+    game = Game(game_state)
+    earth = game_state.world.planets[PlanetLocation(1, 1, 3)]
+    earth_comp = earth.components[PlanetComponent]
+    game.update(60)
+    game.update(60)
+
+    # The resources are kept in the arrays of the engine until the planet is settled
+    assert earth_comp._last_settled == 60
+    ProductionSystem.settle(earth)
+    assert earth_comp._last_settled == 120
+    metal = earth_comp.resources[Resources.Metal]
+    assert metal > 0
+    # Settling the planet again does not overwrite what it spent since
+    earth_comp.resources[Resources.Metal] -= 100
+    ProductionSystem.settle(earth)
+    assert earth_comp.resources[Resources.Metal] == metal - 100
+
+    # The next update accumulates from what was left
+    game.update(60)
+    ProductionSystem.settle(earth)
+    metal_per_second = earth_comp._production_per_second[Resources.Metal]
+    assert earth_comp.resources[Resources.Metal] == pytest.approx(
+        metal - 100 + metal_per_second * 60
+    )
+
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_production_rates_cache(vectorized):
+    ProductionSystem.vectorized = vectorized
+    try:
+        game_state = initialise_gamestate()
+        game = Game(game_state)
+        earth = game_state.world.planets[PlanetLocation(1, 1, 3)]
+        earth_comp = earth.components[PlanetComponent]
+
+        game.update(3600)
+        metal_per_second = earth_comp._production_per_second[Resources.Metal]
+        assert metal_per_second == pytest.approx(30 / 3600 * game_state.world.speed)
+
+        # Rates are cached until something marks the planet dirty
+        # (setting the level through __dict__ bypasses the automatic invalidation)
+        for building_id, level in (("solar_plant", 5), ("metal_mine", 1)):
+            building_comp = earth.buildings[building_id].components[BuildingComponent]
+            building_comp.__dict__["level"] = level
+        game.update(1)
+        assert earth_comp._production_per_second[Resources.Metal] == metal_per_second
+
+        ProductionSystem.mark_dirty(earth)
+        game.update(1)
+        assert earth_comp._production_per_second[Resources.Metal] == pytest.approx(
+            metal_per_second * (1 + 1.1)
+        )
+
+        # Upgrading a building invalidates the cache
+        metal_per_second = earth_comp._production_per_second[Resources.Metal]
+        assert game.action_upgrade_building(
+            "max", PlanetLocation(1, 1, 3), "metal_mine"
+        )
+        game.update(1)
+        assert earth_comp._production_per_second[Resources.Metal] > metal_per_second
+
+        # and so does changing the universe speed
+        metal_per_second = earth_comp._production_per_second[Resources.Metal]
+        game_state.world.speed *= 2
+        game.update(1)
+        assert earth_comp._production_per_second[Resources.Metal] == pytest.approx(
+            2 * metal_per_second
+        )
+    finally:
+        ProductionSystem.vectorized = True
+
+
+@pytest.mark.parametrize(
+    "vectorized, lazy_accrual", [(True, False), (False, False), (True, True)]
+)
+def test_production_changes(vectorized, lazy_accrual):
+    ProductionSystem.vectorized = vectorized
+    try:
+        game_state = init_state_complex()
+        game = Game(game_state, lazy_accrual=lazy_accrual)
+        earth = PlanetLocation(1, 1, 3)
+        game.update(1)
+        changes = game.get_player_changes("max", 0)
+        serialised = changes.planets[earth].components[PlanetComponent].serialise()
+
+        # The production does not change the planets
+        for _ in range(10):
+            game.update(60)
+        changes = game.get_player_changes("max", changes.version)
+        assert changes.planets == {}
+        # Clients compute the resources from the rates, up to the current game time
+        assert changes.time == game_state.world.time
+        elapsed = changes.time - serialised["_last_settled"]
+        assert elapsed == 600
+        earth_comp = game_state.world.planets[earth].components[PlanetComponent]
+        for resource, quantity in earth_comp.resources.items():
+            produced = serialised["resources"][resource.value] + (
+                serialised["_production_per_second"][resource.value] * elapsed
+            )
+            assert produced > serialised["resources"][resource.value]
+            capacity = serialised["_resources_storage"][resource.value]
+            assert quantity == pytest.approx(min(produced, capacity))
+
+        # Upgrades change the planet, and so do the rates they change
+        assert game.action_upgrade_building("max", earth, "metal_mine")
+        assert game.action_upgrade_building("max", earth, "solar_plant")
+        changes = game.get_player_changes("max", changes.version)
+        assert set(changes.planets) == {earth}
+        client_earth = changes.planets[earth].components[PlanetComponent].serialise()
+        game.update(1)
+        changes = game.get_player_changes("max", changes.version)
+        if changes.planets:
+            client_earth = (
+                changes.planets[earth].components[PlanetComponent].serialise()
+            )
+        rates = client_earth["_production_per_second"]
+        assert rates == earth_comp.serialise()["_production_per_second"]
+        assert rates["metal"] > serialised["_production_per_second"]["metal"]
+    finally:
+        ProductionSystem.vectorized = True
+
+
+def test_lazy_accrual():
+    def play(lazy_accrual):
+        PositionSystem.reset()
+        game_state = init_state_complex()
+        game = Game(game_state, lazy_accrual=lazy_accrual)
+        earth = PlanetLocation(1, 1, 3)
+        for _ in range(10):
+            game.update(60)
+        game.action_upgrade_building("max", earth, "metal_mine")
+        game.action_upgrade_building("max", earth, "solar_plant")
+        for _ in range(30):
+            game.update(60)
+        mars = PlanetLocation(1, 1, 4)
+        game.action_send_mission("max", earth, "TRANSPORT", mars, {Resources.Metal: 10})
+        for _ in range(60):
+            game.update(60)
+        return {
+            planet_id: planet.components[PlanetComponent].resources
+            for planet_id, planet in game.get_player_planets("max").items()
+        }
+
+    eager_resources = play(lazy_accrual=False)
+    lazy_resources = play(lazy_accrual=True)
+    # Creating a game does not change the production mode of the others
+    PositionSystem.reset()
+    lazy_game = Game(init_state_complex(), lazy_accrual=True)
+    PositionSystem.reset()
+    Game(init_state_complex(), lazy_accrual=False)
+    assert lazy_game.game_state.world.lazy_accrual
+    assert eager_resources.keys() == lazy_resources.keys()
+    for planet_id, resources in eager_resources.items():
+        assert resources[Resources.Metal] > 0
+        for resource, quantity in resources.items():
+            assert lazy_resources[planet_id][resource] == pytest.approx(quantity)
+
+
+def test_fleet_arrivals_schedule(monkeypatch):
+    game_state = init_state_complex()
+    game = Game(game_state)
+    earth = PlanetLocation(1, 1, 3)
+    mars = PlanetLocation(1, 1, 4)
+
+    executed = []
+    execute_mission = MissionSystem.execute_mission
+
+    def record_execution(game_state, fleet):
+        executed.append(fleet.components[FleetComponent].travelling_to)
+        execute_mission(game_state, fleet)
+
+    monkeypatch.setattr(MissionSystem, "execute_mission", record_execution)
+
+    game.update(1)
+    # Both fleets travel the same distance and arrive at the same time
+    assert game.action_send_mission("max", earth, "TRANSPORT", mars).success
+    assert game.action_send_mission("max", mars, "TRANSPORT", earth).success
+    travel_time = (
+        game_state.players["max"].fleets[0].components[FleetComponent].travel_time_left
+    )
+    assert len(MissionSystem.arrivals) == 2
+
+    game.update(travel_time / 2)
+    assert executed == []
+
+    game.update(travel_time / 2)
+    # Simultaneous arrivals are executed in the order the missions were sent
+    assert executed == [mars, earth]
+    # The fleets are now returning
+    assert len(MissionSystem.arrivals) == 2
+
+    game.update(travel_time)
+    assert executed == [mars, earth, earth, mars]
+    assert MissionSystem.arrivals == []
+    for fleet in game_state.players["max"].fleets:
+        assert not fleet.components[FleetComponent].in_transit
+
+
+def test_snapshot_fleet_arrivals(monkeypatch, tmp_path):
+    game_state = init_state_complex()
+    game = Game(game_state)
+    earth = PlanetLocation(1, 1, 3)
+    mars = PlanetLocation(1, 1, 4)
+
+    executed = []
+    execute_mission = MissionSystem.execute_mission
+
+    def record_execution(game_state, fleet):
+        executed.append(fleet.components[FleetComponent].travelling_to)
+        execute_mission(game_state, fleet)
+
+    monkeypatch.setattr(MissionSystem, "execute_mission", record_execution)
+
+    game.update(1)
+    # The missions are sent in the reverse order of the fleets
+    assert game.action_send_mission("max", mars, "TRANSPORT", earth).success
+    assert game.action_send_mission("max", earth, "TRANSPORT", mars).success
+    travel_time = (
+        game_state.players["max"].fleets[0].components[FleetComponent].travel_time_left
+    )
+    game.update(travel_time / 2)
+    path = tmp_path / "game.snapshot"
+    save_snapshot(game_state, path)
+
+    game = Game(load_snapshot(path))
+    game.update(travel_time / 2)
+    # Simultaneous arrivals are still executed in the order the missions were sent
+    assert executed == [earth, mars]
+
+
+def test_fleet_index():
+    game_state = init_state_complex()
+    game = Game(game_state)
+    earth = PlanetLocation(1, 1, 3)
+    mars = PlanetLocation(1, 1, 4)
+    jupiter = PlanetLocation(1, 1, 5)
+    earth_fleet, mars_fleet = game_state.players["max"].fleets
+
+    assert PositionSystem.get_player_fleet("max", earth) is earth_fleet
+    assert PositionSystem.get_player_fleet("bob", earth) is None
+    assert PositionSystem.get_stationed_fleets(jupiter) == [
+        game_state.players["bob"].fleets[0]
+    ]
+
+    game.update(1)
+    assert game.action_send_mission("max", earth, "TRANSPORT", mars).success
+    assert PositionSystem.get_player_fleet("max", earth) is None
+    assert PositionSystem.get_stationed_fleets(earth) == []
+
+    # The fleet comes back to earth
+    game.update(earth_fleet.components[FleetComponent].travel_time_left)
+    game.update(earth_fleet.components[FleetComponent].travel_time_left)
+    assert PositionSystem.get_player_fleet("max", earth) is earth_fleet
+
+    # Bob's only fleet is away from jupiter, an empty fleet defends the planet
+    assert game.action_send_mission("bob", jupiter, "TRANSPORT", earth).success
+    bob_fleet = game_state.players["bob"].fleets[0]
+    assert game.action_send_mission("max", earth, "ATTACK", jupiter).success
+    game.update(earth_fleet.components[FleetComponent].travel_time_left)
+    assert game_state.players["bob"].fleets == [bob_fleet]
+    assert bob_fleet.heavy_fighter.components[ShipComponent].number == 5
+    assert PositionSystem.get_stationed_fleets(jupiter) == []
+
+
+def test_free_locations():
+    game_state = initialise_empty_universe()
+    game = Game(game_state)
+    PositionSystem.set_universe_size(galaxies=1, systems=2, positions=2)
+
+    for i in range(4):
+        assert game.create_new_player(f"player_{i}", f"Player {i}")
+    assert set(game_state.world.planets) == {
+        PlanetLocation(1, system, position)
+        for system in range(1, 3)
+        for position in range(1, 3)
+    }
+
+    with pytest.raises(AssertionError):
+        game.create_new_player("player_5", "Player 5")
+
+    PositionSystem.set_universe_size(galaxies=1, systems=2, positions=3)
+    assert PositionSystem.get_random_free_location() in {
+        PlanetLocation(1, 1, 3),
+        PlanetLocation(1, 2, 3),
+    }
+
+
+def test_planet_location():
+    location = PlanetLocation(2, 301, 7)
+    assert location == "2_301_7"
+    assert json.dumps({location: 1}) == '{"2_301_7": 1}'
+    # Locations are interned
+    assert PlanetLocation(2, 301, 7) is location
+    assert PlanetLocation.from_str("2_301_7") is location
+    assert PlanetLocation.from_key(location.key) is location
+    assert pickle.loads(pickle.dumps(location)) is location
+
+    targets = [
+        PlanetLocation(1, 1, 1),
+        PlanetLocation(2, 12, 7),
+        PlanetLocation(2, 301, 1),
+        location,
+        PlanetLocation(5, 301, 7),
+    ]
+    assert location.distances_to(targets).tolist() == [
+        location.distance_from(target) for target in targets
+    ]